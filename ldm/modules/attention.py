@@ -151,11 +151,173 @@ class SpatialSelfAttention(nn.Module):
         return x + h_
 
 
+class AttentionChunkPlanner:
+    """
+    Decides in how many query chunks an attention gets split so that it fits into memory.
+    The allocator is only queried the first time a (sequence lengths, batch * heads, dtype, device, budget)
+    combination is seen, the plan is then reused until reset() (UNet.sample calls it at the start of every run).
+    An explicit budget in bytes can be given per device type, e.g. set_budget("cpu", 8 * 1024 ** 3), otherwise
+    the free cuda memory is used and cpu attention is not split.
+    """
+
+    def __init__(self):
+        self.budgets = {}
+        self.plans = {}
+        self.verbose = False
+
+    def set_budget(self, device_type, budget):
+        self.budgets[device_type] = budget
+        self.reset()
+
+    def reset(self):
+        self.plans.clear()
+
+    def free_memory(self, device):
+        budget = self.budgets.get(device.type)
+        if budget is not None:
+            return budget
+        if device.type != "cuda" or sys.platform == "darwin":  # means we can't count gpu memory
+            return None
+        torch.cuda.empty_cache()
+        stats = torch.cuda.memory_stats(device)
+        mem_active = stats['active_bytes.all.current']
+        mem_reserved = stats['reserved_bytes.all.current']
+        mem_free_cuda, _ = torch.cuda.mem_get_info(device)
+        mem_free_total = mem_free_cuda + mem_reserved - mem_active
+        return math.ceil(mem_free_total / 10 ** int(math.log10(mem_free_total) - 1)) * (
+                10 ** int(math.log10(mem_free_total) - 1))
+
+    def chunks(self, device, dtype, batch_heads, q_len, k_len, needed, factor=1):
+        """Number of query chunks for an attention that needs `needed` bytes when done in one go."""
+        device = torch.device(device)
+        key = (q_len, k_len, batch_heads, dtype, str(device), self.budgets.get(device.type), factor)
+        plan = self.plans.get(key)
+        if plan is None:
+            free = self.free_memory(device)
+            chunk_split = 1 if free is None or needed <= free else (int(needed / free) + 1) * factor
+            plan = dict(q_len=q_len, k_len=k_len, batch_heads=batch_heads, dtype=str(dtype), device=str(device),
+                        needed=int(needed), free=free, chunks=min(chunk_split, q_len))
+            self.plans[key] = plan
+            if self.verbose:
+                print(f"attention plan: {plan}")
+        return plan["chunks"]
+
+    def describe(self):
+        """The plans chosen so far, for debugging."""
+        return list(self.plans.values())
+
+
+chunk_planner = AttentionChunkPlanner()
+
+
+try:
+    import xformers
+    import xformers.ops
+
+    XFORMERS_IS_AVAILABLE = True
+except Exception:
+    XFORMERS_IS_AVAILABLE = False
+
+
+# attention backends, all of them take q, k, v as (b h) n d and return (b h) n d
+
+def naive_attention(q, k, v, scale, **kwargs):
+    """reference implementation"""
+    sim = einsum('b i d, b j d -> b i j', q, k) * scale
+    return einsum('b i j, b j d -> b i d', sim.softmax(dim=-1), v)
+
+
+def einsum_attention(q, k, v, scale, secondary_device=None, factor=1, result_device=None, **kwargs):
+    """splits the queries into as many chunks as the chunk planner asks for, the result (and q, k between chunks)
+    can be kept on a secondary device. With result_device only the result is collected (and returned) there while
+    q and k stay where they are."""
+    device, dtype = q.device, q.dtype
+    secondary_device = default(secondary_device, device)
+    dtype_multiplyer = q.element_size()
+    s1, s2, s3, s4 = (q.shape[0] * q.shape[1] * k.shape[1] * 1.5 * dtype_multiplyer), \
+                     (q.shape[0] * q.shape[1] * k.shape[1] * dtype_multiplyer), \
+                     (q.shape[0] * q.shape[1] * q.shape[2] * 3 * dtype_multiplyer), \
+                     (q.shape[0] * q.shape[1] * v.shape[2] * 2 * dtype_multiplyer)
+    # 4 main operations' needed compute memory: softmax, einsum, another einsum, and r1 allocation memory.
+    chunk_split = chunk_planner.chunks(device, dtype, q.shape[0], q.shape[1], k.shape[1], s1 + s2 + s3 + s4,
+                                       factor=factor)
+    r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=default(result_device, secondary_device), dtype=dtype)
+    mp = q.shape[1] // chunk_split
+    for i in range(0, q.shape[1], mp):
+        q, k = q.to(device, non_blocking=True), k.to(device, non_blocking=True)
+        s1 = einsum('b i d, b j d -> b i j', q[:, i:i + mp], k)
+        q, k = q.to(secondary_device, non_blocking=True), k.to(secondary_device, non_blocking=True)
+        s1 *= scale
+        s1 = F.softmax(s1, dim=-1)
+        r1[:, i:i + mp] = einsum('b i j, b j d -> b i d', s1, v).to(r1.device, non_blocking=True)
+        del s1
+    if result_device is not None:
+        return r1
+    return r1.to(device, non_blocking=True)
+
+
+def _default_scale(q, scale):
+    # sdpa and xformers scale by 1 / sqrt(d), fold any other scale into q
+    default_scale = q.shape[-1] ** -0.5
+    return q if abs(scale - default_scale) < 1e-8 else q * (scale / default_scale)
+
+
+def sdpa_attention(q, k, v, scale, **kwargs):
+    return F.scaled_dot_product_attention(_default_scale(q, scale), k, v)
+
+
+def xformers_attention(q, k, v, scale, **kwargs):
+    q, k, v = map(lambda t: t.contiguous(), (_default_scale(q, scale), k, v))
+    return xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None)
+
+
+ATTENTION_BACKENDS = {
+    "einsum": einsum_attention,
+    "sdpa": sdpa_attention,
+    "xformers": xformers_attention,
+    "naive": naive_attention,
+}
+# what to use instead when a backend can't run
+ATTENTION_FALLBACKS = {
+    "xformers": "sdpa",
+    "sdpa": "einsum",
+}
+
+
+def attention_backend_available(name, device):
+    if name == "xformers":
+        return XFORMERS_IS_AVAILABLE and torch.device(device).type == "cuda"
+    if name == "sdpa":
+        return hasattr(F, "scaled_dot_product_attention")
+    return name in ATTENTION_BACKENDS
+
+
+def resolve_attention_backend(name, device, speed_mp=None):
+    """Turns "auto" or an unavailable backend into the backend that will actually run."""
+    if name is None or name == "auto":
+        if torch.device(device).type == "cpu":
+            name = "sdpa"
+        else:
+            name = "xformers" if speed_mp else "einsum"
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"unknown attention backend '{name}', choose from {list(ATTENTION_BACKENDS)} or 'auto'")
+    while not attention_backend_available(name, device):
+        name = ATTENTION_FALLBACKS[name]
+    return name
+
+
+def attention(q, k, v, scale, backend="auto", speed_mp=None, **kwargs):
+    backend = resolve_attention_backend(backend, q.device, speed_mp)
+    return ATTENTION_BACKENDS[backend](q, k, v, scale, **kwargs)
+
+
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, superfastmode=True, context_dim=None, heads=8, dim_head=64, dropout=0.):
+    def __init__(self, query_dim, superfastmode=True, context_dim=None, heads=8, dim_head=64, dropout=0.,
+                 attn_backend="auto"):
         super().__init__()
         self.dim_head = 40
         inner_dim = dim_head * heads
+        self.is_cross_attention = context_dim is not None
         context_dim = default(context_dim, query_dim)
 
         self.scale = dim_head ** -0.5
@@ -170,138 +332,82 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
         self.fast_forward = superfastmode
-
-    def _maybe_init(self, x):
-        """
-        Initialize the attention operator, if required We expect the head dimension to be exposed here, meaning that x
-        : B, Head, Length
-        """
-        _, M, K = x.shape
-        try:
-            import xformers
-            import xformers.ops
-            self.attention_op = xformers.ops.AttentionOpDispatch(
-                dtype=x.dtype,
-                device=x.device,
-                k=K,
-                attn_bias_type=type(None),
-                has_dropout=False,
-                kv_len=M,
-                q_len=M,
-            ).op
-        except Exception as err:
-            raise Exception(
-                f"Please install xformers with the flash attention / cutlass components or disable it.\n{err}")
-
-    def light_forward(self, x, context=None, mask=None, dtype=None, fucking_hell=False):
-        try:
-            import xformers
-            import xformers.ops
-        except Exception as e:
-            raise ModuleNotFoundError("Please install xformers!", e)
-        q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
-
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.unsqueeze(3)
-                .reshape(b, t.shape[1], self.heads, int(t.shape.numel() / (b * self.heads * t.shape[1])))
-                .permute(0, 2, 1, 3)
-                .reshape(b * self.heads, t.shape[1], int(t.shape.numel() / (b * self.heads * t.shape[1])))
-                .contiguous(),
-            (q, k, v),
-        )
-
-        # init the attention op, if required, using the proper dimensions
-        self._maybe_init(q)
-
-        # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=self.attention_op)
-        del q, k, v
-
-        out = (
-            out.unsqueeze(0)
-                .reshape(b, self.heads, out.shape[1], int(out.shape.numel() / (b * self.heads * out.shape[1])))
-                .permute(0, 2, 1, 3)
-                .reshape(b, out.shape[1], int(out.shape.numel() / (b * out.shape[1])))
-        )
-        return self.to_out(out)
-
-    def forward(self, x, speed_mp=None, context=None, mask=None, dtype=None, fucking_hell=False):
-        if speed_mp:
-            return self.light_forward(x, context=context, mask=mask, dtype=dtype, fucking_hell=fucking_hell)
+        self.attn_backend = attn_backend
+        self.kv_cache = None  # projected keys/values of the text context, see set_kv_cache()
+
+    def set_kv_cache(self, enabled):
+        """The context only changes between sampling runs, while enabled its projections are computed once
+        per context tensor. Enabling again drops whatever was cached."""
+        self.kv_cache = {} if enabled else None
+
+    def project_context(self, context):
+        if self.kv_cache is None:
+            return self.to_k(context), self.to_v(context)
+        key = (context.data_ptr(), tuple(context.shape), context.stride(), context.dtype, context.device,
+               context._version, self.to_k.weight.dtype)
+        entry = self.kv_cache.get(key)
+        if entry is None:
+            # keeping the context alive makes sure its address can't be reused by another tensor meanwhile
+            entry = self.kv_cache[key] = (context, self.to_k(context), self.to_v(context))
+        return entry[1], entry[2]
+
+    def forward(self, x, speed_mp=None, context=None, mask=None, dtype=None, fucking_hell=False, attn_backend=None):
         h = self.heads
         device = x.device
         secondary_device = device if (self.fast_forward and sys.platform != "darwin") else torch.device("cpu")  # macs
         dtype = x.dtype if dtype is None else dtype
         x = x.to(dtype, non_blocking=True)
         q_proj = self.to_q(x)
-        context = default(context, x)
-        k_proj = self.to_k(context)
-        v_proj = self.to_v(context)
+        if context is None:
+            k_proj, v_proj = self.to_k(x), self.to_v(x)
+        else:
+            k_proj, v_proj = self.project_context(context)
 
         del context, x
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q_proj, k_proj, v_proj))
         del q_proj, k_proj, v_proj
-        if sys.platform != "darwin" and device != "cpu":  # means we can't count gpu memory
-            torch.cuda.empty_cache()
-            stats = torch.cuda.memory_stats(device)
-            mem_active = stats['active_bytes.all.current']
-            mem_reserved = stats['reserved_bytes.all.current']
-            mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-            mem_free_torch = mem_reserved - mem_active
-            mem_free_total = (mem_free_cuda + mem_free_torch)
-            mem_free_total = math.ceil(mem_free_total / 10 ** int(math.log10(mem_free_total) - 1)) * (
-                    10 ** int(math.log10(mem_free_total) - 1))
-            dtype_multiplyer = 2 if str(dtype) == "torch.float16" else 4
-            s1, s2, s3, s4 = (q.shape[0] * q.shape[1] * q.shape[1] * 1.5 * dtype_multiplyer), \
-                             (q.shape[0] * (q.shape[1] ** 2) * dtype_multiplyer), \
-                             (q.shape[0] * q.shape[1] * q.shape[2] * 3 * dtype_multiplyer), \
-                             (q.shape[0] * q.shape[1] * v.shape[2] * 2 * dtype_multiplyer)
-            s = int((s1 + s2 + s3 + s4))
-            # 4 main operations' needed compute memory: softmax, einsum, another einsum, and r1 allocation memory.
-            chunk_split = int(((s / mem_free_total) + 1)) * (2 if fucking_hell else 1) if s > mem_free_cuda else 1
-        else:
-            chunk_split = 1
-        r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=secondary_device)
-        mp = q.shape[1] // chunk_split
-        # print("The operation will need \t", s, s // 1024 // 1024)
-        # print("The available memory is \t", mem_free_total, mem_free_total // 1024 // 1024)
-        # print(f"Splitting into {chunk_split} chunks")
-        for i in range(0, q.shape[1], mp):
-            q, k = q.to(device, non_blocking=True), k.to(device, non_blocking=True)
-            s1 = einsum('b i d, b j d -> b i j', q[:, i:i + mp], k)
-            q, k = q.to(secondary_device, non_blocking=True), k.to(secondary_device, non_blocking=True)
-            s1 *= self.scale
-            s1 = F.softmax(s1, dim=-1)
-            r1[:, i:i + mp] = einsum('b i j, b j d -> b i d', s1, v).to(secondary_device, non_blocking=True)
-        r1 = rearrange(r1, '(b h) n d -> b n (h d)', h=h).to(dtype).to(device, non_blocking=True)
+        r1 = attention(q, k, v, self.scale, backend=default(attn_backend, self.attn_backend), speed_mp=speed_mp,
+                       secondary_device=secondary_device, factor=2 if fucking_hell else 1)
+        del q, k, v
+        r1 = rearrange(r1, '(b h) n d -> b n (h d)', h=h).to(dtype)
         return self.to_out(r1)
 
 
 class BasicTransformerBlock(nn.Module):
     def __init__(self, dim, n_heads, d_head, dropout=0., superfastmode=True, context_dim=None, gated_ff=True,
-                 checkpoint=True):
+                 checkpoint=True, attn_backend="auto"):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head,
-                                    dropout=dropout, superfastmode=superfastmode)  # is a self-attention
+        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    superfastmode=superfastmode, attn_backend=attn_backend)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout, superfastmode=superfastmode)
+                                    heads=n_heads, dim_head=d_head, dropout=dropout, superfastmode=superfastmode,
+                                    attn_backend=attn_backend)
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
         self.checkpoint = checkpoint
 
-    def forward(self, x, speed_mp=None, context=None, fucking_hell=False):
-        return checkpoint(self._forward, (x, speed_mp, context, fucking_hell), self.parameters(), self.checkpoint)
+    def forward(self, x, speed_mp=None, context=None, fucking_hell=False, token_merge=None):
+        return checkpoint(self._forward, (x, speed_mp, context, fucking_hell, token_merge), self.parameters(),
+                          self.checkpoint)
 
-    def _forward(self, x, speed_mp=None, context=None, fucking_hell=False):
-        x = self.attn1(self.norm1(x), speed_mp=speed_mp, dtype=x.dtype, fucking_hell=fucking_hell) + x
+    def _forward(self, x, speed_mp=None, context=None, fucking_hell=False, token_merge=None):
+        # token_merge: (settings, h, w) to run attn1 (and ff) on merged tokens
+        if token_merge is None:
+            x = self.attn1(self.norm1(x), speed_mp=speed_mp, dtype=x.dtype, fucking_hell=fucking_hell) + x
+        else:
+            settings, h, w = token_merge
+            x_norm = self.norm1(x)
+            merge, unmerge = settings.matching(x_norm, h, w)
+            x = unmerge(self.attn1(merge(x_norm), speed_mp=speed_mp, dtype=x.dtype, fucking_hell=fucking_hell)) + x
         x = self.attn2(self.norm2(x), speed_mp=speed_mp, context=context, dtype=x.dtype) + x
-        x = self.ff(self.norm3(x)) + x
+        if token_merge is not None and token_merge[0].merge_ff:
+            x_norm = self.norm3(x)
+            merge, unmerge = token_merge[0].matching(x_norm, token_merge[1], token_merge[2])
+            x = unmerge(self.ff(merge(x_norm))) + x
+        else:
+            x = self.ff(self.norm3(x)) + x
         return x
 
 
@@ -315,9 +421,11 @@ class SpatialTransformer(nn.Module):
     """
 
     def __init__(self, in_channels, n_heads, d_head,
-                 depth=1, dropout=0., superfastmode=True, context_dim=None):
+                 depth=1, dropout=0., superfastmode=True, context_dim=None, attn_backend="auto", downsample=None):
         super().__init__()
         self.in_channels = in_channels
+        self.downsample = downsample  # of the latent at this level, decides whether token merging applies
+        self.token_merge = None  # TokenMerge settings, see set_token_merge()
         inner_dim = n_heads * d_head
         self.norm = Normalize(in_channels)
 
@@ -329,7 +437,7 @@ class SpatialTransformer(nn.Module):
 
         self.transformer_blocks = nn.ModuleList(
             [BasicTransformerBlock(inner_dim, n_heads, d_head, superfastmode=superfastmode, dropout=dropout,
-                                   context_dim=context_dim)
+                                   context_dim=context_dim, attn_backend=attn_backend)
              for _ in range(depth)]
         )
         self.proj_out = zero_module(nn.Conv2d(inner_dim,
@@ -338,6 +446,9 @@ class SpatialTransformer(nn.Module):
                                               stride=1,
                                               padding=0))
 
+    def set_token_merge(self, settings):
+        self.token_merge = settings
+
     def forward(self, x, context=None, speed_mp=None):
         # note: if no context is given, cross-attention defaults to self-attention
         b, c, h, w = x.shape
@@ -345,8 +456,11 @@ class SpatialTransformer(nn.Module):
         x = self.norm(x)
         x = self.proj_in(x)
         x = rearrange(x, 'b c h w -> b (h w) c')
+        token_merge = None
+        if self.token_merge is not None and self.token_merge.applies(self.downsample):
+            token_merge = (self.token_merge, h, w)
         for block in self.transformer_blocks:
-            x = block(x, speed_mp=speed_mp, context=context, fucking_hell=True)
+            x = block(x, speed_mp=speed_mp, context=context, fucking_hell=True, token_merge=token_merge)
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
         return x + x_in
@@ -7,7 +7,7 @@ import torch
 import torch.nn as nn
 from einops import rearrange
 
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, attention
 from ldm.util import instantiate_from_config
 
 
@@ -183,25 +183,11 @@ class LinAttnBlock(LinearAttention):
         super().__init__(dim=in_channels, heads=1, dim_head=in_channels)
 
 
-@torch.jit.script
-def fused_t(x, c):
-    return x * (int(c) ** (-0.5))
-
-
-def fused_memory_opt(mem_free_total, b, h, w, c):
-    # s1 = (b * h * w * 2 * h * w) * 2  # 2 bmms
-    # s2 = (b * ((h * w) ** 2) * 2) * 2  # 2 softmaxes
-    # s3 = (b * c * h * w * 3) * 2  # zeros_like, empty_like, empty_strided
-    # s = 2 * (s1 + s2 + s3)  # 2 because of small allocations which don't really matter
-    s = 16 * b * ((h * w) ** 2) + 12 * b * c * h * w
-    s = (s // mem_free_total) + 1 if s > mem_free_total else torch.tensor(1)
-    return s
-
-
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, attn_backend="auto"):
         super().__init__()
         self.in_channels = in_channels
+        self.attn_backend = attn_backend
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -240,45 +226,22 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b, c, h, w = q.shape
-        q = q.reshape(b, c, h * w).permute(0, 2, 1)
-        # q = q.permute(0, 2, 1)  # b,hw,c
-        k = k.reshape(b, c, h * w)  # b,c,hw
-        h_ = torch.zeros_like(k, device=secondary_device, dtype=sec_precision)
-        v = v.reshape(b, c, h * w)
-
-        stats = torch.cuda.memory_stats(dev)
-        mem_active = stats['active_bytes.all.current']
-        mem_reserved = stats['reserved_bytes.all.current']
-        mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-        mem_free_torch = mem_reserved - mem_active
-        mem_free_total = (mem_free_cuda + mem_free_torch)
-        mem_free_total = math.ceil(mem_free_total / 10 ** int(math.log10(mem_free_total) - 1)) * (
-                10 ** int(math.log10(mem_free_total) - 1))
-
-        mp = q.shape[1] // fused_memory_opt(mem_free_total, b, h, w, c)
-
-        for i in range(0, q.shape[1], mp):
-            w1 = torch.bmm(q[:, i:i + mp], k)  # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-            w1 = fused_t(w1, torch.tensor(c))
-            w1 = torch.nn.functional.softmax(w1, dim=2, dtype=precision)
-            # attend to values
-            w1 = w1.permute(0, 2, 1)  # b,hw,hw (first hw of k, second of q)
-
-            h_[:, :, i:i + mp] = torch.bmm(v, w1).to(
-                secondary_device).to(sec_precision)  # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-
-        h_ = h_.reshape(b, c, h, w)
+        q, k, v = map(lambda t: t.reshape(b, c, h * w).permute(0, 2, 1), (q, k, v))  # b,hw,c
+        # q and k stay on the device, only the result is collected on the secondary device
+        h_ = attention(q, k, v, c ** (-0.5), backend=self.attn_backend, result_device=secondary_device)
+        del q, k, v
+        h_ = h_.permute(0, 2, 1).to(secondary_device).to(sec_precision).reshape(b, c, h, w)
 
         h_ = self.proj_out.to(secondary_device).to(sec_precision)(h_).to(precision).to(dev)
 
         return x.to(dev) + h_
 
 
-def make_attn(in_channels, attn_type="vanilla"):
+def make_attn(in_channels, attn_type="vanilla", attn_backend="auto"):
     assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
-        return AttnBlock(in_channels)
+        return AttnBlock(in_channels, attn_backend)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
@@ -288,7 +251,8 @@ def make_attn(in_channels, attn_type="vanilla"):
 class Model(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1, 2, 4, 8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla"):
+                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla",
+                 attn_backend="auto"):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -331,7 +295,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -346,7 +310,7 @@ class Model(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -368,7 +332,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -441,7 +405,7 @@ class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1, 2, 4, 8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, double_z=True, use_linear_attn=False, attn_type="vanilla",
-                 **ignore_kwargs):
+                 attn_backend="auto", **ignore_kwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -474,7 +438,7 @@ class Encoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -489,7 +453,7 @@ class Encoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -535,7 +499,7 @@ class Decoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1, 2, 4, 8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, give_pre_end=False, tanh_out=False, use_linear_attn=False,
-                 attn_type="vanilla", **ignorekwargs):
+                 attn_type="vanilla", attn_backend="auto", **ignorekwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -568,7 +532,7 @@ class Decoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -587,7 +551,7 @@ class Decoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attn_backend=attn_backend))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 from einops import rearrange, repeat
 from functools import partial
-from transformers import CLIPTokenizer, CLIPTextModel
+from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextConfig
 
 from ldm.modules.x_transformer import Encoder, \
     TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
@@ -140,10 +140,14 @@ class SpatialRescaler(nn.Module):
 class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
 
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77, pretrained=True):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
-        self.transformer = CLIPTextModel.from_pretrained(version)
+        if pretrained:
+            self.transformer = CLIPTextModel.from_pretrained(version)
+        else:
+            # only build the architecture, the weights come from the SD checkpoint anyway
+            self.transformer = CLIPTextModel(CLIPTextConfig.from_pretrained(version))
         self.device = device
         self.max_length = max_length
         self.freeze()
@@ -153,15 +157,20 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
-    def forward(self, text):
+    def tokenize(self, text):
         batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
                                         return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-        tokens = batch_encoding["input_ids"].to(self.device)
-        outputs = self.transformer(input_ids=tokens)
+        return batch_encoding["input_ids"]
+
+    def encode_tokens(self, tokens):
+        outputs = self.transformer(input_ids=tokens.to(self.device))
 
         z = outputs.last_hidden_state
         return z
 
+    def forward(self, text):
+        return self.encode_tokens(self.tokenize(text))
+
     def encode(self, text):
         return self(text)
 
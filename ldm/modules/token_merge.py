@@ -0,0 +1,98 @@
+"""
+Token merging for the self-attention of SpatialTransformer (ToMe, Bolya & Hoffman 2023, "Token Merging for Fast
+Stable Diffusion").
+
+Before attn1 the most similar tokens are averaged together with bipartite soft matching, attention runs on the
+shorter sequence and its output is copied back to every merged token. The destination tokens are the top left
+token of every sy x sx cell of the latent grid, every other token is a source that gets merged into its most
+similar destination, the `ratio` of all tokens with the highest similarity are merged.
+"""
+import torch
+
+
+def _identity(x):
+    return x
+
+
+class TokenMerge:
+    """
+    Settings shared by the SpatialTransformers of a unet, see UNet.set_token_merge().
+    Only transformers at a downsampling factor of at most `max_downsample` (1 = the full latent resolution) merge.
+    With `paired` set the batch is [uncond, cond] of the same latent and the matching is computed on the cond half
+    only and used for both.
+    """
+
+    def __init__(self, ratio=0.5, max_downsample=1, merge_ff=False, sx=2, sy=2):
+        if not 0. <= ratio < 1.:
+            raise ValueError(f"the token merge ratio must be in [0, 1), got {ratio}")
+        self.ratio = ratio
+        self.max_downsample = max_downsample
+        self.merge_ff = merge_ff
+        self.sx, self.sy = sx, sy
+        self.paired = False
+
+    def applies(self, downsample):
+        return self.ratio > 0 and downsample is not None and downsample <= self.max_downsample
+
+    def matching(self, metric, h, w):
+        """merge() and unmerge() functions for the [B, h * w, C] tokens that `metric` belongs to"""
+        if self.paired and metric.shape[0] % 2 == 0:
+            half = metric.shape[0] // 2
+            return bipartite_soft_matching(metric[half:], h, w, self.ratio, self.sx, self.sy, repeat=2)
+        return bipartite_soft_matching(metric, h, w, self.ratio, self.sx, self.sy)
+
+
+def bipartite_soft_matching(metric, h, w, ratio, sx=2, sy=2, repeat=1):
+    """
+    Matches the source tokens of `metric` [B, h * w, C] to their most similar destination token and returns
+    merge() and unmerge() for tensors of the same token layout. With repeat=n the matching is used for a batch of
+    n copies of the metric's batch.
+    """
+    b, n, _ = metric.shape
+    r = int(n * ratio)
+    if r <= 0:
+        return _identity, _identity
+
+    with torch.no_grad():
+        grid = torch.arange(n, device=metric.device).reshape(h, w)
+        is_dst = torch.zeros(h, w, dtype=torch.bool, device=metric.device)
+        is_dst[::sy, ::sx] = True
+        dst_pos, src_pos = grid[is_dst], grid[~is_dst]
+        r = min(r, src_pos.shape[0])
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_pos] @ metric[:, dst_pos].transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        del scores
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:]  # sources that stay
+        merged_idx = edge_idx[:, :r]  # sources that get merged
+        dst_idx = node_idx[..., None].gather(dim=1, index=merged_idx)
+        if repeat > 1:
+            unm_idx, merged_idx, dst_idx = (idx.repeat(repeat, 1, 1) for idx in (unm_idx, merged_idx, dst_idx))
+        # positions in the full sequence, for unmerge()
+        unm_pos, merged_pos = src_pos[unm_idx], src_pos[merged_idx]
+        # every destination averages itself with the sources merged into it (scatter_reduce needs torch 1.12)
+        counts = metric.new_ones((dst_idx.shape[0], dst_pos.shape[0], 1))
+        counts.scatter_add_(1, dst_idx, torch.ones_like(dst_idx, dtype=counts.dtype))
+
+    def merge(x):
+        bx, _, c = x.shape
+        src, dst = x[:, src_pos], x[:, dst_pos]
+        unm = src.gather(dim=1, index=unm_idx.expand(bx, -1, c))
+        src = src.gather(dim=1, index=merged_idx.expand(bx, -1, c))
+        dst.scatter_add_(1, dst_idx.expand(bx, -1, c), src)
+        dst = dst / counts.to(dst.dtype)
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        bx, _, c = x.shape
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[:, :unm_len], x[:, unm_len:]
+        out = x.new_empty((bx, n, c))
+        out[:, dst_pos] = dst
+        out.scatter_(1, unm_pos.expand(bx, -1, c), unm)
+        out.scatter_(1, merged_pos.expand(bx, -1, c), dst.gather(dim=1, index=dst_idx.expand(bx, -1, c)))
+        return out
+
+    return merge, unmerge
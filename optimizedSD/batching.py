@@ -0,0 +1,127 @@
+"""
+Dynamic batching of generation jobs.
+
+Concurrent clients mostly send small jobs, while at 512x512 the unet has batch headroom to spare. The scheduler
+collects the jobs that arrive within `max_wait` seconds of the first one, groups the ones that can share a sampler
+run (same size, steps, sampler, eta and every other sampling option) into batches of up to `max_batch` samples and
+hands each batch to GenerationService.run_batch(), which keeps the prompt, negative prompt, guidance scale and seeds
+per sample and splits the images back out per job. The noise of a sample only depends on its seed (seeded_noise.py),
+so a job gets the same images as when it runs alone, up to the rounding of the batched kernels.
+
+Jobs that can't share a run go alone: img2img and inpainting, prompt files, n_iter > 1, early stopping (a batch
+stops when its slowest sample converges) and fixed_code (unseeded start code).
+"""
+import asyncio
+import json
+import time
+from collections import deque
+
+from sd_daemon import DEFAULT_JOB
+
+# fields that may differ between the jobs of a batch, everything else has to match
+PER_JOB = ("prompt", "negative_prompt", "scale", "seed", "n_samples", "outdir", "format", "unet_bs",
+           "img2img_strength", "mask_crop", "mask_crop_margin", "return_bytes")
+
+
+def batch_key(job):
+    """what a job has to share with others to run in the same batch, None if it has to run alone"""
+    job = {**DEFAULT_JOB, **job}
+    if (job["init_image"] is not None or job["from_file"] or job["n_iter"] != 1 or job["stop_threshold"] > 0
+            or job["fixed_code"]):
+        return None
+    return json.dumps({k: v for k, v in job.items() if k not in PER_JOB}, sort_keys=True)
+
+
+def _percentiles(values):
+    if not values:
+        return dict(mean=0., p50=0., p95=0.)
+    ordered = sorted(values)
+    return dict(mean=sum(ordered) / len(ordered), p50=ordered[len(ordered) // 2],
+                p95=ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))])
+
+
+class BatchMetrics:
+    """throughput and latency of the scheduled batches, the latencies over the last `window` jobs"""
+
+    def __init__(self, window=200):
+        self.since = time.time()
+        self.batches = 0
+        self.jobs = 0
+        self.samples = 0
+        self.busy = 0.  # seconds spent running batches
+        self.latency = deque(maxlen=window)  # submit -> done
+        self.queue_wait = deque(maxlen=window)  # submit -> start
+        self.batch_jobs = deque(maxlen=window)
+
+    def record(self, submitted, started, finished, samples):
+        """one batch: the submit times of its jobs, when it started and finished and its number of samples"""
+        self.batches += 1
+        self.jobs += len(submitted)
+        self.samples += samples
+        self.busy += finished - started
+        self.batch_jobs.append(len(submitted))
+        for t in submitted:
+            self.latency.append(finished - t)
+            self.queue_wait.append(started - t)
+
+    def stats(self):
+        elapsed = max(time.time() - self.since, 1e-9)
+        return dict(batches=self.batches, jobs=self.jobs, samples=self.samples,
+                    jobs_per_batch=self.jobs / self.batches if self.batches else 0.,
+                    samples_per_second=self.samples / elapsed,
+                    samples_per_busy_second=self.samples / self.busy if self.busy else 0.,
+                    utilization=self.busy / elapsed,
+                    latency=_percentiles(self.latency), queue_wait=_percentiles(self.queue_wait))
+
+
+class BatchScheduler:
+    """
+    batches = await scheduler.collect(queue)
+
+    The queue holds jobs with a `params` dict (the job fields, None once cancelled).
+    """
+
+    def __init__(self, max_batch=4, max_wait=0.05):
+        if max_batch < 1:
+            raise ValueError(f"the batch size must be at least 1, got {max_batch}")
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = BatchMetrics()
+
+    @staticmethod
+    def samples(job):
+        """the job's n_samples, 0 if it isn't a positive integer (the job then fails when it runs)"""
+        n = job.params.get("n_samples", DEFAULT_JOB["n_samples"])
+        return n if isinstance(n, int) and not isinstance(n, bool) and n > 0 else 0
+
+    async def collect(self, queue):
+        """waits for a job, then for up to max_wait for more, and returns the batches to run in arrival order"""
+        jobs = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while self.max_batch > 1:
+            timeout = deadline - loop.time()
+            if timeout <= 0 or sum(self.samples(job) for job in jobs if job.params is not None) >= self.max_batch:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return self.group([job for job in jobs if job.params is not None])
+
+    def group(self, jobs):
+        batches, open_batches = [], {}
+        for job in jobs:
+            try:
+                key = batch_key(job.params) if self.max_batch > 1 and self.samples(job) else None
+            except (TypeError, ValueError):
+                key = None  # fields of the wrong type, the job runs alone and fails on its own
+            batch = open_batches.get(key)
+            if key is None or batch is None or sum(map(self.samples, batch)) + self.samples(job) > self.max_batch:
+                batch = [job]
+                batches.append(batch)
+                if key is not None:
+                    open_batches[key] = batch
+            else:
+                batch.append(job)
+        return batches
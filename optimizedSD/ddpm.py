@@ -6,12 +6,14 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 import asyncio
+import hashlib
+import inspect
 import logging
 import math
 import time
+from collections import OrderedDict
 from functools import partial
 
-import k_diffusion as K
 import numpy as np
 import pytorch_lightning as pl
 import torch
@@ -20,20 +22,52 @@ from pytorch_lightning.utilities.distributed import rank_zero_only
 from tqdm import trange, tqdm
 
 from ldm.models.autoencoder import VQModelInterface
-from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor
+from ldm.modules.attention import CrossAttention, SpatialTransformer, chunk_planner
+from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, timestep_embedding
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+from ldm.modules.token_merge import TokenMerge
 from ldm.util import exists, default, instantiate_from_config
+from optimizedSD.deep_cache import DeepCache
+from optimizedSD.guidance import GuidancePolicy
+from optimizedSD.optimUtils import split_weighted_subprompts
+from optimizedSD.seeded_noise import SeededNoise
 
 
 # from samplers import CompVisDenoiser
 
+# native sampler names -> karras_sampling() sampler
+KARRAS_SAMPLERS = {
+    "k_euler": "euler",
+    "k_euler_a": "euler_a",
+    "k_heun": "heun",
+    "k_dpm_2": "dpm_2",
+    "k_dpm_2_a": "dpm_2_a",
+    "k_lms": "lms",
+}
+
 def disabled_train(self):
     """Overwrite model.train with this function to make sure train/eval mode
     does not change anymore."""
     return self
 
 
+def sample_seeds(seed, batch_size):
+    """seed + i for sample i, or a list with one seed per sample as it is"""
+    if isinstance(seed, (list, tuple)):
+        if len(seed) != batch_size:
+            raise ValueError(f"{len(seed)} seeds for a batch of {batch_size}")
+        return [int(s) for s in seed]
+    return [seed + s for s in range(batch_size)]
+
+
+def per_sample(scale, x):
+    """a guidance scale as is, or a list with one scale per sample as a tensor that broadcasts over the samples of x"""
+    if not isinstance(scale, (list, tuple)):
+        return scale
+    return torch.tensor(scale, dtype=x.dtype, device=x.device).reshape((-1,) + (1,) * (x.dim() - 1))
+
+
 class DDPM(pl.LightningModule):
     # classic DDPM with Gaussian diffusion, in image space
     def __init__(self,
@@ -158,6 +192,57 @@ class FirstStage(DDPM):
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
             self.restarted_from_ckpt = True
+        self.set_tiling(False)
+
+    def set_tiling(self, enabled=True, tile_size=64, overlap=16):
+        """Tiled first stage: encode/decode in tiles of `tile_size` latent pixels overlapping by `overlap`,
+        so that the peak memory is bounded by the tile size instead of the image size."""
+        assert 0 <= overlap < tile_size
+        self.tiled = enabled
+        self.tile_size = tile_size
+        self.tile_overlap = overlap
+
+    @staticmethod
+    def tile_starts(size, tile, overlap):
+        if size <= tile:
+            return [0]
+        starts = list(range(0, size - tile, tile - overlap))
+        starts.append(size - tile)
+        return starts
+
+    @staticmethod
+    def feather(size, ramp, first, last, device):
+        # linear ramp over the overlap, except on the image borders where there is no neighbour to blend with
+        w = torch.ones(size, device=device)
+        ramp = min(ramp, size)
+        if ramp > 0:
+            r = (torch.arange(ramp, device=device) + 0.5) / ramp
+            if not first:
+                w[:ramp] = r
+            if not last:
+                w[-ramp:] = torch.minimum(w[-ramp:], r.flip(0))
+        return w
+
+    def tiled_apply(self, fn, x, tile, overlap, scale):
+        """Runs fn on overlapping tiles of x (tile and overlap in pixels of x, fn changes the resolution by
+        `scale`) and blends the outputs with a feathered weight mask."""
+        b, _, h, w = x.shape
+        out = weights = None
+        for y in self.tile_starts(h, tile, overlap):
+            for x0 in self.tile_starts(w, tile, overlap):
+                t = fn(x[:, :, y:y + tile, x0:x0 + tile])
+                th, tw = t.shape[-2:]
+                if out is None:
+                    out = torch.zeros((b, t.shape[1], int(h * scale), int(w * scale)), device=t.device)
+                    weights = torch.zeros((1, 1) + out.shape[2:], device=t.device)
+                ramp = int(overlap * scale)
+                mask = (self.feather(th, ramp, y == 0, y + tile >= h, t.device)[:, None] *
+                        self.feather(tw, ramp, x0 == 0, x0 + tile >= w, t.device)[None, :])
+                oy, ox = int(y * scale), int(x0 * scale)
+                out[:, :, oy:oy + th, ox:ox + tw] += t.float() * mask
+                weights[:, :, oy:oy + th, ox:ox + tw] += mask
+                del t
+        return (out / weights).to(x.dtype)
 
     def instantiate_first_stage(self, config):
         model = instantiate_from_config(config)
@@ -194,9 +279,47 @@ class FirstStage(DDPM):
         else:
             if isinstance(self.first_stage_model, VQModelInterface):
                 return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
+            elif self.tiled and max(z.shape[-2:]) > self.tile_size:
+                f = 2 ** self.num_downs
+                return self.tiled_apply(self.first_stage_model.decode, z, self.tile_size, self.tile_overlap, f)
             else:
                 return self.first_stage_model.decode(z)
 
+    # rough number of full resolution, 128 channel activations the decoder keeps alive per image
+    decode_activations = 6
+
+    def decode_chunk_size(self, z):
+        """How many latents fit into one decoder call, from the free memory, the output resolution and the dtype."""
+        b, _, h, w = z.shape
+        if z.device.type != "cuda":
+            return b
+        stats = torch.cuda.memory_stats(z.device)
+        mem_free_cuda, _ = torch.cuda.mem_get_info(z.device)
+        mem_free_total = mem_free_cuda + stats['reserved_bytes.all.current'] - stats['active_bytes.all.current']
+        if self.tiled:
+            h, w = min(h, self.tile_size), min(w, self.tile_size)
+        f = 2 ** self.num_downs
+        per_sample = self.decode_activations * 128 * (h * f) * (w * f) * z.element_size()
+        return max(1, min(b, int(mem_free_total * 0.8) // per_sample))
+
+    @torch.no_grad()
+    def decode_samples(self, z, chunk_size=None, to_uint8=True):
+        """Decodes a batch of latents, as many per decoder call as the memory allows, and post-processes the
+        whole batch on the device before a single copy to the cpu.
+        Returns uint8 [b, h, w, c] images, or float [b, c, h, w] in [0, 1] with to_uint8=False."""
+        chunk_size = chunk_size or self.decode_chunk_size(z)
+        x = None
+        for i in range(0, z.shape[0], chunk_size):
+            x_chunk = self.decode_first_stage(z[i:i + chunk_size])
+            if x is None:
+                x = torch.empty((z.shape[0],) + x_chunk.shape[1:], dtype=x_chunk.dtype, device=x_chunk.device)
+            x[i:i + x_chunk.shape[0]] = x_chunk
+            del x_chunk
+        x = ((x + 1.0) / 2.0).clamp_(min=0.0, max=1.0)
+        if to_uint8:
+            x = (255.0 * x).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+        return x.cpu()
+
     @torch.no_grad()
     def encode_first_stage(self, x):
         if hasattr(self, "split_input_params"):
@@ -235,9 +358,114 @@ class FirstStage(DDPM):
             else:
                 return self.first_stage_model.encode(x)
         else:
+            f = 2 ** self.num_downs
+            if self.tiled and max(x.shape[-2:]) > self.tile_size * f and \
+                    not isinstance(self.first_stage_model, VQModelInterface):
+                # blend the posterior parameters (mean and logvar) of the tiles
+                parameters = self.tiled_apply(lambda t: self.first_stage_model.encode(t).parameters, x,
+                                              self.tile_size * f, self.tile_overlap * f, 1 / f)
+                return DiagonalGaussianDistribution(parameters)
             return self.first_stage_model.encode(x)
 
 
+class SamplingPlan:
+    """
+    What a ddim/plms run needs at every step, computed once: the update coefficients as [steps, 1, 1, 1] tables
+    on the device, the timestep batches and the time embeddings of all the steps.
+    Built from the current ddim schedule by UNet.sampling_plan(), which caches it; treat it as read-only.
+    """
+
+    def __init__(self, model, batch_size, device):
+        table = lambda v: torch.as_tensor(v, dtype=torch.float32).to(device).reshape(-1, 1, 1, 1)
+        alphas = table(model.ddim_alphas)
+        alphas_prev = table(model.ddim_alphas_prev)
+        self.sigmas = table(model.ddim_sigmas)
+        self.sqrt_alphas = alphas.sqrt()
+        self.sqrt_alphas_prev = alphas_prev.sqrt()
+        self.sqrt_one_minus_alphas = table(model.ddim_sqrt_one_minus_alphas)
+        self.dir_coefs = (1. - alphas_prev - self.sigmas ** 2).sqrt()
+        # eta == 0 gives a deterministic schedule, the steps then skip drawing noise altogether
+        self.has_noise = bool((self.sigmas != 0).any())
+
+        self.timesteps = model.ddim_timesteps
+        self.batch_size = batch_size
+        ts = torch.as_tensor(self.timesteps.copy(), dtype=torch.long, device=device)
+        # expanded views, ts[index] is the timestep batch of a step, ts_cfg[index] the one of [uncond, cond]
+        self.ts = ts[:, None].expand(-1, batch_size)
+        self.ts_cfg = ts[:, None].expand(-1, 2 * batch_size)
+        self.embeddings = model.time_embeddings(ts)
+
+    def coefficients(self, index):
+        """sqrt(a_t), sqrt(a_prev), sigma_t, sqrt(1 - a_t) and the direction coefficient of a step"""
+        return (self.sqrt_alphas[index], self.sqrt_alphas_prev[index], self.sigmas[index],
+                self.sqrt_one_minus_alphas[index], self.dir_coefs[index])
+
+    def emb(self, index, n):
+        return self.embeddings[index:index + 1].expand(n, -1)
+
+
+class SigmaPlan:
+    """
+    SamplingPlan of the samplers that work in sigma space (x = x_0 + sigma * eps): the model evaluations of a run
+    at their sigmas, with input scalings, timesteps and time embeddings computed once.
+    Index i refers to the i-th evaluation sigma.
+    """
+    has_noise = False
+
+    def __init__(self, model, sigmas, batch_size, device):
+        self.sigmas = [float(sigma) for sigma in sigmas]
+        self.c_ins = [(sigma ** 2 + 1) ** -0.5 for sigma in self.sigmas]
+        self.batch_size = batch_size
+        ts = torch.as_tensor(model.sigma_to_t(np.array(self.sigmas)), dtype=torch.float32, device=device)
+        self.ts = ts[:, None].expand(-1, batch_size)
+        self.ts_cfg = ts[:, None].expand(-1, 2 * batch_size)
+        self.embeddings = model.time_embeddings(ts)
+
+    def emb(self, index, n):
+        return self.embeddings[index:index + 1].expand(n, -1)
+
+
+class ConditioningCache:
+    """LRU cache of text embeddings, bounded by entry count and by bytes. Entries are kept on the cpu."""
+
+    def __init__(self, max_entries=64, max_bytes=256 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        z = self.entries.get(key)
+        if z is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return z
+
+    def put(self, key, z):
+        z = z.detach().to("cpu", copy=True)
+        size = z.numel() * z.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).numel() * z.element_size()
+        self.entries[key] = z
+        self.nbytes += size
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.numel() * old.element_size()
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), bytes=self.nbytes)
+
+
 class CondStage(DDPM):
     """main class"""
 
@@ -278,6 +506,15 @@ class CondStage(DDPM):
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
             self.restarted_from_ckpt = True
+        self.cond_cache = ConditioningCache()
+        self._cond_hash = None
+
+    def load_state_dict(self, *args, **kwargs):
+        # new weights, the cached embeddings are stale
+        self._cond_hash = None
+        if getattr(self, "cond_cache", None) is not None:
+            self.cond_cache.clear()
+        return super().load_state_dict(*args, **kwargs)
 
     def instantiate_cond_stage(self, config):
         if not self.cond_stage_trainable:
@@ -300,7 +537,68 @@ class CondStage(DDPM):
             model = instantiate_from_config(config)
             self.cond_stage_model = model
 
+    def cond_stage_hash(self):
+        if self._cond_hash is None:
+            h = hashlib.sha1()
+            for name, p in sorted(self.cond_stage_model.state_dict().items()):
+                h.update(name.encode("utf-8"))
+                h.update(p.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            self._cond_hash = h.hexdigest()
+        return self._cond_hash
+
+    def encode_texts(self, texts):
+        """Encodes a list of prompts, running the text encoder once per unique (and uncached) prompt."""
+        unique = list(dict.fromkeys(texts))
+        tokens = self.cond_stage_model.tokenize(unique)
+        zs = [None] * len(unique)
+        if self.cond_cache is not None:
+            dtype = next(self.cond_stage_model.parameters()).dtype
+            prefix = (self.cond_stage_hash(), dtype, torch.is_autocast_enabled())
+            keys = [prefix + (tuple(t.tolist()),) for t in tokens]
+            zs = [self.cond_cache.get(key) for key in keys]
+        missing = [i for i, z in enumerate(zs) if z is None]
+        if missing:
+            z = self.cond_stage_model.encode_tokens(tokens[missing])
+            for j, i in enumerate(missing):
+                if self.cond_cache is not None:
+                    self.cond_cache.put(keys[i], z[j])
+                zs[i] = z[j]
+        device = self.cond_stage_model.device
+        z = torch.stack([z.to(device, non_blocking=True) for z in zs])
+        if len(unique) == 1:
+            return z.expand(len(texts), *z.shape[1:])
+        position = {text: i for i, text in enumerate(unique)}
+        return z.index_select(0, torch.tensor([position[text] for text in texts], device=z.device))
+
+    def get_weighted_conditioning(self, prompts):
+        """Conditioning for a batch of prompts where every prompt may be weighted ("a cat:0.25 a duck:0.75").
+        All sub-prompts of the batch go through a single text encoder call and are mixed with one contraction."""
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        parsed = []
+        for prompt in prompts:
+            subprompts, weights = split_weighted_subprompts(prompt)
+            if len(subprompts) > 1:
+                total = sum(weights)
+                parsed.append((subprompts, [weight / total for weight in weights]))
+            else:
+                parsed.append(([prompt], [1.0]))
+        if all(len(subprompts) == 1 for subprompts, _ in parsed):
+            return self.get_learned_conditioning(list(prompts))
+
+        texts = list(dict.fromkeys(text for subprompts, _ in parsed for text in subprompts))
+        position = {text: i for i, text in enumerate(texts)}
+        w = torch.zeros(len(prompts), len(texts))
+        for b, (subprompts, weights) in enumerate(parsed):
+            for text, weight in zip(subprompts, weights):
+                w[b, position[text]] += weight
+        z = self.get_learned_conditioning(texts)
+        return torch.einsum("bu,u...->b...", w.to(z.device, z.dtype), z)
+
     def get_learned_conditioning(self, c):
+        if hasattr(self.cond_stage_model, "tokenize") and (
+                isinstance(c, str) or (isinstance(c, (list, tuple)) and c and all(isinstance(s, str) for s in c))):
+            return self.encode_texts([c] if isinstance(c, str) else list(c))
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -319,8 +617,8 @@ class DiffusionWrapper(pl.LightningModule):
         super().__init__()
         self.diffusion_model = instantiate_from_config(diff_model_config)
 
-    def forward(self, x, t, cc, speed_mp):
-        out = self.diffusion_model(x, t, context=cc, speed_mp=speed_mp)
+    def forward(self, x, t, cc, speed_mp, emb=None, depth=None):
+        out = self.diffusion_model(x, t, context=cc, speed_mp=speed_mp, emb=emb, depth=depth)
         return out
 
 
@@ -329,27 +627,47 @@ class DiffusionWrapperOut(pl.LightningModule):
         super().__init__()
         self.diffusion_model = instantiate_from_config(diff_model_config)
 
-    def forward(self, h, emb, tp, hs, cc, speed_mp):
-        return self.diffusion_model(h, emb, tp, hs, context=cc, speed_mp=speed_mp)
+    def forward(self, h, emb, tp, hs, cc, speed_mp, keep=None):
+        return self.diffusion_model(h, emb, tp, hs, context=cc, speed_mp=speed_mp, keep=keep)
 
 
 class CFGDenoiser(torch.nn.Module):
     def __init__(self, model):
         super().__init__()
         self.inner_model = model
+        self.cond_in = None
+        self.x_in = None
+        self.sigma_in = None
+
+    @staticmethod
+    def doubled(buf, x):
+        # [x, x] in a buffer that is reused as long as the shape stays the same
+        b = x.shape[0]
+        if buf is None or buf.shape != (2 * b,) + x.shape[1:] or buf.dtype != x.dtype or buf.device != x.device:
+            buf = torch.empty((2 * b,) + x.shape[1:], dtype=x.dtype, device=x.device)
+        buf[:b].copy_(x)
+        buf[b:].copy_(x)
+        return buf
 
     def forward(self, x, sigma, uncond, cond, cond_scale):
-        x_in = torch.cat([x] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        return uncond + (cond - uncond) * cond_scale
+        self.x_in = self.doubled(self.x_in, x)
+        self.sigma_in = self.doubled(self.sigma_in, sigma)
+        # the same conditioning comes in at every step, keep one tensor so the cached context projections match
+        if self.cond_in is None or self.cond_in[0] is not uncond or self.cond_in[1] is not cond:
+            self.cond_in = (uncond, cond, torch.cat([uncond, cond]))
+        cond_in = self.cond_in[2]
+        uncond, cond = self.inner_model(self.x_in, self.sigma_in, cond=cond_in).chunk(2)
+        return uncond.lerp_(cond, per_sample(cond_scale, cond))
 
 
 class KDiffusionSampler:
+    """the samplers of the k_diffusion package that have no native version in UNet, k_diffusion is optional"""
+
     def __init__(self, m, sampler):
+        import k_diffusion
+        self.K = k_diffusion
         self.model = m
-        self.model_wrap = K.external.CompVisDenoiser(m)
+        self.model_wrap = self.K.external.CompVisDenoiser(m)
         self.schedule = sampler
 
     def get_sampler_name(self):
@@ -361,18 +679,25 @@ class KDiffusionSampler:
     def sample2(self, x, conditioning, unconditional_conditioning, steps, unconditional_guidance_scale, mask=None):
         sigmas = self.model_wrap.get_sigmas(steps)
         model_wrap_cfg = CFGDenoiser(self.model_wrap)
-        noise = torch.randn_like(x) * sigmas[steps - 1]
+        noise = self.model.randn_like(x) * sigmas[steps - 1]
 
         xi = x + noise
 
         sigma_sched = sigmas[steps - 1:]
         model_wrap_cfg.init_latent = x
 
-        return K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, xi, sigma_sched,
+        return self.K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, xi, sigma_sched,
                                                               extra_args={'cond': conditioning,
                                                                           'uncond': unconditional_conditioning,
                                                                           'cond_scale': unconditional_guidance_scale},
-                                                              disable=False)
+                                                              disable=False, **self.noise_kwargs(xi))
+
+    def noise_kwargs(self, x):
+        # the ancestral samplers of newer k_diffusion versions take the source of their per-step noise
+        sample_fn = self.K.sampling.__dict__[f'sample_{self.schedule}']
+        if self.model.noise is None or "noise_sampler" not in inspect.signature(sample_fn).parameters:
+            return {}
+        return dict(noise_sampler=lambda sigma, sigma_next: self.model.randn_like(x))
 
     def sample(self, x_latent, cond, S, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
                mask=None, init_latent=None, callback_fn=None):
@@ -380,7 +705,7 @@ class KDiffusionSampler:
         model_wrap_cfg = CFGDenoiser(self.model_wrap)
         # x_dec = init_latent if init_latent is not None else x_latent
         # x_dec = init_latent
-        x0 = torch.randn_like(init_latent) if init_latent is not None else torch.randn_like(x_latent)
+        x0 = self.model.randn_like(init_latent) if init_latent is not None else self.model.randn_like(x_latent)
         # if mask is not None:
         #     x0_noisy = x0
         #     x_dec = x0_noisy * mask + (1. - mask) * x_dec
@@ -389,13 +714,13 @@ class KDiffusionSampler:
         else:
             x_dec = x0 * sigmas[0]
         # x_dec = x_dec * sigmas[0]
-        samples_ddim = K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, x_dec, sigmas,
+        samples_ddim = self.K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, x_dec, sigmas,
                                                                       callback=callback_fn,
                                                                       extra_args={'cond': cond,
                                                                                   'uncond': unconditional_conditioning,
                                                                                   'cond_scale': unconditional_guidance_scale
                                                                                   },
-                                                                      disable=False)
+                                                                      disable=False, **self.noise_kwargs(x_dec))
         # if mask is not None:
         #     return x0 * mask + (1. - mask) * x_dec
 
@@ -447,6 +772,21 @@ class UNet(DDPM):
         self.model2.eval()
         self.turbo = False
         self.unet_bs = unet_bs
+        self.cache_context_kv = False
+        self.token_merge = None  # TokenMerge settings of the spatial transformers, see set_token_merge()
+        self.cfg_input = None
+        self.guidance = None  # GuidancePolicy of the running sample() call
+        self.deep_cache = None  # DeepCache of the running sample() call, if any
+        self.tiling = None  # (window, overlap, windows per batch) in latent pixels while sampling tiled
+        self.tile_weight_cache = None
+        self.tile_conds = {}
+        self.progress = None  # called with (step, total steps) at every sampler step of the running sample() call
+        self.steps_run = None
+        self.last_run_stats = None
+        self.legacy_noise = False
+        self.noise = None  # SeededNoise of the running sample() call
+        self.schedule_key = None
+        self.sampling_plans = OrderedDict()
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
@@ -474,45 +814,211 @@ class UNet(DDPM):
             print(f"setting self.scale_factor to {self.scale_factor}")
             print("### USING STD-RESCALING ###")
 
-    def apply_model(self, x_noisy, t, cond, speed_mp=None, return_ids=False):
-
-        if not self.turbo:
-            self.model1.to(self.cdevice)
-
+    def apply_model(self, x_noisy, t, cond, speed_mp=None, return_ids=False, emb=None, paired=False):
+        """paired: the batch is [uncond, cond] of the same latent, token merging can match on one half for both"""
+        if self.tiling is not None and max(x_noisy.shape[2:]) > self.tiling[0]:
+            return self.apply_model_tiled(x_noisy, t, cond, speed_mp=speed_mp, emb=emb)
+        return self.apply_model_batch(x_noisy, t, cond, speed_mp=speed_mp, return_ids=return_ids, emb=emb,
+                                      paired=paired)
+
+    def tile_windows(self, h, w):
+        """window size and top left corners of the overlapping windows that cover an h x w latent"""
+        tile, overlap = self.tiling[:2]
+
+        def starts(size):
+            if size <= tile:
+                return [0]
+            return list(range(0, size - tile, tile - overlap)) + [size - tile]
+
+        return min(tile, h), min(tile, w), [(y, x) for y in starts(h) for x in starts(w)]
+
+    def tile_weights(self, h, w, like):
+        """
+        Blending weights of a window, ramping down over the overlap so the seams don't show,
+        and their sum over all windows at every latent pixel. Built once per canvas size.
+        """
+        key = (h, w, self.tiling, like.dtype, like.device)
+        if self.tile_weight_cache is not None and self.tile_weight_cache[0] == key:
+            return self.tile_weight_cache[1:]
+        th, tw, windows = self.tile_windows(h, w)
+        overlap = self.tiling[1]
+
+        def ramp(size):
+            r = torch.ones(size, dtype=torch.float32)
+            for i in range(min(overlap, size // 2)):
+                r[i] = r[size - 1 - i] = (i + 1) / (overlap + 1)
+            return r
+
+        weights = (ramp(th)[:, None] * ramp(tw)[None, :])[None, None]
+        norm = torch.zeros((1, 1, h, w))
+        for y, x in windows:
+            norm[:, :, y:y + th, x:x + tw] += weights
+        weights, norm = weights.to(like.device, like.dtype), norm.to(like.device, like.dtype)
+        self.tile_weight_cache = (key, weights, norm)
+        return weights, norm
+
+    def tiled_cond(self, cond, n):
+        """cond repeated for n windows, the same tensor every step so the cross-attention cache keeps hitting"""
+        key = (id(cond), n)
+        entry = self.tile_conds.get(key)
+        if entry is None or entry[0] is not cond:
+            entry = self.tile_conds[key] = (cond, cond.repeat(n, *([1] * (cond.dim() - 1))))
+        return entry[1]
+
+    def apply_model_tiled(self, x_noisy, t, cond, speed_mp=None, emb=None):
+        """
+        MultiDiffusion (Bar-Tal et al. 2023): the model runs on overlapping windows of the latent, `tile_batch` windows
+        per unet batch, and the predictions are blended per pixel. Memory is bounded by the window size and the cost
+        grows with the number of windows, linearly in the canvas area.
+        """
+        b, _, h, w = x_noisy.shape
+        tile_batch = self.tiling[2]
+        th, tw, windows = self.tile_windows(h, w)
+        weights, norm = self.tile_weights(h, w, x_noisy)
+        out = None
+        for g in range(0, len(windows), tile_batch):
+            group = windows[g:g + tile_batch]
+            n = len(group)
+            x_in = torch.cat([x_noisy[:, :, y:y + th, x:x + tw] for y, x in group])
+            e_t = self.apply_model_batch(x_in, t.repeat(n), self.tiled_cond(cond, n), speed_mp=speed_mp,
+                                         emb=None if emb is None else emb.repeat(n, 1), cache_key=(b, g))
+            if out is None:
+                out = e_t.new_zeros((b, e_t.shape[1], h, w))
+            for k, (y, x) in enumerate(group):
+                out[:, :, y:y + th, x:x + tw].addcmul_(e_t[k * b:(k + 1) * b], weights)
+            del x_in, e_t
+        return out.div_(norm)
+
+    def apply_model_batch(self, x_noisy, t, cond, speed_mp=None, return_ids=False, emb=None, cache_key=None,
+                          paired=False):
         step = self.unet_bs
-        h, emb, hs = self.model1(x_noisy[0:step], t[:step], cond[:step], speed_mp=speed_mp)
+        emb_in = emb
         bs = cond.shape[0]
+        if self.token_merge is not None:
+            # the halves only meet in one unet call when the batch isn't chunked
+            self.token_merge.paired = paired and step >= bs
+        # with a deep cache, cheap steps only run the shallow blocks on top of the deep features of the last full one
+        cache = self.deep_cache
+        cache_key = bs if cache_key is None else cache_key
+        cheap = cache is not None and cache.cheap(cache_key)
+        depth = cache.depth if cheap else None
+        keep = cache.depth if cache is not None and not cheap else None
+        if cache is not None:
+            cache.record(cheap)
 
-        # assert bs%2 == 0
-        lenhs = len(hs)
-
-        for i in range(step, bs, step):
-            h_temp, emb_temp, hs_temp = self.model1(x_noisy[i:i + step], t[i:i + step], cond[i:i + step], speed_mp)
-            h = torch.cat((h, h_temp))
-            emb = torch.cat((emb, emb_temp))
-            for j in range(lenhs):
-                hs[j] = torch.cat((hs[j], hs_temp[j]))
-
-        if not self.turbo:
-            self.model1.to("cpu")
-            self.model2.to(self.cdevice)
-
-        hs_temp = [hs[j][:step] for j in range(lenhs)]
-        x_recon = self.model2(h[:step], emb[:step], x_noisy.dtype, hs_temp, cond[:step], speed_mp)
+        if self.turbo:
+            # both halves are on the device, every chunk goes through model1 and straight into model2,
+            # so only one chunk's skip activations exist at a time
+            x_recon = None
+            for i in range(0, bs, step):
+                h, emb, hs = self.model1(x_noisy[i:i + step], t[i:i + step], cond[i:i + step], speed_mp,
+                                         emb=None if emb_in is None else emb_in[i:i + step], depth=depth)
+                if cheap:
+                    h = cache.feature(cache_key)[i:i + step]
+                out = self.model2(h, emb, x_noisy.dtype, hs, cond[i:i + step], speed_mp, keep=keep)
+                if keep is not None:
+                    out, feature = out
+                    cache.store(cache_key, bs, i, feature)
+                    del feature
+                del h, emb, hs
+                if x_recon is None:
+                    x_recon = out.new_empty((bs,) + out.shape[1:])
+                x_recon[i:i + step] = out
+                del out
+            return x_recon
 
-        for i in range(step, bs, step):
-            hs_temp = [hs[j][i:i + step] for j in range(lenhs)]
-            x_recon1 = self.model2(h[i:i + step], emb[i:i + step], x_noisy.dtype, hs_temp, cond[i:i + step], speed_mp)
-            x_recon = torch.cat((x_recon, x_recon1))
+        self.model1.to(self.cdevice)
 
-        if not self.turbo:
-            self.model2.to("cpu")
+        # the skips of every chunk have to be kept while model1 and model2 take turns on the device,
+        # the buffers for them are allocated once with the first chunk's shapes and filled in place
+        h_temp, emb_temp, hs_temp = self.model1(x_noisy[0:step], t[:step], cond[:step], speed_mp=speed_mp,
+                                                emb=None if emb_in is None else emb_in[:step], depth=depth)
+        if step >= bs:
+            h, emb, hs = h_temp, emb_temp, hs_temp
+        else:
+            h = None if cheap else h_temp.new_empty((bs,) + h_temp.shape[1:])
+            emb = emb_temp.new_empty((bs,) + emb_temp.shape[1:])
+            hs = [x.new_empty((bs,) + x.shape[1:]) for x in hs_temp]
+            for i in range(0, bs, step):
+                if i > 0:
+                    h_temp, emb_temp, hs_temp = self.model1(x_noisy[i:i + step], t[i:i + step], cond[i:i + step],
+                                                            speed_mp, depth=depth,
+                                                            emb=None if emb_in is None else emb_in[i:i + step])
+                if not cheap:
+                    h[i:i + step] = h_temp
+                emb[i:i + step] = emb_temp
+                for j, x in enumerate(hs_temp):
+                    hs[j][i:i + step] = x
+        del h_temp, emb_temp, hs_temp
+        if cheap:
+            h = cache.feature(cache_key)
+
+        self.model1.to("cpu")
+        self.model2.to(self.cdevice)
+
+        x_recon = None
+        for i in range(0, bs, step):
+            out = self.model2(h[i:i + step], emb[i:i + step], x_noisy.dtype, [x[i:i + step] for x in hs],
+                              cond[i:i + step], speed_mp, keep=keep)
+            if keep is not None:
+                out, feature = out
+                cache.store(cache_key, bs, i, feature)
+                del feature
+            if step >= bs:
+                x_recon = out
+                break
+            if x_recon is None:
+                x_recon = out.new_empty((bs,) + out.shape[1:])
+            x_recon[i:i + step] = out
+            del out
+        del h, emb, hs
+
+        self.model2.to("cpu")
 
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
         else:
             return x_recon
 
+    def seeded_noise(self, seed, batch_size, stream=0):
+        """
+        noise source where sample i uses seed + i (or seed[i] for a list), None in legacy mode (global rng, reseeded
+        per sample)
+        """
+        if self.legacy_noise:
+            return None
+        return SeededNoise(sample_seeds(seed, batch_size), self.cdevice, stream=stream)
+
+    def randn_like(self, x):
+        """noise for x from the seeded source of the current run, or from the global rng without one"""
+        if self.noise is None:
+            return torch.randn_like(x)
+        return self.noise.randn_like(x)
+
+    @staticmethod
+    def legacy_randn(seed, shape, device):
+        tens = []
+        for s in sample_seeds(seed, shape[0]):
+            torch.manual_seed(s)
+            tens.append(torch.randn((1,) + tuple(shape[1:]), device=device))
+        return torch.cat(tens)
+
+    def set_context_kv_cache(self, enabled):
+        """Turns the caching of the cross-attention key/value projections on or off in both unet halves."""
+        for module in list(self.model1.modules()) + list(self.model2.modules()):
+            if isinstance(module, CrossAttention) and module.is_cross_attention:
+                module.set_kv_cache(enabled)
+
+    def set_token_merge(self, ratio, max_downsample=1, merge_ff=False):
+        """
+        Merges `ratio` of the tokens before the self-attention (and with merge_ff the feed forward) of the
+        spatial transformers at a downsampling factor up to max_downsample, in both unet halves. ratio 0 turns it off.
+        """
+        self.token_merge = TokenMerge(ratio, max_downsample, merge_ff) if ratio > 0 else None
+        for module in list(self.model1.modules()) + list(self.model2.modules()):
+            if isinstance(module, SpatialTransformer):
+                module.set_token_merge(self.token_merge)
+
     def register_buffer1(self, name, attr):
         if type(attr) == torch.Tensor:
             if attr.device != torch.device(self.cdevice):
@@ -520,6 +1026,9 @@ class UNet(DDPM):
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (ddim_num_steps, ddim_discretize, ddim_eta, str(self.cdevice))
+        if key == self.schedule_key:
+            return
 
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.num_timesteps, verbose=verbose)
@@ -537,6 +1046,64 @@ class UNet(DDPM):
         self.register_buffer1('ddim_alphas', ddim_alphas)
         self.register_buffer1('ddim_alphas_prev', ddim_alphas_prev)
         self.register_buffer1('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
+        self.schedule_key = key
+
+    def time_embeddings(self, timesteps):
+        """time_embed of model1 for a batch of timesteps, run on the device even while model1 is offloaded"""
+        unet = self.model1.diffusion_model
+        param = next(unet.time_embed.parameters())
+        home = param.device
+        unet.time_embed.to(self.cdevice)
+        emb = unet.time_embed(timestep_embedding(timesteps, unet.model_channels).to(self.cdevice, param.dtype))
+        unet.time_embed.to(home)
+        return emb
+
+    def cached_plan(self, key, build):
+        dtype = next(self.model1.diffusion_model.time_embed.parameters()).dtype
+        key = key + (dtype,)
+        plan = self.sampling_plans.get(key)
+        if plan is None:
+            plan = self.sampling_plans[key] = build()
+            while len(self.sampling_plans) > 8:
+                self.sampling_plans.popitem(last=False)
+        self.sampling_plans.move_to_end(key)
+        return plan
+
+    def sampling_plan(self, batch_size, device):
+        """SamplingPlan of the current schedule, cached per (schedule, batch, dtype, device)."""
+        return self.cached_plan((self.schedule_key, batch_size, str(device)),
+                                lambda: SamplingPlan(self, batch_size, device))
+
+    def sigma_plan(self, sigmas, batch_size, device):
+        """SigmaPlan for the given evaluation sigmas, cached like sampling_plan()"""
+        sigmas = tuple(float(sigma) for sigma in sigmas)
+        return self.cached_plan(("sigmas", sigmas, batch_size, str(device)),
+                                lambda: SigmaPlan(self, sigmas, batch_size, device))
+
+    def log_sigmas(self):
+        alphas_cumprod = self.alphas_cumprod.double().cpu().numpy()
+        return 0.5 * np.log((1 - alphas_cumprod) / alphas_cumprod)
+
+    def sigma_to_t(self, sigmas):
+        """(fractional) ddpm timesteps of the given sigmas, interpolated in log sigma"""
+        log_sigmas = self.log_sigmas()
+        return np.interp(np.log(sigmas), log_sigmas, np.arange(len(log_sigmas)))
+
+    def sigma_schedule(self, n, schedule="karras", t_start=None):
+        """n sigmas from the one of timestep t_start (default: the last one) down to the smallest one, plus a 0"""
+        log_sigmas = self.log_sigmas()
+        t_max = len(log_sigmas) - 1 if t_start is None else t_start
+        sigma_max = math.exp(np.interp(t_max, np.arange(len(log_sigmas)), log_sigmas))
+        sigma_min = math.exp(log_sigmas[0])
+        if schedule == "karras":
+            rho = 7.
+            ramp = np.linspace(0, 1, n)
+            sigmas = (sigma_max ** (1 / rho) + ramp * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))) ** rho
+        elif schedule == "uniform":
+            sigmas = np.exp(np.interp(np.linspace(t_max, 0, n), np.arange(len(log_sigmas)), log_sigmas))
+        else:
+            raise ValueError(f"unknown sigma schedule '{schedule}', choose from karras or uniform")
+        return [float(sigma) for sigma in sigmas] + [0.]
 
     @torch.no_grad()
     def sample(self,
@@ -562,97 +1129,228 @@ class UNet(DDPM):
                unconditional_conditioning=None,
                speed_mp=None,
                batch_size=None,
-               callback_fn=None
+               callback_fn=None,
+               sigma_schedule=None,
+               guidance=None,
+               stop_threshold=0.,
+               stop_patience=3,
+               deep_cache=None,
+               tile_size=None,
+               tile_overlap=16,
+               tile_batch=4,
+               progress=None
                ):
 
-        if self.turbo:
-            self.model1.to(self.cdevice)
-            self.model2.to(self.cdevice)
-
-        if x0 is None:
-            batch_size, b1, b2, b3 = shape
-            img_shape = (1, b1, b2, b3)
-            tens = []
-            print("seeds used = ", [seed + s for s in range(batch_size)])
-            for _ in range(batch_size):
-                torch.manual_seed(seed)
-                tens.append(torch.randn(img_shape, device=self.cdevice))
-                seed += 1
-            noise = torch.cat(tens)
-            del tens
-            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
-
-        x_latent = noise if x0 is None else x0
-        # sampling
-
-        if sampler == "plms":
-            print(f'Data shape for PLMS sampling is {shape}')
-            samples = self.plms_sampling(conditioning, batch_size, x_latent,
-                                         callback=callback,
-                                         img_callback=img_callback,
-                                         quantize_denoised=quantize_x0,
-                                         mask=mask, x0=x0,
-                                         ddim_use_original_steps=False,
-                                         noise_dropout=noise_dropout,
-                                         temperature=temperature,
-                                         score_corrector=score_corrector,
-                                         corrector_kwargs=corrector_kwargs,
-                                         log_every_t=log_every_t,
-                                         unconditional_guidance_scale=unconditional_guidance_scale,
-                                         unconditional_conditioning=unconditional_conditioning,
-                                         speed_mp=speed_mp,
-                                         callback_fn=callback_fn
-                                         )
-
-        elif sampler == "ddim":
-            samples = self.ddim_sampling(x_latent, conditioning, S,
-                                         unconditional_guidance_scale=unconditional_guidance_scale,
-                                         unconditional_conditioning=unconditional_conditioning,
-                                         mask=mask, init_latent=x_T, use_original_steps=False,
-                                         callback_fn=callback_fn
-                                         )
-        else:
-            if sampler == 'k_dpm_2_a':
-                sampler = KDiffusionSampler(self, 'dpm_2_ancestral')
-            elif sampler == 'k_dpm_2':
-                sampler = KDiffusionSampler(self, 'dpm_2')
-            elif sampler == 'k_euler_a':
-                sampler = KDiffusionSampler(self, 'euler_ancestral')
-            elif sampler == 'k_euler':
-                sampler = KDiffusionSampler(self, 'euler')
-            elif sampler == 'k_heun':
-                sampler = KDiffusionSampler(self, 'heun')
-            elif sampler == 'k_lms':
-                sampler = KDiffusionSampler(self, 'lms')
-            if mask is not None:
-                logging.info("k_diffusion does not support masks yet")
-            # samples = sampler.sample(x_latent, conditioning,
-            #                          unconditional_conditioning, S, unconditional_guidance_scale)
-            samples = sampler.sample(x_latent, conditioning, S,
-                                     unconditional_guidance_scale=unconditional_guidance_scale,
-                                     unconditional_conditioning=unconditional_conditioning,
-                                     mask=mask, init_latent=x_T, callback_fn=callback_fn)
-
-        # elif sampler == "euler":
-        #     cvd = CompVisDenoiser(self.alphas_cumprod)
-        #     sig = cvd.get_sigmas(S)
-        #     samples = self.heun_sampling(noise, sig, conditioning,
-        #     unconditional_conditioning=unconditional_conditioning,
-        #                                 unconditional_guidance_scale=unconditional_guidance_scale)
-
-        if self.turbo:
-            self.model1.to("cpu")
-            self.model2.to("cpu")
+        # the free memory changed since the last run, plan the attention chunks again
+        chunk_planner.reset()
+        try:
+            # starts from an empty cache, so a new conditioning can never hit a stale projection
+            self.set_context_kv_cache(self.cache_context_kv)
+            if self.turbo:
+                self.model1.to(self.cdevice)
+                self.model2.to(self.cdevice)
+
+            self.noise = self.seeded_noise(seed, shape[0] if x0 is None else x0.shape[0])
+            if isinstance(unconditional_guidance_scale, (list, tuple)) and len(set(unconditional_guidance_scale)) == 1:
+                unconditional_guidance_scale = unconditional_guidance_scale[0]
+            self.guidance = guidance if guidance is not None else GuidancePolicy()
+            self.deep_cache = deep_cache
+            self.progress = progress
+            if tile_size is not None:
+                if tile_size % 8 or not 0 <= tile_overlap < tile_size:
+                    raise ValueError(f"the tile size must be a multiple of 8 latent pixels larger than the overlap, "
+                                     f"got {tile_size} and {tile_overlap}")
+                self.tiling = (tile_size, tile_overlap, tile_batch)
+            self.steps_run = None
+            if x0 is None:
+                batch_size, b1, b2, b3 = shape
+                print("seeds used = ", sample_seeds(seed, batch_size))
+                if self.noise is None:
+                    noise = self.legacy_randn(seed, shape, self.cdevice)
+                else:
+                    noise = self.noise.randn((b1, b2, b3))
+                self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
+
+            x_latent = noise if x0 is None else x0
+            # sampling
+
+            if sampler == "plms":
+                print(f'Data shape for PLMS sampling is {shape}')
+                samples = self.plms_sampling(conditioning, batch_size, x_latent,
+                                             callback=callback,
+                                             img_callback=img_callback,
+                                             quantize_denoised=quantize_x0,
+                                             mask=mask, x0=x0,
+                                             ddim_use_original_steps=False,
+                                             noise_dropout=noise_dropout,
+                                             temperature=temperature,
+                                             score_corrector=score_corrector,
+                                             corrector_kwargs=corrector_kwargs,
+                                             log_every_t=log_every_t,
+                                             unconditional_guidance_scale=unconditional_guidance_scale,
+                                             unconditional_conditioning=unconditional_conditioning,
+                                             speed_mp=speed_mp,
+                                             callback_fn=callback_fn,
+                                             stop_threshold=stop_threshold,
+                                             stop_patience=stop_patience
+                                             )
+
+            elif sampler in ("dpmpp_2m", "dpmpp_3s"):
+                samples = self.dpmpp_sampling(x_latent, conditioning, S, solver=sampler,
+                                              schedule=sigma_schedule or "karras",
+                                              x0=x0, mask=mask,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning,
+                                              speed_mp=speed_mp, callback_fn=callback_fn)
+
+            elif sampler == "ddim":
+                samples = self.ddim_sampling(x_latent, conditioning, S,
+                                             unconditional_guidance_scale=unconditional_guidance_scale,
+                                             unconditional_conditioning=unconditional_conditioning,
+                                             mask=mask, init_latent=x_T, use_original_steps=False,
+                                             callback_fn=callback_fn, stop_threshold=stop_threshold,
+                                             stop_patience=stop_patience
+                                             )
+            elif sampler in KARRAS_SAMPLERS:
+                samples = self.karras_sampling(x_latent, conditioning, S, sampler=KARRAS_SAMPLERS[sampler],
+                                               schedule=sigma_schedule or "uniform", x0=x0, mask=mask,
+                                               unconditional_guidance_scale=unconditional_guidance_scale,
+                                               unconditional_conditioning=unconditional_conditioning,
+                                               speed_mp=speed_mp, callback_fn=callback_fn)
+            else:
+                # any other k_diffusion sampler, e.g. "k_dpm_fast", if the package is installed
+                if mask is not None:
+                    logging.info("k_diffusion samplers do not support masks")
+                k_sampler = KDiffusionSampler(self, sampler[2:] if sampler.startswith("k_") else sampler)
+                samples = k_sampler.sample(x_latent, conditioning, S,
+                                           unconditional_guidance_scale=unconditional_guidance_scale,
+                                           unconditional_conditioning=unconditional_conditioning,
+                                           mask=mask, init_latent=x_T, callback_fn=callback_fn)
+
+            # elif sampler == "euler":
+            #     cvd = CompVisDenoiser(self.alphas_cumprod)
+            #     sig = cvd.get_sigmas(S)
+            #     samples = self.heun_sampling(noise, sig, conditioning,
+            #     unconditional_conditioning=unconditional_conditioning,
+            #                                 unconditional_guidance_scale=unconditional_guidance_scale)
+            steps_run = self.steps_run if self.steps_run is not None else S
+            self.last_run_stats = dict(sampler=sampler, steps_planned=S, steps_run=steps_run,
+                                       early_stopped=steps_run < S)
+            if self.guidance.active:
+                print(self.guidance.summary())
+                self.last_run_stats["guidance"] = self.guidance.stats()
+            if self.deep_cache is not None:
+                print(self.deep_cache.summary())
+                self.last_run_stats["deep_cache"] = self.deep_cache.stats()
+        finally:
+            # also after an exception, so a failed run can't leak its state into the next one
+            if self.turbo:
+                self.model1.to("cpu")
+                self.model2.to("cpu")
+            self.set_context_kv_cache(False)
+            self.noise = None
+            if self.deep_cache is not None:
+                # drop the kept features, they hold a batch of activations
+                self.deep_cache.start(0)
+            self.guidance = None
+            self.deep_cache = None
+            self.tiling = None
+            self.tile_conds = {}
+            self.tile_weight_cache = None
+            self.progress = None
 
         return samples
 
     def q_sample(self, x_start, t, noise=None):
-        noise = default(noise, lambda: torch.randn_like(x_start)).to(x_start.device)
+        noise = default(noise, lambda: self.randn_like(x_start)).to(x_start.device)
         return (extract_into_tensor(self.sqrt_alphas_cumprod.to(x_start.device), t.to(x_start.device),
                                     x_start.shape) * x_start +
                 extract_into_tensor(self.sqrt_one_minus_alphas_cumprod.to(x_start.device), t.to(x_start.device),
                                     x_start.shape) * noise)
 
+    def guided_model_output(self, x, index, plan, c, c_in, unconditional_guidance_scale, speed_mp=None):
+        """
+        Model output of one step, with classifier-free guidance when c_in is given. The doubled input batch is
+        a persistent buffer that x is copied into and the guidance is combined in place in the model output.
+        """
+        b = x.shape[0]
+        if c_in is None:
+            return self.apply_model(x, plan.ts[index], c, speed_mp=speed_mp, emb=plan.emb(index, b))
+        guidance = self.guidance
+        mode = "cfg" if guidance is None else guidance.mode()
+        if mode != "cfg":
+            # the guidance policy skips the uncond branch at this step
+            e_t = self.apply_model(x, plan.ts[index], c, speed_mp=speed_mp, emb=plan.emb(index, b))
+            guidance.record(mode, b)
+            if mode == "reuse":
+                # uncond + scale * (cond - uncond) == cond + (scale - 1) * (cond - uncond)
+                scale = per_sample(unconditional_guidance_scale, e_t)
+                if torch.is_tensor(scale):
+                    e_t.addcmul_(guidance.delta, scale - 1.)
+                else:
+                    e_t.add_(guidance.delta, alpha=scale - 1.)
+            return e_t
+        x_in = self.cfg_input
+        if x_in is None or x_in.shape != (2 * b,) + x.shape[1:] or x_in.dtype != x.dtype or x_in.device != x.device:
+            x_in = self.cfg_input = torch.empty((2 * b,) + x.shape[1:], dtype=x.dtype, device=x.device)
+        x_in[:b].copy_(x)
+        x_in[b:].copy_(x)
+        e_t_uncond, e_t = self.apply_model(x_in, plan.ts_cfg[index], c_in, speed_mp=speed_mp,
+                                           emb=plan.emb(index, 2 * b), paired=True).chunk(2)
+        if guidance is not None:
+            guidance.record(mode, b)
+            guidance.store(e_t_uncond, e_t)
+        # uncond + scale * (cond - uncond)
+        return e_t_uncond.lerp_(e_t, per_sample(unconditional_guidance_scale, e_t))
+
+    @staticmethod
+    def convergence_streak(streak, pred_x0, prev_pred_x0, stop_threshold):
+        """
+        Number of consecutive steps the x_0 prediction changed by less than stop_threshold (relative l2 in latent
+        space, the largest change in the batch counts). Always 0 with early stopping off.
+        """
+        if stop_threshold <= 0 or prev_pred_x0 is None:
+            return 0
+        change = (pred_x0 - prev_pred_x0).flatten(1).norm(dim=1) / prev_pred_x0.flatten(1).norm(dim=1).clamp_min(1e-8)
+        return streak + 1 if change.max().item() < stop_threshold else 0
+
+    def begin_step(self, step, total_steps):
+        """tells the guidance policy and the deep cache which sampler step the following model evaluations belong to"""
+        for tracker in (self.guidance, self.deep_cache):
+            if tracker is not None:
+                if step == 0:
+                    tracker.start(total_steps)
+                tracker.begin_step(step)
+        if self.progress is not None:
+            self.progress(step, total_steps)
+
+    def ddim_update(self, x, e_t, index, plan, quantize_denoised=False, repeat_noise=False, temperature=1.,
+                    noise_dropout=0.):
+        """x_{t-1} and the x_0 prediction of a ddim step"""
+        # select parameters corresponding to the currently considered timestep
+        sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_coef = plan.coefficients(index)
+
+        # current prediction for x_0
+        pred_x0 = torch.addcmul(x, e_t, sqrt_one_minus_at, value=-1.).div_(sqrt_at)
+        if quantize_denoised:
+            pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
+        # direction pointing to x_t, plus the prediction
+        x_prev = torch.mul(e_t, dir_coef).addcmul_(pred_x0, sqrt_a_prev)
+        if plan.has_noise:
+            noise = noise_like(x.shape, x.device, repeat_noise) if repeat_noise else self.randn_like(x)
+            noise = sigma_t * noise * temperature
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+            x_prev += noise
+        return x_prev, pred_x0
+
+    @staticmethod
+    def guidance_conditioning(cond, unconditional_conditioning, unconditional_guidance_scale):
+        """[uncond, cond] batch for classifier-free guidance, built once per run instead of once per step."""
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            return None
+        return torch.cat([unconditional_conditioning, cond])
+
     @torch.no_grad()
     def plms_sampling(self, cond, b, img,
                       ddim_use_original_steps=False,
@@ -660,16 +1358,18 @@ class UNet(DDPM):
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, speed_mp=None,
-                      callback_fn=None):
+                      callback_fn=None, stop_threshold=0., stop_patience=3):
 
-        device = self.betas.device
-        timesteps = self.ddim_timesteps
+        plan = self.sampling_plan(img.shape[0], img.device)
+        timesteps = plan.timesteps
         time_range = np.flip(timesteps)
         total_steps = timesteps.shape[0]
         print(f"Running PLMS Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        c_in = self.guidance_conditioning(cond, unconditional_conditioning, unconditional_guidance_scale)
+        prev_pred_x0, streak = None, 0
 
         for i, step in enumerate(iterator):
             try:
@@ -677,8 +1377,8 @@ class UNet(DDPM):
             except:
                 pass
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-            ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
+            ts = plan.ts[index]
+            self.begin_step(i, total_steps)
 
             if mask is not None:
                 assert x0 is not None
@@ -692,8 +1392,16 @@ class UNet(DDPM):
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
-                                      old_eps=old_eps, t_next=ts_next, speed_mp=speed_mp)
+                                      old_eps=old_eps, speed_mp=speed_mp, c_in=c_in, plan=plan)
             img, pred_x0, e_t = outs
+            self.steps_run = i + 1
+            streak = self.convergence_streak(streak, pred_x0, prev_pred_x0, stop_threshold)
+            prev_pred_x0 = pred_x0
+            if streak >= stop_patience and i < total_steps - 1:
+                # converged, finish with the current x_0 prediction instead of running the remaining steps
+                print(f"PLMS converged after {i + 1} of {total_steps} steps")
+                img = pred_x0 if mask is None else x0 * mask + (1. - mask) * pred_x0
+                break
             if i % 10 == 0 and callback_fn is not None:
                 callback_fn(img)
             old_eps.append(e_t)
@@ -707,54 +1415,31 @@ class UNet(DDPM):
     @torch.no_grad()
     def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None, speed_mp=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None,
+                      c_in=None, plan=None):
         b, *_, device = *x.shape, x.device
+        if c_in is None:
+            c_in = self.guidance_conditioning(c, unconditional_conditioning, unconditional_guidance_scale)
+        plan = plan if plan is not None else self.sampling_plan(b, device)
 
-        def get_model_output(x, t, speed_mp):
-            if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-                e_t = self.apply_model(x, t, c)
-            else:
-                x_in = torch.cat([x] * 2)
-                t_in = torch.cat([t] * 2)
-                c_in = torch.cat([unconditional_conditioning, c])
-                e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in, speed_mp=speed_mp).chunk(2)
-                e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        def get_model_output(x, index, speed_mp):
+            e_t = self.guided_model_output(x, index, plan, c, c_in, unconditional_guidance_scale, speed_mp=speed_mp)
 
             if score_corrector is not None:
                 assert self.parameterization == "eps"
-                e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
+                e_t = score_corrector.modify_score(self.model, e_t, x, plan.ts[index], c, **corrector_kwargs)
 
             return e_t
 
-        alphas = self.ddim_alphas
-        alphas_prev = self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
-        sigmas = self.ddim_sigmas
-
         def get_x_prev_and_pred_x0(e_t, index):
-            # select parameters corresponding to the currently considered timestep
-            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device)
-
-            # current prediction for x_0
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-            if quantize_denoised:
-                pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
-            # direction pointing to x_t
-            dir_xt = (1. - a_prev - sigma_t ** 2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-            return x_prev, pred_x0
+            return self.ddim_update(x, e_t, index, plan, quantize_denoised=quantize_denoised,
+                                    repeat_noise=repeat_noise, temperature=temperature, noise_dropout=noise_dropout)
 
-        e_t = get_model_output(x, t, speed_mp=speed_mp)
+        e_t = get_model_output(x, index, speed_mp=speed_mp)
         if len(old_eps) == 0:
             # Pseudo Improved Euler (2nd order)
             x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t, index)
-            e_t_next = get_model_output(x_prev, t_next, speed_mp)
+            e_t_next = get_model_output(x_prev, max(index - 1, 0), speed_mp)
             e_t_prime = (e_t + e_t_next) / 2
         elif len(old_eps) == 1:
             # 2nd order Pseudo Linear Multistep (Adams-Bashforth)
@@ -770,6 +1455,210 @@ class UNet(DDPM):
 
         return x_prev, pred_x0, e_t
 
+    @torch.no_grad()
+    def dpmpp_sampling(self, x, cond, steps, solver="dpmpp_2m", schedule="karras", x0=None, mask=None,
+                       unconditional_guidance_scale=1., unconditional_conditioning=None, speed_mp=None,
+                       callback_fn=None):
+        """
+        DPM-Solver++ (Lu et al. 2022) in sigma space, `steps` is the number of model evaluations.
+        dpmpp_2m is the second order multistep solver, dpmpp_3s the third order singlestep one.
+        With x0 (img2img, the clean latent) sampling starts at the timestep of step `steps` of the ddim schedule
+        made by stochastic_encode(), and with a mask the masked part is taken from x0 noised to every sigma.
+        """
+        if x0 is not None and steps <= 0:
+            # img2img at strength 0 keeps the image
+            return x0
+        b = x.shape[0]
+        t_start = self.img2img_t_start(x0, steps)
+
+        if solver == "dpmpp_2m":
+            orders = [1] * steps
+        else:
+            # third order steps, then what is left in one lower order step, the last step to sigma 0 is first order
+            orders = [3] * ((steps - 1) // 3) + ([(steps - 1) % 3] if (steps - 1) % 3 else []) + [1]
+        sigmas = self.sigma_schedule(len(orders), schedule, t_start)
+        eval_sigmas = []
+        for order, sigma, sigma_next in zip(orders, sigmas[:-1], sigmas[1:]):
+            eval_sigmas.append(sigma)
+            if order > 1:
+                h = math.log(sigma / sigma_next)
+                eval_sigmas += [sigma * math.exp(-r * h) for r in ((1 / 3, 2 / 3) if order == 3 else (1 / 2,))]
+        plan = self.sigma_plan(eval_sigmas, b, x.device)
+        denoise = self.sigma_denoiser(plan, cond, unconditional_conditioning, unconditional_guidance_scale, speed_mp)
+        print(f"Running {solver} sampling with {steps} model evaluations")
+
+        x, noise = self.sigma_start(x, x0, sigmas[0])
+
+        index = 0
+        old_denoised = None
+        iterator = tqdm(list(zip(orders, sigmas[:-1], sigmas[1:])), desc=solver)
+        for i, (order, sigma, sigma_next) in enumerate(iterator):
+            self.begin_step(i, len(orders))
+            denoised = denoise(x, index)
+            index += 1
+            if sigma_next == 0:
+                x = denoised
+            else:
+                h = math.log(sigma / sigma_next)
+                phi_1 = math.expm1(-h)
+                if order == 1:
+                    if old_denoised is not None and solver == "dpmpp_2m":
+                        r = math.log(sigmas[i - 1] / sigma) / h
+                        denoised_d = denoised * (1 + 1 / (2 * r)) - old_denoised * (1 / (2 * r))
+                    else:
+                        denoised_d = denoised
+                    x = x * (sigma_next / sigma) - denoised_d * phi_1
+                elif order == 2:
+                    r1 = 1 / 2
+                    sigma_1 = plan.sigmas[index]
+                    x_1 = x * (sigma_1 / sigma) - denoised * math.expm1(-r1 * h)
+                    denoised_1 = denoise(x_1, index)
+                    index += 1
+                    x = x * (sigma_next / sigma) - denoised * phi_1 - (denoised_1 - denoised) * (0.5 / r1 * phi_1)
+                else:
+                    r1, r2 = 1 / 3, 2 / 3
+                    sigma_1, sigma_2 = plan.sigmas[index], plan.sigmas[index + 1]
+                    x_1 = x * (sigma_1 / sigma) - denoised * math.expm1(-r1 * h)
+                    denoised_1 = denoise(x_1, index)
+                    phi_22 = math.expm1(-r2 * h) / (r2 * h) + 1
+                    x_2 = (x * (sigma_2 / sigma) - denoised * math.expm1(-r2 * h)
+                           + (denoised_1 - denoised) * (r2 / r1 * phi_22))
+                    denoised_2 = denoise(x_2, index + 1)
+                    index += 2
+                    phi_2 = phi_1 / h + 1
+                    x = x * (sigma_next / sigma) - denoised * phi_1 + (denoised_2 - denoised) * (phi_2 / r2)
+            old_denoised = denoised
+
+            if mask is not None and x0 is not None:
+                x = (x0 + noise * sigma_next) * mask + (1. - mask) * x
+            if i % 10 == 0 and callback_fn is not None:
+                callback_fn(x)
+        return x
+
+    def img2img_t_start(self, x0, steps):
+        """timestep the sigma-space samplers start img2img at: the one of step `steps` of the current ddim schedule"""
+        if x0 is None or self.schedule_key is None:
+            return None
+        return self.ddim_timesteps[max(0, min(steps, len(self.ddim_timesteps)) - 1)]
+
+    def sigma_start(self, x, x0, sigma):
+        """starting point of a sigma-space sampler and, for img2img, the noise x0 is noised with"""
+        if x0 is None:
+            return x * (sigma ** 2 + 1) ** 0.5, None
+        noise = self.randn_like(x0)
+        return x0 + noise * sigma, noise
+
+    def sigma_denoiser(self, plan, cond, unconditional_conditioning, unconditional_guidance_scale, speed_mp=None):
+        """x_0 prediction of the guided model for x at the sigma of plan index i"""
+        c_in = self.guidance_conditioning(cond, unconditional_conditioning, unconditional_guidance_scale)
+
+        def denoise(x, index):
+            eps = self.guided_model_output(x * plan.c_ins[index], index, plan, cond, c_in,
+                                           unconditional_guidance_scale, speed_mp=speed_mp)
+            return x - eps * plan.sigmas[index]
+
+        return denoise
+
+    @staticmethod
+    def ancestral_step(sigma, sigma_next, eta=1.):
+        """sigma to step down to and the amount of noise to add back for an ancestral step"""
+        if sigma_next == 0:
+            return 0., 0.
+        sigma_up = min(sigma_next, eta * (sigma_next ** 2 * (sigma ** 2 - sigma_next ** 2) / sigma ** 2) ** 0.5)
+        sigma_down = (sigma_next ** 2 - sigma_up ** 2) ** 0.5
+        return sigma_down, sigma_up
+
+    @staticmethod
+    def lms_coefficients(sigmas, order=4):
+        """coefficients of the linear multistep update of every step, integrating the lagrange basis exactly"""
+        coefficients = []
+        for i in range(len(sigmas) - 1):
+            cur_order = min(i + 1, order)
+            row = []
+            for j in range(cur_order):
+                basis = np.poly1d([1.])
+                for k in range(cur_order):
+                    if k != j:
+                        basis = basis * (np.poly1d([1., -sigmas[i - k]]) / (sigmas[i - j] - sigmas[i - k]))
+                integral = basis.integ()
+                row.append(float(integral(sigmas[i + 1]) - integral(sigmas[i])))
+            coefficients.append(row)
+        return coefficients
+
+    @torch.no_grad()
+    def karras_sampling(self, x, cond, steps, sampler="euler", schedule="uniform", x0=None, mask=None,
+                        unconditional_guidance_scale=1., unconditional_conditioning=None, speed_mp=None,
+                        callback_fn=None):
+        """
+        The samplers of Karras et al. (2022) and k-diffusion: euler, euler_a, heun, dpm_2, dpm_2_a and lms,
+        in sigma space on the split unet. img2img and masks work like in dpmpp_sampling().
+        """
+        if x0 is not None and steps <= 0:
+            return x0
+        b = x.shape[0]
+        sigmas = self.sigma_schedule(steps, schedule, self.img2img_t_start(x0, steps))
+        n = len(sigmas) - 1
+        ancestral = [self.ancestral_step(sigmas[i], sigmas[i + 1]) for i in range(n)]
+        # the model is evaluated at the schedule, the second order samplers also at the midpoints behind it
+        eval_sigmas = sigmas[:n]
+        if sampler == "dpm_2":
+            eval_sigmas = eval_sigmas + [math.exp((math.log(sigmas[i]) + math.log(sigmas[i + 1])) / 2)
+                                         if sigmas[i + 1] > 0 else sigmas[i] for i in range(n)]
+        elif sampler == "dpm_2_a":
+            eval_sigmas = eval_sigmas + [math.exp((math.log(sigmas[i]) + math.log(ancestral[i][0])) / 2)
+                                         if ancestral[i][0] > 0 else sigmas[i] for i in range(n)]
+        plan = self.sigma_plan(eval_sigmas, b, x.device)
+        denoise = self.sigma_denoiser(plan, cond, unconditional_conditioning, unconditional_guidance_scale, speed_mp)
+        lms = self.lms_coefficients(sigmas) if sampler == "lms" else None
+        print(f"Running {sampler} sampling with {steps} steps")
+
+        x, noise = self.sigma_start(x, x0, sigmas[0])
+        ds = []
+        for i in tqdm(range(n), desc=sampler):
+            self.begin_step(i, n)
+            sigma, sigma_next = sigmas[i], sigmas[i + 1]
+            denoised = denoise(x, i)
+            d = (x - denoised) / sigma
+            if sampler == "euler":
+                x = x + d * (sigma_next - sigma)
+            elif sampler == "euler_a":
+                sigma_down, sigma_up = ancestral[i]
+                x = x + d * (sigma_down - sigma)
+                if sigma_up > 0:
+                    x = x + self.randn_like(x) * sigma_up
+            elif sampler == "heun":
+                if sigma_next == 0:
+                    x = x + d * (sigma_next - sigma)
+                else:
+                    x_2 = x + d * (sigma_next - sigma)
+                    d_2 = (x_2 - denoise(x_2, i + 1)) / sigma_next
+                    x = x + (d + d_2) * ((sigma_next - sigma) / 2)
+            elif sampler in ("dpm_2", "dpm_2_a"):
+                sigma_down, sigma_up = ancestral[i] if sampler == "dpm_2_a" else (sigma_next, 0.)
+                if sigma_down == 0:
+                    x = x + d * (sigma_down - sigma)
+                else:
+                    sigma_mid = plan.sigmas[n + i]
+                    x_2 = x + d * (sigma_mid - sigma)
+                    d_2 = (x_2 - denoise(x_2, n + i)) / sigma_mid
+                    x = x + d_2 * (sigma_down - sigma)
+                if sigma_up > 0:
+                    x = x + self.randn_like(x) * sigma_up
+            elif sampler == "lms":
+                ds.append(d)
+                if len(ds) > 4:
+                    ds.pop(0)
+                for coefficient, d_j in zip(lms[i], reversed(ds)):
+                    x = x + d_j * coefficient
+            else:
+                raise ValueError(f"unknown sampler '{sampler}'")
+
+            if mask is not None and x0 is not None:
+                x = (x0 + noise * sigma_next) * mask + (1. - mask) * x
+            if i % 10 == 0 and callback_fn is not None:
+                callback_fn(x)
+        return x
+
     @torch.no_grad()
     def stochastic_encode(self, x0, t, seed, ddim_eta, ddim_steps, use_original_steps=False, noise=None):
         # fast, but does not allow for exact reconstruction
@@ -778,16 +1667,12 @@ class UNet(DDPM):
         sqrt_alphas_cumprod = torch.sqrt(self.ddim_alphas)
 
         if noise is None:
-            b0, b1, b2, b3 = x0.shape
-            img_shape = (1, b1, b2, b3)
-            tens = []
-            print("seeds used = ", [seed + s for s in range(b0)])
-            for _ in range(b0):
-                torch.manual_seed(seed)
-                tens.append(torch.randn(img_shape, device=x0.device))
-                seed += 1
-            noise = torch.cat(tens)
-            del tens
+            print("seeds used = ", sample_seeds(seed, x0.shape[0]))
+            source = self.seeded_noise(seed, x0.shape[0], stream=1)
+            if source is None:
+                noise = self.legacy_randn(seed, x0.shape, x0.device)
+            else:
+                noise = source.randn_like(x0)
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
                 extract_into_tensor(self.ddim_sqrt_one_minus_alphas, t, x0.shape) * noise)
 
@@ -795,7 +1680,7 @@ class UNet(DDPM):
     def add_noise(self, x0, t):
 
         sqrt_alphas_cumprod = torch.sqrt(self.ddim_alphas)
-        noise = torch.randn(x0.shape, device=x0.device)
+        noise = self.randn_like(x0)
 
         # print(extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape),
         #       extract_into_tensor(self.ddim_sqrt_one_minus_alphas, t, x0.shape))
@@ -804,32 +1689,47 @@ class UNet(DDPM):
 
     @torch.no_grad()
     def ddim_sampling(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-                      mask=None, init_latent=None, use_original_steps=False, callback_fn=None):
+                      mask=None, init_latent=None, use_original_steps=False, callback_fn=None, stop_threshold=0.,
+                      stop_patience=3):
 
-        timesteps = self.ddim_timesteps
-        timesteps = timesteps[:t_start]
+        plan = self.sampling_plan(x_latent.shape[0], x_latent.device)
+        timesteps = plan.timesteps[:t_start]
         time_range = np.flip(timesteps)
         total_steps = timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
+        c_in = self.guidance_conditioning(cond, unconditional_conditioning, unconditional_guidance_scale)
+        x0 = init_latent
+        prev_pred_x0, streak = None, 0
         for i, step in enumerate(iterator):
-            x0 = init_latent if init_latent is not None else torch.randn_like(x_dec)
+            if mask is not None and init_latent is None:
+                x0 = self.randn_like(x_dec)
             try:
                 iterator.write(file=open("tqdm.txt", "w", encoding="utf-8"), s=str(iterator))
             except:
                 pass
             index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+            ts = plan.ts[index]
+            self.begin_step(i, total_steps)
             if mask is not None:
                 # x0_noisy = self.add_noise(mask, torch.tensor([index] * x0.shape[0]).to(self.cdevice))
                 x0_noisy = x0
                 x_dec = x0_noisy * mask + (1. - mask) * x_dec
 
-            x_dec = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                       unconditional_guidance_scale=unconditional_guidance_scale,
-                                       unconditional_conditioning=unconditional_conditioning)
+            x_dec, pred_x0 = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                                unconditional_guidance_scale=unconditional_guidance_scale,
+                                                unconditional_conditioning=unconditional_conditioning, c_in=c_in,
+                                                plan=plan)
+            self.steps_run = i + 1
+            streak = self.convergence_streak(streak, pred_x0, prev_pred_x0, stop_threshold)
+            prev_pred_x0 = pred_x0
+            if streak >= stop_patience and i < total_steps - 1:
+                # converged, finish with the current x_0 prediction instead of running the remaining steps
+                print(f"DDIM converged after {i + 1} of {total_steps} steps")
+                x_dec = pred_x0
+                break
             if i % 10 == 0 and callback_fn is not None:
                 callback_fn(x_dec)
 
@@ -841,145 +1741,17 @@ class UNet(DDPM):
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, c_in=None, plan=None):
         b, *_, device = *x.shape, x.device
+        if c_in is None:
+            c_in = self.guidance_conditioning(c, unconditional_conditioning, unconditional_guidance_scale)
+        plan = plan if plan is not None else self.sampling_plan(b, device)
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            e_t = self.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        e_t = self.guided_model_output(x, index, plan, c, c_in, unconditional_guidance_scale)
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.ddim_alphas
-        alphas_prev = self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
-        sigmas = self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device)
-
-        # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-        if quantize_denoised:
-            pred_x0, _, *_ = self.first_stage_model.quantize(pred_x0)
-        # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t ** 2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev
-
-    def append_zero(self, x):
-        return torch.cat([x, x.new_zeros([1])])
-
-    def get_sigmas_karras(self, n, sigma_min, sigma_max, rho=7., device='cpu'):
-        """Constructs the noise schedule of Karras et al. (2022)."""
-        ramp = torch.linspace(0, 1, n)
-        min_inv_rho = sigma_min ** (1 / rho)
-        max_inv_rho = sigma_max ** (1 / rho)
-        sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
-        return self.append_zero(sigmas).to(device)
-
-    def get_sigmas_exponential(self, n, sigma_min, sigma_max, device='cpu'):
-        """Constructs an exponential noise schedule."""
-        sigmas = torch.linspace(math.log(sigma_max), math.log(sigma_min), n, device=device).exp()
-        return self.append_zero(sigmas)
-
-    def get_sigmas_vp(self, n, beta_d=19.9, beta_min=0.1, eps_s=1e-3, device='cpu'):
-        """Constructs a continuous VP noise schedule."""
-        t = torch.linspace(1, eps_s, n, device=device)
-        sigmas = torch.sqrt(torch.exp(beta_d * t ** 2 / 2 + beta_min * t) - 1)
-        return self.append_zero(sigmas)
-
-    def to_d(self, x, sigma, denoised):
-        """Converts a denoiser output to a Karras ODE derivative."""
-        return (x - denoised) / self.append_dims(sigma, x.ndim)
-
-    def append_dims(self, x, target_dims):
-        """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
-        dims_to_append = target_dims - x.ndim
-        if dims_to_append < 0:
-            raise ValueError(f'input has {x.ndim} dims but target_dims is {target_dims}, which is less')
-        return x[(...,) + (None,) * dims_to_append]
-
-    def get_ancestral_step(self, sigma_from, sigma_to):
-        """Calculates the noise level (sigma_down) to step down to and the amount
-        of noise to add (sigma_up) when doing an ancestral sampling step."""
-        sigma_up = (sigma_to ** 2 * (sigma_from ** 2 - sigma_to ** 2) / sigma_from ** 2) ** 0.5
-        sigma_down = (sigma_to ** 2 - sigma_up ** 2) ** 0.5
-        return sigma_down, sigma_up
-
-    @torch.no_grad()
-    def euler_sampling(self, x, sigmas, cond, extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0.,
-                       s_tmax=float('inf'), s_noise=1.):
-        """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-        s_in = x.new_ones([x.shape[0]]).half()
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-            denoised = self.apply_model(x, sigma_hat * s_in, cond)
-            d = self.to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            # Euler method
-            x = x + d * dt
-        return x
-
-    @torch.no_grad()
-    def heun_sampling(self, x, sigmas, cond, unconditional_conditioning=None, unconditional_guidance_scale=1,
-                      extra_args=None, callback=None, disable=None, s_churn=0., s_tmin=0., s_tmax=float('inf'),
-                      s_noise=1.):
-        """Implements Algorithm 2 (Heun steps) from Karras et al. (2022)."""
-        extra_args = {} if extra_args is None else extra_args
-        print(sigmas)
-        # sigmas = self.get_sigmas_karras(steps, 0.01, 80, rho=7., device=x.device)
-        print(x[0])
-        x = x * sigmas[0]
-        print("alu", x[0])
-        s_in = x.new_ones([x.shape[0]])
-        for i in trange(len(sigmas) - 1, disable=disable):
-            gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
-            eps = torch.randn_like(x) * s_noise
-            sigma_hat = (sigmas[i] * (gamma + 1)).half()
-            if gamma > 0:
-                x = x + eps * (sigma_hat ** 2 - sigmas[i] ** 2) ** 0.5
-
-            # print(sigma_hat * s_in)
-            # x, sigma_hat * s_in, cond
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([sigma_hat * s_in] * 2)
-            c_in = torch.cat([unconditional_conditioning, cond])
-            e_t_uncond, e_t = self.apply_model(x_in, t_in, c_in).chunk(2)
-            denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
-            # denoised = self.apply_model(x, sigma_hat * s_in, cond)
-            d = self.to_d(x, sigma_hat, denoised)
-            if callback is not None:
-                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
-            dt = sigmas[i + 1] - sigma_hat
-            # if sigmas[i + 1] == 0:
-            if 1:
-                # Euler method
-                x = x + d * dt
-            else:
-                # Heun's method
-                x_2 = x + d * dt
-                denoised_2 = self.apply_model(x_2, sigmas[i + 1] * s_in, cond)
-                d_2 = self.to_d(x_2, sigmas[i + 1], denoised_2)
-                d_prime = (d + d_2) / 2
-                x = x + d_prime * dt
-        return x
+        return self.ddim_update(x, e_t, index, plan, quantize_denoised=quantize_denoised,
+                                repeat_noise=repeat_noise, temperature=temperature, noise_dropout=noise_dropout)
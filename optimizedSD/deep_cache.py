@@ -0,0 +1,68 @@
+"""
+Reuse of the deep unet features across sampler steps (DeepCache, Ma et al. 2023).
+
+Adjacent steps produce nearly the same deep features. On a full step the whole unet runs and the input of the
+last `depth` output blocks is kept. On the cheap steps after it, model1 only runs the first `depth` input blocks,
+the middle block is skipped and model2 only runs the last `depth` output blocks, on top of the kept feature.
+Every `interval`-th step is a full one.
+
+The features are kept per key, the batch size of the evaluation (and the window group when sampling is tiled), so
+the doubled guidance batch and the conditional-only batch of a GuidancePolicy each have their own.
+"""
+
+
+class DeepCache:
+
+    def __init__(self, interval=3, depth=1):
+        if interval < 1:
+            raise ValueError(f"the deep cache interval must be at least 1, got {interval}")
+        if depth < 1:
+            raise ValueError(f"the deep cache depth must be at least 1, got {depth}")
+        self.interval = int(interval)
+        self.depth = int(depth)
+        self.start(0)
+
+    def start(self, total_steps):
+        """called by a sampler before its first step"""
+        self.total_steps = total_steps
+        self.step = 0
+        self.features = {}  # key -> kept feature of the last full step
+        self.last_full_step = {}
+        self.full_evals = 0
+        self.cheap_evals = 0
+
+    def begin_step(self, step):
+        self.step = step
+
+    def cheap(self, key):
+        """whether an evaluation with this key at the current step can run on the kept features"""
+        if key not in self.features:
+            return False
+        return 0 < self.step - self.last_full_step[key] < self.interval
+
+    def record(self, cheap):
+        if cheap:
+            self.cheap_evals += 1
+        else:
+            self.full_evals += 1
+
+    def feature(self, key):
+        return self.features[key]
+
+    def store(self, key, batch, offset, feature):
+        """keeps the feature of samples offset:offset + len(feature) of a full evaluation of `batch` samples"""
+        self.last_full_step[key] = self.step
+        if offset == 0 and feature.shape[0] == batch:
+            self.features[key] = feature
+            return
+        kept = self.features.get(key)
+        if offset == 0 and (kept is None or kept.shape != (batch,) + feature.shape[1:] or kept.dtype != feature.dtype):
+            kept = self.features[key] = feature.new_empty((batch,) + feature.shape[1:])
+        kept[offset:offset + feature.shape[0]] = feature
+
+    def stats(self):
+        return dict(full_evals=self.full_evals, cheap_evals=self.cheap_evals, interval=self.interval, depth=self.depth)
+
+    def summary(self):
+        return (f"deep cache: {self.cheap_evals} of {self.full_evals + self.cheap_evals} unet evaluations "
+                f"ran on cached features")
@@ -37,6 +37,8 @@ from skimage.exposure import match_histograms
 from torch import autocast
 from torchvision.utils import make_grid
 
+from residency import stage_residency
+
 device = torch.device(0)
 
 
@@ -304,6 +306,7 @@ def inner_generate(args, return_latent=False, return_sample=False, return_c=Fals
     model.turbo = True
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
     init_image = args.init_image
     if device != "cpu":
         model.half()
@@ -316,7 +319,7 @@ def inner_generate(args, return_latent=False, return_sample=False, return_c=Fals
     assert prompt is not None
     data = [batch_size * [prompt]]
     precision_scope = autocast if args.precision == "autocast" else nullcontext
-    modelFS.to(device)
+    stages.acquire("modelFS")
     init_latent = None
     mask_image = None
     if args.init_latent is not None:
@@ -362,11 +365,7 @@ def inner_generate(args, return_latent=False, return_sample=False, return_c=Fals
     else:
         mask = None
 
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
+    stages.release("modelFS")
 
     t_enc = int((1.0 - args.strength) * args.steps)
     results = []
@@ -382,11 +381,7 @@ def inner_generate(args, return_latent=False, return_sample=False, return_c=Fals
                 if args.init_c is not None:
                     c = args.init_c
 
-                if device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelCS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelCS")
 
                 z_enc = model.stochastic_encode(
                     init_latent, torch.tensor([t_enc] * batch_size).to(device), args.seed, args.ddim_eta, args.ddim_steps
@@ -0,0 +1,201 @@
+"""
+Pre-split, memory-mapped checkpoint format.
+
+The regular model.ckpt is a 4GB pickle that has to be fully unpickled into RAM, re-keyed into
+model1./model2. and then loaded into every stage. The converter below does that work once and writes
+one safetensors-style file per stage (8 byte header size, json header, raw aligned tensor data),
+optionally in fp16, plus the CLIP tokenizer/config so that loading needs no network.
+Loading memory-maps each file and hands every stage only its own tensors without copying them.
+
+Convert once:
+    python optimizedSD/fast_ckpt.py --ckpt_path models/ldm/stable-diffusion-v1/model.ckpt \
+        --out_dir models/ldm/stable-diffusion-v1/model-fast --half
+then pass the directory as --ckpt_path to any of the scripts.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+
+STAGES = ("unet", "cond_stage", "first_stage")
+ALIGNMENT = 64
+CLIP_DIR = "clip"
+
+DTYPE_NAMES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+NAME_DTYPES = {v: k for k, v in DTYPE_NAMES.items()}
+
+
+def load_model_from_config(ckpt, verbose=False):
+    print(f"Loading model from {ckpt}")
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    if "global_step" in pl_sd:
+        print(f"Global Step: {pl_sd['global_step']}")
+    sd = pl_sd["state_dict"]
+    return sd
+
+
+def split_state_dict(sd):
+    """Re-keys model.* into model1.*/model2.* and routes every tensor to the stage that owns it."""
+    stages = {stage: {} for stage in STAGES}
+    for key, value in sd.items():
+        sp = key.split(".")
+        if sp[0] == "model":
+            if "input_blocks" in sp or "middle_block" in sp or "time_embed" in sp:
+                stages["unet"]["model1." + key[6:]] = value
+            else:
+                stages["unet"]["model2." + key[6:]] = value
+        elif sp[0] == "cond_stage_model":
+            stages["cond_stage"][key] = value
+        elif sp[0] == "first_stage_model":
+            stages["first_stage"][key] = value
+        elif sp[0] == "model_ema":
+            continue
+        else:
+            # schedule buffers (betas, alphas_cumprod, ...)
+            stages["unet"][key] = value
+    return stages
+
+
+def save_stage(path, sd, metadata=None):
+    # biggest elements first, so that every tensor stays aligned to its element size
+    names = sorted(sd, key=lambda k: -sd[k].element_size())
+    header, offset = {}, 0
+    for name in names:
+        t = sd[name]
+        nbytes = t.numel() * t.element_size()
+        header[name] = {"dtype": DTYPE_NAMES[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header["__metadata__"] = {k: str(v) for k, v in (metadata or {}).items()}
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(8 + len(header)) % ALIGNMENT)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            t = sd[name].detach().cpu().contiguous().reshape(-1)
+            if t.numel():
+                f.write(memoryview(t.view(torch.uint8).numpy()))
+
+
+def load_stage(path):
+    """Memory-maps a stage file, returns ({name: tensor}, metadata). The tensors point into the mapping."""
+    with open(path, "rb") as f:
+        n = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(n))
+        # copy-on-write mapping: pages are read lazily, nothing is written back to the file
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = 8 + n
+    metadata = header.pop("__metadata__", {})
+    sd = {}
+    for name, info in header.items():
+        dtype = NAME_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count:
+            t = torch.frombuffer(mm, dtype=dtype, count=count, offset=start + begin)
+        else:
+            t = torch.empty(0, dtype=dtype)
+        sd[name] = t.reshape(info["shape"])
+    return sd, metadata
+
+
+def is_fast_ckpt(path):
+    return os.path.isdir(path) and all(os.path.exists(os.path.join(path, f"{s}.safetensors")) for s in STAGES)
+
+
+def convert(ckpt_path, out_dir, config_path="optimizedSD/v1-inference.yaml", half=False):
+    tic = time.time()
+    stages = split_state_dict(load_model_from_config(ckpt_path))
+    os.makedirs(out_dir, exist_ok=True)
+    for stage, sd in stages.items():
+        if half:
+            sd = {k: v.half() if v.is_floating_point() else v for k, v in sd.items()}
+        path = os.path.join(out_dir, f"{stage}.safetensors")
+        save_stage(path, sd, metadata=dict(format="optimizedSD-fast", stage=stage, source=os.path.basename(ckpt_path)))
+        print(f"wrote {len(sd)} tensors to {path}")
+
+    # the tokenizer and text config are fetched from the hub by FrozenCLIPEmbedder, keep a local copy
+    from transformers import CLIPTokenizer, CLIPTextConfig
+    config = OmegaConf.load(config_path)
+    version = config.modelCondStage.params.cond_stage_config.get("params", {}).get(
+        "version", "openai/clip-vit-large-patch14")
+    clip_dir = os.path.join(out_dir, CLIP_DIR)
+    CLIPTokenizer.from_pretrained(version).save_pretrained(clip_dir)
+    CLIPTextConfig.from_pretrained(version).save_pretrained(clip_dir)
+    print(f"converted in {time.time() - tic:.2f} seconds")
+
+
+def load_into(module, sd):
+    """load_state_dict(sd, strict=False), keeping the memory-mapped tensors instead of copying when dtypes match."""
+    own = module.state_dict(keep_vars=True)
+    same_dtype = all(k not in own or own[k].dtype == v.dtype for k, v in sd.items())
+    if same_dtype:
+        try:
+            return module.load_state_dict(sd, strict=False, assign=True)
+        except TypeError:  # torch < 2.1
+            pass
+    return module.load_state_dict(sd, strict=False)
+
+
+def load_split_models(config, ckpt_path):
+    """Instantiates UNet, CondStage and FirstStage from `config` and loads either a model.ckpt
+    or a directory written by convert()."""
+    tic = time.time()
+    if is_fast_ckpt(ckpt_path):
+        print(f"Loading fast checkpoint from {ckpt_path}")
+        sds = {stage: load_stage(os.path.join(ckpt_path, f"{stage}.safetensors"))[0] for stage in STAGES}
+        clip_dir = os.path.join(ckpt_path, CLIP_DIR)
+        if os.path.isdir(clip_dir):
+            config = OmegaConf.create(OmegaConf.to_container(config))
+            params = config.modelCondStage.params.cond_stage_config.setdefault("params", {})
+            params["version"] = clip_dir
+            params["pretrained"] = False
+    else:
+        sd = load_model_from_config(ckpt_path)
+        sds = split_state_dict(sd)
+        del sd
+
+    model = instantiate_from_config(config.modelUNet)
+    load_into(model, sds.pop("unet"))
+    model.eval()
+
+    modelCS = instantiate_from_config(config.modelCondStage)
+    load_into(modelCS, sds.pop("cond_stage"))
+    modelCS.eval()
+
+    modelFS = instantiate_from_config(config.modelFirstStage)
+    load_into(modelFS, sds.pop("first_stage"))
+    modelFS.eval()
+    print(f"models loaded in {time.time() - tic:.2f} seconds")
+    return model, modelCS, modelFS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert a model.ckpt into the pre-split fast format")
+    parser.add_argument("--ckpt_path", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                        help="checkpoint path")
+    parser.add_argument("--out_dir", type=str, default="models/ldm/stable-diffusion-v1/model-fast",
+                        help="output directory")
+    parser.add_argument("--config_path", type=str, default="optimizedSD/v1-inference.yaml", help="config path")
+    parser.add_argument("--half", action="store_true", help="store the floating point weights in fp16")
+    opt = parser.parse_args()
+    convert(opt.ckpt_path, opt.out_dir, opt.config_path, opt.half)
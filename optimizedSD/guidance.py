@@ -0,0 +1,77 @@
+"""
+When the unconditional half of classifier-free guidance is evaluated.
+
+Guidance doubles the unet batch at every step, so it is half of the sampling compute. A GuidancePolicy passed to
+UNet.sample() can cut that down in two ways:
+- interval=(start, end): guidance only for the steps whose position start <= step / steps < end, the other steps use
+  the plain conditional prediction, e.g. (0, 0.7) drops guidance for the last 30% of the steps.
+- uncond_every=k: inside the interval the uncond branch only runs every k-th step, the steps in between use the
+  conditional prediction plus the (cond - uncond) difference of the last full step.
+
+The default policy guides every step and changes nothing.
+"""
+
+
+class GuidancePolicy:
+
+    def __init__(self, interval=(0., 1.), uncond_every=1):
+        start, end = interval
+        if not 0. <= start <= end <= 1.:
+            raise ValueError(f"the guidance interval must satisfy 0 <= start <= end <= 1, got {interval}")
+        if uncond_every < 1:
+            raise ValueError(f"uncond_every must be at least 1, got {uncond_every}")
+        self.interval = (float(start), float(end))
+        self.uncond_every = int(uncond_every)
+        self.start(0)
+
+    @property
+    def active(self):
+        return self.interval != (0., 1.) or self.uncond_every > 1
+
+    def start(self, total_steps):
+        """called by a sampler before its first step"""
+        self.total_steps = total_steps
+        self.step = 0
+        self.delta = None
+        self.last_full_step = None
+        self.per_step = []  # [step, unet evaluations, evaluations saved] per sampler step
+
+    def begin_step(self, step):
+        self.step = step
+
+    def mode(self):
+        """'cfg' (cond and uncond), 'reuse' (cond plus the cached difference) or 'cond' (no guidance)"""
+        start, end = self.interval
+        position = self.step / max(self.total_steps, 1)
+        if not start <= position < end:
+            return "cond"
+        if self.uncond_every == 1 or self.delta is None:
+            return "cfg"
+        if self.step == self.last_full_step or self.step - self.last_full_step >= self.uncond_every:
+            return "cfg"
+        return "reuse"
+
+    def store(self, e_t_uncond, e_t):
+        """keeps cond - uncond of a full step for the reuse steps after it"""
+        self.last_full_step = self.step
+        if self.uncond_every > 1:
+            self.delta = e_t - e_t_uncond
+
+    def record(self, mode, batch):
+        evals, saved = (2 * batch, 0) if mode == "cfg" else (batch, batch)
+        if self.per_step and self.per_step[-1][0] == self.step:
+            self.per_step[-1][1] += evals
+            self.per_step[-1][2] += saved
+        else:
+            self.per_step.append([self.step, evals, saved])
+
+    def stats(self):
+        evals = sum(s[1] for s in self.per_step)
+        saved = sum(s[2] for s in self.per_step)
+        return dict(steps=len(self.per_step), unet_evals=evals, saved_evals=saved,
+                    saved_fraction=saved / (evals + saved) if evals + saved else 0.)
+
+    def summary(self):
+        stats = self.stats()
+        return (f"guidance: {stats['saved_evals']} of {stats['unet_evals'] + stats['saved_evals']} unet evaluations "
+                f"skipped ({100 * stats['saved_fraction']:.0f}%)")
@@ -0,0 +1,368 @@
+"""
+Local http api for the generation models, to run next to the gradio ui.
+
+Loads the models once (like sd_daemon.py) and queues the submitted jobs. A single worker thread runs them one at a
+time on the shared models while the asyncio event loop keeps answering status requests and streaming progress.
+Compatible txt2img jobs that arrive close together are merged into one unet batch (see batching.py, --max_batch and
+--max_wait), /v1/health reports the batching throughput and latencies.
+
+Start it:
+    python optimizedSD/http_api.py --port 7862
+
+Endpoints, json in and out:
+    POST   /v1/txt2img | /v1/img2img | /v1/inpaint   submit a job -> {"id": ..., "status": "queued"}
+    GET    /v1/jobs                                   all known jobs
+    GET    /v1/jobs/<id>                              status, step progress and, once done, the result
+    GET    /v1/jobs/<id>/events                       server-sent events with the progress until the job ends
+    GET    /v1/jobs/<id>/images/<n>                   the n-th image of a finished job
+    DELETE /v1/jobs/<id>                              cancel a queued job
+    GET    /v1/health                                 queue length and model stats
+
+The job fields are those of sd_daemon.py's DEFAULT_JOB. img2img and inpaint jobs send the input image as base64 in
+"init_image", inpaint jobs also the mask in "mask" (white where the image is regenerated).
+
+    curl -s localhost:7862/v1/txt2img -d '{"prompt": "an apple", "n_samples": 2}'
+    curl -N localhost:7862/v1/jobs/<id>/events
+    curl -so apple.png localhost:7862/v1/jobs/<id>/images/0
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import io
+import json
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from batching import BatchScheduler
+from sd_daemon import DEFAULT_JOB, GenerationService, add_model_args
+
+DEFAULT_PORT = 7862
+MAX_BODY = 64 * 1024 * 1024
+FINISHED = ("done", "failed", "cancelled")
+# fields a client can't set, the server decides where the images go and returns them itself
+SERVER_FIELDS = ("outdir", "from_file", "return_bytes")
+# the type of the job fields that default to None, the others take the type of their default
+NULLABLE_TYPES = dict(seed=int, sigma_schedule=str, tile_size=int)
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.params = params
+        self.format = params.get("format", DEFAULT_JOB["format"])
+        self.n_iter = params.get("n_iter", DEFAULT_JOB["n_iter"])
+        self.status = "queued"
+        self.step, self.total_steps, self.runs = 0, 0, 0
+        self.result, self.error, self.images = None, None, []
+        self.created, self.started, self.finished = time.time(), None, None
+        # set and replaced on every change, a listener waits on the event it saw last
+        self.changed = asyncio.Event()
+
+    def touch(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def progress(self, step, total_steps):
+        """one sampler step, a job samples n_iter times"""
+        if step == 0:
+            self.runs += 1
+        self.step, self.total_steps = step + 1, total_steps
+        self.touch()
+
+    def describe(self):
+        info = dict(id=self.id, type=self.kind, status=self.status,
+                    progress=dict(step=self.step, total_steps=self.total_steps, run=self.runs,
+                                  runs=self.n_iter),
+                    created=self.created, started=self.started, finished=self.finished)
+        if self.result is not None:
+            info["result"] = {**self.result, "images": [f"/v1/jobs/{self.id}/images/{i}"
+                                                        for i in range(len(self.images))]}
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+def _decode_image(params, key):
+    try:
+        return io.BytesIO(base64.b64decode(params[key], validate=True))
+    except (binascii.Error, TypeError):
+        raise HttpError(400, f"'{key}' must be a base64 encoded image")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_type(key, value):
+    """HttpError(400) unless the job field has the type of its DEFAULT_JOB value, ints pass for floats"""
+    default = DEFAULT_JOB[key]
+    if value is None and default is None:
+        return
+    expected = NULLABLE_TYPES.get(key, type(default))
+    if expected is float:
+        ok, name = _is_number(value), "a number"
+    elif expected is int:
+        ok, name = isinstance(value, int) and not isinstance(value, bool), "an integer"
+    elif expected is list:
+        ok = isinstance(value, list) and len(value) == len(default) and all(map(_is_number, value))
+        name = f"a list of {len(default)} numbers"
+    else:
+        ok, name = isinstance(value, expected), {bool: "a boolean", str: "a string"}[expected]
+    if not ok:
+        raise HttpError(400, f"'{key}' must be {name}")
+
+
+def parse_job(kind, body):
+    """the job dict for GenerationService.run() from a request body, HttpError(400) if it doesn't fit"""
+    try:
+        params = json.loads(body or b"{}")
+    except ValueError as e:
+        raise HttpError(400, f"invalid json: {e}")
+    if not isinstance(params, dict):
+        raise HttpError(400, "the job must be a json object")
+    unknown = (set(params) - set(DEFAULT_JOB)) | (set(params) & set(SERVER_FIELDS))
+    if unknown:
+        raise HttpError(400, f"unknown job arguments: {sorted(unknown)}")
+    for key, value in params.items():
+        if key not in ("init_image", "mask"):  # base64 images, checked when they are decoded
+            _check_type(key, value)
+    needs = dict(txt2img=(), img2img=("init_image",), inpaint=("init_image", "mask"))[kind]
+    for key in ("init_image", "mask"):
+        if key in needs and params.get(key) is None:
+            raise HttpError(400, f"{kind} jobs need '{key}'")
+        if key not in needs and params.get(key) is not None:
+            raise HttpError(400, f"{kind} jobs don't take '{key}'")
+        if key in needs:
+            params[key] = _decode_image(params, key)
+    params["return_bytes"] = True
+    return params
+
+
+class ApiServer:
+
+    def __init__(self, service, max_queue=32, keep_jobs=100, scheduler=None):
+        self.service = service
+        self.scheduler = scheduler if scheduler is not None else BatchScheduler(max_batch=1)
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.queue = asyncio.Queue(max_queue)
+        # the models are shared, so one thread runs every job
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sampler")
+
+    async def worker(self):
+        while True:
+            for jobs in await self.scheduler.collect(self.queue):
+                jobs = [job for job in jobs if job.status == "queued"]  # cancelled while it waited
+                if jobs:
+                    try:
+                        await self.run(jobs)
+                    except Exception as e:
+                        # only this batch fails, the worker goes on with the next one
+                        self.fail(jobs, e)
+            self.prune()
+
+    @staticmethod
+    def fail(jobs, error):
+        finished = time.time()
+        for job in jobs:
+            if job.status not in FINISHED:
+                job.error, job.status = f"{type(error).__name__}: {error}", "failed"
+                job.params = None
+                job.finished = finished
+                job.touch()
+
+    async def run(self, jobs):
+        """runs the jobs as one batch in the worker thread"""
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        for job in jobs:
+            job.status, job.started = "running", started
+            job.touch()
+
+        def progress(step, total_steps):
+            for job in jobs:
+                loop.call_soon_threadsafe(job.progress, step, total_steps)
+
+        params = [job.params for job in jobs]
+        samples = sum(map(self.scheduler.samples, jobs))
+        try:
+            if len(jobs) == 1:
+                results = [await loop.run_in_executor(self.executor, self.service.run, params[0], progress)]
+            else:
+                results = await loop.run_in_executor(self.executor, self.service.run_batch, params, progress)
+        except Exception as e:
+            results = [e] * len(jobs)
+        finished = time.time()
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                job.error, job.status = f"{type(result).__name__}: {result}", "failed"
+            else:
+                job.images = [base64.b64decode(data) for data in result.pop("images")]
+                job.result, job.status = result, "done"
+            job.params = None  # drop the decoded input images
+            job.finished = finished
+            job.touch()
+        self.scheduler.metrics.record([job.created for job in jobs], started, finished, samples)
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+            del self.jobs[job_id]
+
+    def job(self, job_id):
+        if job_id not in self.jobs:
+            raise HttpError(404, f"no job {job_id}")
+        return self.jobs[job_id]
+
+    def submit(self, kind, body):
+        job = Job(kind, parse_job(kind, body))
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HttpError(503, "the job queue is full")
+        self.jobs[job.id] = job
+        return dict(id=job.id, status=job.status, queued=self.queue.qsize())
+
+    def cancel(self, job_id):
+        job = self.job(job_id)
+        if job.status == "running":
+            raise HttpError(409, "the job is already running")
+        if job.status == "queued":
+            job.status, job.finished = "cancelled", time.time()
+            job.params = None
+            job.touch()
+        return job.describe()
+
+    def health(self):
+        running = [job.id for job in self.jobs.values() if job.status == "running"]
+        return dict(ok=True, queued=self.queue.qsize(), running=running, batching=self.scheduler.metrics.stats(),
+                    **self.service.stats())
+
+    async def dispatch(self, writer, method, path, body):
+        """answers one request, returns False when the connection has to close afterwards"""
+        m = re.fullmatch(r"/v1/(txt2img|img2img|inpaint)", path)
+        if m and method == "POST":
+            return await respond(writer, 202, self.submit(m.group(1), body))
+        if path == "/v1/jobs" and method == "GET":
+            return await respond(writer, 200, [job.describe() for job in self.jobs.values()])
+        if path == "/v1/health" and method == "GET":
+            return await respond(writer, 200, self.health())
+        m = re.fullmatch(r"/v1/jobs/(\w+)(/events|/images/(\d+))?", path)
+        if m and method == "GET" and m.group(2) is None:
+            return await respond(writer, 200, self.job(m.group(1)).describe())
+        if m and method == "DELETE" and m.group(2) is None:
+            return await respond(writer, 200, self.cancel(m.group(1)))
+        if m and method == "GET" and m.group(2) == "/events":
+            await stream_events(writer, self.job(m.group(1)))
+            return False
+        if m and method == "GET" and m.group(3) is not None:
+            job, n = self.job(m.group(1)), int(m.group(3))
+            if job.status != "done":
+                raise HttpError(409, f"the job is {job.status}")
+            if n >= len(job.images):
+                raise HttpError(404, f"the job has {len(job.images)} images")
+            content_type = "image/png" if job.format == "png" else "image/jpeg"
+            return await respond(writer, 200, body=job.images[n], content_type=content_type)
+        raise HttpError(404, f"no route {method} {path}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await respond(writer, 413, dict(ok=False, error="request body too large"))
+                    break
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    keep_open = await self.dispatch(writer, method.upper(), urlsplit(target).path, body)
+                except HttpError as e:
+                    keep_open = await respond(writer, e.status, dict(ok=False, error=str(e)))
+                if not keep_open or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def respond(writer, status, payload=None, body=b"", content_type="application/json"):
+    if payload is not None:
+        body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+    return True
+
+
+async def stream_events(writer, job):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                 b"Connection: close\r\n\r\n")
+    while True:
+        changed = job.changed  # taken before writing, so no change in between is missed
+        writer.write(f"event: {job.status}\ndata: {json.dumps(job.describe())}\n\n".encode("utf-8"))
+        await writer.drain()
+        if job.status in FINISHED:
+            return
+        await changed.wait()
+
+
+async def main(opt):
+    loop = asyncio.get_running_loop()
+    # loading the checkpoint blocks for a while, keep it off the loop like the jobs
+    service = await loop.run_in_executor(None, GenerationService, opt)
+    api = ApiServer(service, max_queue=opt.max_queue, keep_jobs=opt.keep_jobs,
+                    scheduler=BatchScheduler(max_batch=opt.max_batch, max_wait=opt.max_wait / 1000))
+    worker = asyncio.create_task(api.worker())
+    server = await asyncio.start_server(api.handle, opt.host, opt.port)
+    print(f"http api listening on http://{opt.host}:{opt.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+        api.executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="local http api for SD generation jobs")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to bind")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to bind")
+    parser.add_argument("--max_queue", type=int, default=32, help="jobs that can wait before submits are refused")
+    parser.add_argument("--keep_jobs", type=int, default=100,
+                        help="finished jobs (and their images) kept in memory for the clients to fetch")
+    parser.add_argument("--max_batch", type=int, default=4,
+                        help="samples of compatible txt2img jobs that run as one unet batch, 1 disables batching")
+    parser.add_argument("--max_wait", type=float, default=50,
+                        help="milliseconds to wait for more jobs to batch with the first one")
+    add_model_args(parser)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -21,7 +21,9 @@ from tqdm import tqdm, trange
 from transformers import logging
 
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from fast_ckpt import load_split_models
+from optimUtils import logger
+from residency import stage_residency
 
 logging.set_verbosity_error()
 
@@ -103,6 +105,7 @@ def generate(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     if device != "cpu" and full_precision == False:
         model.half()
@@ -121,16 +124,12 @@ def generate(
     assert prompt is not None
     data = [batch_size * [prompt]]
 
-    modelFS.to(device)
+    stages.acquire("modelFS")
 
     init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
     init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
 
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
+    stages.release("modelFS")
 
     assert 0.0 <= strength <= 1.0, "can only work with strength in [0.0, 1.0]"
     t_enc = int(strength * ddim_steps)
@@ -147,31 +146,16 @@ def generate(
         for _ in trange(n_iter, desc="Sampling"):
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
-                    modelCS.to(device)
+                    stages.acquire("modelCS")
                     uc = None
                     if scale != 1.0:
                         uc = modelCS.get_learned_conditioning(batch_size * [""])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
 
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
-
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    c = modelCS.get_weighted_conditioning(prompts)
+
+                    stages.release("modelCS")
 
                     # encode (scaled latent)
                     true_z_enc = model.stochastic_encode(
@@ -186,7 +170,7 @@ def generate(
                         unconditional_conditioning=uc,
                         sampler=sampler
                     )
-                    modelFS.to(device)
+                    stages.acquire("modelFS")
                     print("saving images")
                     all_time_samples = []
                     for ij in range(n_interpolate_samples):
@@ -207,11 +191,7 @@ def generate(
                         grid = make_grid(grid, nrow=n_iter)
                         grid = 255.0 * rearrange(grid, "c h w -> h w c").cpu().numpy()
                         all_time_samples.append(Image.fromarray(grid.astype(np.uint8)))
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelFS")
 
                     del samples_ddim
                     del x_sample
@@ -234,38 +214,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     config = args.config_path
     ckpt = args.ckpt_path
-    sd = load_model_from_config(f"{ckpt}")
-    li, lo = [], []
-    for key, v_ in sd.items():
-        sp = key.split(".")
-        if (sp[0]) == "model":
-            if "input_blocks" in sp:
-                li.append(key)
-            elif "middle_block" in sp:
-                li.append(key)
-            elif "time_embed" in sp:
-                li.append(key)
-            else:
-                lo.append(key)
-    for key in li:
-        sd["model1." + key[6:]] = sd.pop(key)
-    for key in lo:
-        sd["model2." + key[6:]] = sd.pop(key)
-
     config = OmegaConf.load(f"{config}")
-
-    model = instantiate_from_config(config.modelUNet)
-    _, _ = model.load_state_dict(sd, strict=False)
-    model.eval()
-
-    modelCS = instantiate_from_config(config.modelCondStage)
-    _, _ = modelCS.load_state_dict(sd, strict=False)
-    modelCS.eval()
-
-    modelFS = instantiate_from_config(config.modelFirstStage)
-    _, _ = modelFS.load_state_dict(sd, strict=False)
-    modelFS.eval()
-    del sd
+    model, modelCS, modelFS = load_split_models(config, ckpt)
 
     demo = gr.Interface(
         fn=generate,
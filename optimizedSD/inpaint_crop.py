@@ -0,0 +1,83 @@
+"""
+Inpainting that only samples the part of the canvas the mask touches.
+
+The latent is cropped to the bounding box of the regenerated region plus a margin of context, the crop is sampled
+with the usual mask blending, only the crop is decoded, and it is pasted back into the original image with a
+feathered seam. The cost then follows the mask area instead of the canvas size.
+
+Masks use the sampler convention: 1 keeps the original, 0 is regenerated.
+"""
+import torch
+
+
+def _snap(lo, hi, size, multiple):
+    # grow [lo, hi) to a multiple of `multiple` around its center, inside [0, size)
+    length = min(size, -(-(hi - lo) // multiple) * multiple)
+    lo = min(max(0, lo - (length - (hi - lo)) // 2), size - length)
+    return lo, lo + length
+
+
+def mask_box(mask, margin=8, multiple=8):
+    """
+    (top, bottom, left, right) in latent pixels around everything the [b, c, h, w] mask regenerates, grown by
+    `margin` and rounded out to `multiple` (the unet needs multiples of 8). None if the mask keeps everything.
+    """
+    region = (mask < 0.99).flatten(0, -3).any(0)
+    rows, cols = torch.nonzero(region.any(1)).flatten(), torch.nonzero(region.any(0)).flatten()
+    if rows.numel() == 0:
+        return None
+    h, w = region.shape
+    top, bottom = _snap(max(0, int(rows[0]) - margin), min(h, int(rows[-1]) + 1 + margin), h, multiple)
+    left, right = _snap(max(0, int(cols[0]) - margin), min(w, int(cols[-1]) + 1 + margin), w, multiple)
+    return top, bottom, left, right
+
+
+def _ramp(size, feather, start_open, end_open):
+    # 1 inside, ramping down to 0 over `feather` pixels at the ends that don't touch the canvas border
+    r = torch.ones(size)
+    feather = min(feather, size // 2)
+    steps = (torch.arange(feather, dtype=torch.float32) + 1) / (feather + 1)
+    if start_open:
+        r[:feather] = steps
+    if end_open:
+        r[size - feather:] = steps.flip(0)
+    return r
+
+
+class MaskCrop:
+    """
+    crop = MaskCrop(mask, margin=8)
+    samples = model.sample(..., x0=crop.crop(init_latent), mask=crop.crop(mask))
+    images = crop.paste(original, modelFS.decode_samples(samples, to_uint8=False))
+    """
+
+    def __init__(self, mask, margin=8, multiple=8):
+        self.canvas = tuple(mask.shape[-2:])
+        self.box = mask_box(mask, margin, multiple)
+        if self.box is None:
+            # nothing to regenerate, keep the whole canvas so the caller doesn't need a special case
+            self.box = (0, self.canvas[0], 0, self.canvas[1])
+
+    @property
+    def is_full(self):
+        return self.box == (0, self.canvas[0], 0, self.canvas[1])
+
+    def crop(self, x, scale=1):
+        """the box of a [..., h, w] tensor, scale is the size of one latent pixel in x (8 for images)"""
+        top, bottom, left, right = (v * scale for v in self.box)
+        return x[..., top:bottom, left:right]
+
+    def paste(self, image, patch, scale=8, feather=32):
+        """
+        `patch` (the decoded crop) blended into a copy of `image`, both [b, c, h, w] floats, with a seam that ramps
+        over `feather` pixels inside the box. The margin only holds context, so the ramp runs through kept pixels.
+        """
+        top, bottom, left, right = (v * scale for v in self.box)
+        height, width = self.canvas[0] * scale, self.canvas[1] * scale
+        weight = (_ramp(bottom - top, feather, top > 0, bottom < height)[:, None]
+                  * _ramp(right - left, feather, left > 0, right < width)[None, :])
+        weight = weight.to(patch.device, patch.dtype)
+        out = image.to(patch.device, patch.dtype).clone()
+        region = out[..., top:bottom, left:right]
+        out[..., top:bottom, left:right] = region + (patch - region) * weight
+        return out
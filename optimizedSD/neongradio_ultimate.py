@@ -42,7 +42,9 @@ from tqdm import tqdm, trange
 from transformers import logging as transformers_logging
 
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts
+from fast_ckpt import load_split_models
+from inpaint_crop import MaskCrop
+from residency import stage_residency
 
 from basicsr.utils import img2tensor, tensor2img
 from basicsr.utils.download_util import load_file_from_url
@@ -154,6 +156,8 @@ def generate_img2img(
         full_precision,
         sampler,
         speed_mp,
+        mask_crop=False,
+        crop_margin=64,
 ):
     torch.cuda.empty_cache()
     gc.collect()
@@ -166,6 +170,7 @@ def generate_img2img(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     try:
         seed = int(seed)
@@ -189,7 +194,7 @@ def generate_img2img(
     assert prompt is not None
     data = [batch_size * [prompt]]
 
-    modelFS.to(device)
+    stages.acquire("modelFS")
 
     init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
     init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
@@ -205,11 +210,19 @@ def generate_img2img(
         if device != "cpu" and not full_precision:
             mask = mask.half().to(device)
 
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
+    crop = None
+    if use_mask and mask_crop:
+        # only sample the box around the masked area, the rest of the image is kept as it is
+        crop = MaskCrop(mask, margin=int(crop_margin) // 8)
+        if crop.is_full:
+            crop = None
+        else:
+            print(f"sampling the latent box {crop.box} of {tuple(init_latent.shape[2:])}")
+            original = (init_image + 1.0) / 2.0
+            init_latent = crop.crop(init_latent)
+            mask = crop.crop(mask)
+
+    stages.release("modelFS")
 
     assert 0.0 <= strength <= 1.0, "can only work with strength in [0.0, 1.0]"
     t_enc = int(strength * ddim_steps)
@@ -226,7 +239,7 @@ def generate_img2img(
         for _ in trange(n_iter, desc="Sampling"):
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
-                    modelCS.to(device)
+                    stages.acquire("modelCS")
                     uc = None
                     if scale != 1.0:
                         uc = modelCS.get_learned_conditioning(
@@ -234,24 +247,9 @@ def generate_img2img(
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
 
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c = modelCS.get_weighted_conditioning(prompts)
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelCS")
 
                     # encode (scaled latent)
                     z_enc = model.stochastic_encode(
@@ -286,29 +284,27 @@ def generate_img2img(
                         callback_fn=callback_fn
                     )
 
-                    modelFS.to(device)
+                    stages.acquire("modelFS")
                     print("saving images")
-                    for i in range(batch_size):
-                        x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
-                        x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        all_samples.append(x_sample.to("cpu"))
-                        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-                        Image.fromarray(x_sample.astype(np.uint8)).save(
+                    if crop is None:
+                        x_samples = modelFS.decode_samples(samples_ddim)
+                    else:
+                        patch = modelFS.decode_samples(samples_ddim, to_uint8=False)
+                        x_samples = crop.paste(original, patch)
+                        x_samples = (255.0 * x_samples).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+                    all_samples.append(x_samples.permute(0, 3, 1, 2))
+                    for x_sample in x_samples.numpy():
+                        Image.fromarray(x_sample).save(
                             os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{base_count:05}.{img_format}")
                         )
                         seeds += str(seed) + ","
                         seed += 1
                         base_count += 1
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelFS")
 
                     del samples_ddim
-                    del x_sample
-                    del x_samples_ddim
+                    del x_samples
                     print("memory_final = ", torch.cuda.memory_allocated() / 1e6)
 
     toc = time.time()
@@ -316,7 +312,7 @@ def generate_img2img(
     time_taken = (toc - tic) / 60.0
     grid = torch.cat(all_samples, 0)
     grid = make_grid(grid, nrow=n_iter)
-    grid = 255.0 * rearrange(grid, "c h w -> h w c").cpu().numpy()
+    grid = rearrange(grid, "c h w -> h w c").numpy()
 
     txt = (
             "Samples finished in "
@@ -362,6 +358,7 @@ def generate_img2img_interp(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     try:
         seed = int(seed)
@@ -384,15 +381,11 @@ def generate_img2img_interp(
     assert prompt is not None
     data = [batch_size * [prompt]]
 
-    modelFS.to(device)
+    stages.acquire("modelFS")
 
     init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
     init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
-    if device != "cpu":
-        mem = torch.cuda.memory_allocated() / 1e6
-        modelFS.to("cpu")
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
+    stages.release("modelFS")
 
     assert 0.0 <= strength <= 1.0, "can only work with strength in [0.0, 1.0]"
     t_enc = int(strength * ddim_steps)
@@ -408,31 +401,16 @@ def generate_img2img_interp(
         for _ in trange(n_iter, desc="Sampling"):
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
-                    modelCS.to(device)
+                    stages.acquire("modelCS")
                     uc = None
                     if scale != 1.0:
                         uc = modelCS.get_learned_conditioning(batch_size * [""])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
 
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c = modelCS.get_weighted_conditioning(prompts)
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelCS")
 
                     # encode (scaled latent)
                     true_z_enc = model.stochastic_encode(
@@ -448,7 +426,7 @@ def generate_img2img_interp(
                         sampler=sampler,
                         speed_mp=speed_mp
                     )
-                    modelFS.to(device)
+                    stages.acquire("modelFS")
                     print("decoding frames")
                     all_time_samples = []
                     for ij in tqdm(range(n_interpolate_samples)):
@@ -469,11 +447,7 @@ def generate_img2img_interp(
                         grid = make_grid(grid, nrow=n_iter)
                         grid = 255.0 * rearrange(grid, "c h w -> h w c").cpu().numpy()
                         all_time_samples.append(Image.fromarray(grid.astype(np.uint8)))
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelFS")
 
                     del samples_ddim
                     del x_sample
@@ -519,6 +493,7 @@ def generate_double_triple(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     if seed == "":
         seed = randint(0, 1000000)
@@ -551,33 +526,18 @@ def generate_double_triple(
         all_samples = list()
         for prompts in tqdm(data, desc="data"):
             with precision_scope("cuda"):
-                modelCS.to(device)
+                stages.acquire("modelCS")
                 uc = None
                 if scale != 1.0:
                     uc = modelCS.get_learned_conditioning(1 * [""])
                 if isinstance(prompts, tuple):
                     prompts = list(prompts)
 
-                subprompts, weights = split_weighted_subprompts(prompts[0])
-                if len(subprompts) > 1:
-                    c = torch.zeros_like(uc)
-                    totalWeight = sum(weights)
-                    # normalize each "sub prompt" and add it
-                    for i in range(len(subprompts)):
-                        weight = weights[i]
-                        # if not skip_normalize:
-                        weight = weight / totalWeight
-                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                else:
-                    c = modelCS.get_learned_conditioning(prompts)
+                c = modelCS.get_weighted_conditioning(prompts)
 
                 shape = [1, C, Height // f, Width // f]
 
-                if device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelCS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelCS")
 
                 samples_ddim = model.sample(
                     S=ddim_steps,
@@ -593,7 +553,7 @@ def generate_double_triple(
                     speed_mp=speed_mp
                 )
 
-                modelFS.to(device)
+                stages.acquire("modelFS")
 
                 x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
                 x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -609,7 +569,7 @@ def generate_double_triple(
                     "1 ... -> b ...", b=1)
                 init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
 
-                modelFS.cpu()
+                stages.release("modelFS")
                 model.to(device)
 
                 z_enc = model.stochastic_encode(
@@ -627,9 +587,9 @@ def generate_double_triple(
                     speed_mp=speed_mp
                 )
 
-                modelFS.to(device)
+                stages.acquire("modelFS")
                 model.cpu()
-                modelCS.to("cpu")
+                stages.release("modelCS")
                 torch.cuda.empty_cache()
 
                 x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
@@ -648,7 +608,7 @@ def generate_double_triple(
                         "1 ... -> b ...", b=1)
                     init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
 
-                    modelFS.cpu()
+                    stages.release("modelFS")
                     model.to(device)
 
                     z_enc = model.stochastic_encode(
@@ -668,7 +628,7 @@ def generate_double_triple(
 
                     print("saving images")
                     model.cpu()
-                    modelFS.to(device)
+                    stages.acquire("modelFS")
 
                     x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
                     x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -678,11 +638,7 @@ def generate_double_triple(
                         os.path.join(sample_path, "seed_" + str(seed) + "_step3_" + f"{base_count:05}.{img_format}")
                     )
 
-                if device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelFS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelFS")
 
                 del samples_ddim
                 del x_sample
@@ -852,6 +808,7 @@ def generate_txt2img(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     if seed == "":
         seed = randint(0, 1000000)
@@ -885,7 +842,7 @@ def generate_txt2img(
         for _ in trange(n_iter, desc="Sampling"):
             for prompts in tqdm(data, desc="data"):
                 with precision_scope("cuda"):
-                    modelCS.to(device)
+                    stages.acquire("modelCS")
                     uc = None
                     if scale != 1.0:
                         uc = modelCS.get_learned_conditioning(
@@ -893,26 +850,11 @@ def generate_txt2img(
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
 
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c = modelCS.get_weighted_conditioning(prompts)
 
                     shape = [batch_size, C, Height // f, Width // f]
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelCS")
                     samples_ddim = model.sample(
                         S=ddim_steps,
                         conditioning=c,
@@ -928,30 +870,23 @@ def generate_txt2img(
                         callback_fn=callback_fn
                     )
 
-                    modelFS.to(device)
+                    stages.acquire("modelFS")
                     model.cpu()
                     logging.info("saving images")
-                    for i in range(batch_size):
-                        x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
-                        x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        all_samples.append(x_sample.to("cpu"))
-                        x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
-                        Image.fromarray(x_sample.astype(np.uint8)).save(
+                    x_samples = modelFS.decode_samples(samples_ddim)
+                    all_samples.append(x_samples.permute(0, 3, 1, 2))
+                    for x_sample in x_samples.numpy():
+                        Image.fromarray(x_sample).save(
                             os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{base_count:05}.{img_format}")
                         )
                         seeds += str(seed) + ","
                         seed += 1
                         base_count += 1
 
-                    if device != "cpu":
-                        mem = torch.cuda.memory_allocated() / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated() / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelFS")
 
                     del samples_ddim
-                    del x_sample
-                    del x_samples_ddim
+                    del x_samples
                     logging.info(str("memory_final = " + str(torch.cuda.memory_allocated() / 1e6)))
 
     toc = time.time()
@@ -959,7 +894,7 @@ def generate_txt2img(
     time_taken = (toc - tic) / 60.0
     grid = torch.cat(all_samples, 0)
     grid = make_grid(grid, nrow=n_iter)
-    grid = 255.0 * rearrange(grid, "c h w -> h w c").cpu().numpy()
+    grid = rearrange(grid, "c h w -> h w c").numpy()
     txt = (
             "Samples finished in "
             + str(round(time_taken, 3))
@@ -1069,38 +1004,8 @@ if __name__ == '__main__':
 
     config = args.config_path
     ckpt = args.ckpt_path
-    sd = load_model_from_config(f"{ckpt}")
-    li, lo = [], []
-    for key, v_ in sd.items():
-        sp = key.split(".")
-        if (sp[0]) == "model":
-            if "input_blocks" in sp:
-                li.append(key)
-            elif "middle_block" in sp:
-                li.append(key)
-            elif "time_embed" in sp:
-                li.append(key)
-            else:
-                lo.append(key)
-    for key in li:
-        sd["model1." + key[6:]] = sd.pop(key)
-    for key in lo:
-        sd["model2." + key[6:]] = sd.pop(key)
-
     config = OmegaConf.load(f"{config}")
-
-    model = instantiate_from_config(config.modelUNet)
-    _, _ = model.load_state_dict(sd, strict=False)
-    model.eval()
-
-    modelCS = instantiate_from_config(config.modelCondStage)
-    _, _ = modelCS.load_state_dict(sd, strict=False)
-    modelCS.eval()
-
-    modelFS = instantiate_from_config(config.modelFirstStage)
-    _, _ = modelFS.load_state_dict(sd, strict=False)
-    modelFS.eval()
-    del sd
+    model, modelCS, modelFS = load_split_models(config, ckpt)
 
     demo = gr.Blocks()
 
@@ -1142,7 +1047,8 @@ if __name__ == '__main__':
                                 gr.Checkbox(value=True, label="Turbo mode (better leave this on)"),
                                 gr.Checkbox(label="Full precision mode (practically does nothing)"),
                                 gr.Radio(
-                                    ["ddim", "plms", "k_dpm_2_a", "k_dpm_2", "k_euler_a", "k_euler", "k_heun", "k_lms"],
+                                    ["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_dpm_2_a", "k_dpm_2", "k_euler_a",
+                                     "k_euler", "k_heun", "k_lms"],
                                     value="plms", label="Sampler"),
                                 gr.Checkbox(value=False,
                                             label="Lightning Attention (only on linux + xformers installed)"),
@@ -1188,7 +1094,8 @@ if __name__ == '__main__':
                                 gr.Checkbox(value=True, label="Turbo mode (better leave this on)"),
                                 gr.Checkbox(label="Full precision mode (practically does nothing)"),
                                 gr.Radio(
-                                    ["ddim", "plms", "k_dpm_2_a", "k_dpm_2", "k_euler_a", "k_euler", "k_heun", "k_lms"],
+                                    ["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_dpm_2_a", "k_dpm_2", "k_euler_a",
+                                     "k_euler", "k_heun", "k_lms"],
                                     value="ddim", label="Sampler"),
                                 gr.Checkbox(value=False,
                                             label="Lightning Attention (only on linux + xformers installed)"),
@@ -1234,10 +1141,13 @@ if __name__ == '__main__':
                                 gr.Checkbox(value=True, label="Turbo mode (better leave this on)"),
                                 gr.Checkbox(label="Full precision mode (practically does nothing)"),
                                 gr.Radio(
-                                    ["ddim", "plms", "k_dpm_2_a", "k_dpm_2", "k_euler_a", "k_euler", "k_heun", "k_lms"],
+                                    ["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_dpm_2_a", "k_dpm_2", "k_euler_a",
+                                     "k_euler", "k_heun", "k_lms"],
                                     value="ddim", label="Sampler"),
                                 gr.Checkbox(value=False,
                                             label="Lightning Attention (only on linux + xformers installed)"),
+                                gr.Checkbox(value=True, label="Only sample the masked area"),
+                                gr.Slider(0, 512, value=64, step=8, label="Context around the masked area (pixels)"),
                             ], outputs=[out_image3, gen_res3])
                             b2.click(get_logs, inputs=[], outputs=outs2)
                             b3.click(get_nvidia_smi, inputs=[], outputs=outs3)
@@ -1275,7 +1185,8 @@ if __name__ == '__main__':
                                 gr.Checkbox(value=True, label="Turbo mode (better leave this on)"),
                                 gr.Checkbox(label="Full precision mode (practically does nothing)"),
                                 gr.Radio(
-                                    ["ddim", "plms", "k_dpm_2_a", "k_dpm_2", "k_euler_a", "k_euler", "k_heun", "k_lms"],
+                                    ["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_dpm_2_a", "k_dpm_2", "k_euler_a",
+                                     "k_euler", "k_heun", "k_lms"],
                                     value="ddim", label="Sampler"),
                                 gr.Checkbox(value=False,
                                             label="Lightning Attention (only on linux + xformers installed)"),
@@ -1319,7 +1230,8 @@ if __name__ == '__main__':
                                 gr.Checkbox(value=True, label="Turbo mode (better leave this on)"),
                                 gr.Checkbox(label="Full precision mode (practically does nothing)"),
                                 gr.Radio(
-                                    ["ddim", "plms", "k_dpm_2_a", "k_dpm_2", "k_euler_a", "k_euler", "k_heun", "k_lms"],
+                                    ["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_dpm_2_a", "k_dpm_2", "k_euler_a",
+                                     "k_euler", "k_heun", "k_lms"],
                                     value="plms", label="Sampler"),
                                 gr.Checkbox(value=False,
                                             label="Lightning Attention (only on linux + xformers installed)"),
@@ -429,6 +429,7 @@ class UNetModelEncode(nn.Module):
             n_embed=None,  # custom support for prediction of discrete ids into codebook of first stage vq model
             legacy=True,
             superfastmode=True,
+            attn_backend="auto",
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -520,7 +521,8 @@ class UNetModelEncode(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim,
+                attn_backend=attn_backend, downsample=ds
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -575,7 +577,8 @@ class UNetModelEncode(nn.Module):
                 num_head_channels=dim_head,
                 use_new_attention_order=use_new_attention_order,
             ) if not use_spatial_transformer else SpatialTransformer(
-                ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim
+                ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim,
+                attn_backend=attn_backend, downsample=ds
             ),
             ResBlock(
                 ch,
@@ -588,30 +591,34 @@ class UNetModelEncode(nn.Module):
         )
         self._feature_size += ch
 
-    def forward(self, x, timesteps=None, context=None, speed_mp=None, y=None):
+    def forward(self, x, timesteps=None, context=None, speed_mp=None, y=None, emb=None, depth=None):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param context: conditioning plugged in via crossattn
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param emb: the time embedding of `timesteps`, if it was precomputed.
+        :param depth: only run this many input blocks and skip the middle block (deep cache steps).
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert (y is not None) == (
                 self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        if emb is None:
+            t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+            emb = self.time_embed(t_emb)
 
         if self.num_classes is not None:
             emb = emb + self.label_emb(y)
 
         h = x.type(self.dtype)
-        for module in self.input_blocks:
+        for module in (self.input_blocks if depth is None else self.input_blocks[:depth]):
             h = module(h, emb, context, speed_mp)
             hs.append(h)
-        h = self.middle_block(h, emb, context, speed_mp)
+        if depth is None:
+            h = self.middle_block(h, emb, context, speed_mp)
 
         return h, emb, hs
 
@@ -645,6 +652,7 @@ class UNetModelDecode(nn.Module):
             n_embed=None,  # custom support for prediction of discrete ids into codebook of first stage vq model
             legacy=True,
             superfastmode=True,
+            attn_backend="auto",
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -746,7 +754,8 @@ class UNetModelDecode(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, superfastmode=superfastmode, depth=transformer_depth, context_dim=context_dim,
+                attn_backend=attn_backend, downsample=ds
                         )
                     )
                 if level and i == num_res_blocks:
@@ -781,21 +790,27 @@ class UNetModelDecode(nn.Module):
                 # nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
             )
 
-    def forward(self, h, emb, tp, hs, context=None, y=None, speed_mp=None):
+    def forward(self, h, emb, tp, hs, context=None, y=None, speed_mp=None, keep=None):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param context: conditioning plugged in via crossattn
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param keep: also return the input of the last `keep` output blocks, for the deep cache.
         :return: an [N x C x ...] Tensor of outputs.
+        With fewer skips than output blocks only the last len(hs) blocks run, h is then their input.
         """
-
-        for module in self.output_blocks:
+        first = len(self.output_blocks) - len(hs)
+        feature = None
+        for n in range(first, len(self.output_blocks)):
+            if keep is not None and n == len(self.output_blocks) - keep:
+                feature = h
             h = torch.cat([h, hs.pop()], dim=1)
-            h = module(h, emb, context, speed_mp=speed_mp)
+            h = self.output_blocks[n](h, emb, context, speed_mp=speed_mp)
         h = h.type(tp)
         if self.predict_codebook_ids:
-            return self.id_predictor(h)
+            out = self.id_predictor(h)
         else:
-            return self.out(h)
+            out = self.out(h)
+        return out if keep is None else (out, feature)
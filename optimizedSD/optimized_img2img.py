@@ -19,7 +19,11 @@ from tqdm import tqdm, trange
 from transformers import logging
 
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from deep_cache import DeepCache
+from fast_ckpt import load_split_models
+from guidance import GuidancePolicy
+from optimUtils import logger
+from residency import stage_residency
 
 logging.set_verbosity_error()
 
@@ -166,6 +170,40 @@ parser.add_argument(
     action="store_true",
     help="Reduces inference time on the expense of 1GB VRAM",
 )
+parser.add_argument(
+    "--legacy_noise",
+    action="store_true",
+    help="draw the noise from the global torch rng like older versions did, to reproduce their seeds",
+)
+parser.add_argument(
+    "--kv_cache",
+    action="store_true",
+    help="project the prompt for the cross-attention once per run instead of at every step",
+)
+parser.add_argument(
+    "--tome_ratio",
+    type=float,
+    help="merge this fraction of the tokens before the self-attention of the high resolution transformers "
+         "(token merging, 0 disables)",
+    default=0.,
+)
+parser.add_argument(
+    "--tome_max_downsample",
+    type=int,
+    choices=[1, 2, 4, 8],
+    help="merge tokens in the transformers down to this downsampling of the latent",
+    default=1,
+)
+parser.add_argument(
+    "--tome_ff",
+    action="store_true",
+    help="also merge the tokens before the feed forward layers",
+)
+parser.add_argument(
+    "--tiled_vae",
+    action="store_true",
+    help="encode/decode the image in overlapping tiles, for very large resolutions",
+)
 parser.add_argument(
     "--precision", type=str, help="evaluate at this precision", choices=["full", "autocast"], default="autocast"
 )
@@ -180,9 +218,72 @@ parser.add_argument(
     "--sampler",
     type=str,
     help="sampler",
-    choices=["ddim"],
+    choices=["ddim", "dpmpp_2m", "dpmpp_3s", "k_euler", "k_euler_a", "k_heun", "k_dpm_2", "k_dpm_2_a", "k_lms"],
     default="ddim",
 )
+parser.add_argument(
+    "--sigma_schedule",
+    type=str,
+    help="step schedule of the sigma-space samplers (default: karras for dpmpp, uniform for k_)",
+    choices=["karras", "uniform"],
+    default=None,
+)
+parser.add_argument(
+    "--guidance_interval",
+    type=float,
+    nargs=2,
+    help="only guide the steps in this fraction of the sampling, e.g. 0 0.7 drops guidance for the last 30%%",
+    default=[0., 1.],
+)
+parser.add_argument(
+    "--uncond_every",
+    type=int,
+    help="evaluate the unconditional branch every k steps and reuse its difference in between",
+    default=1,
+)
+parser.add_argument(
+    "--stop_threshold",
+    type=float,
+    help="stop ddim early once the x_0 prediction changes by less than this (relative l2) for --stop_patience "
+         "steps in a row, 0 disables",
+    default=0.,
+)
+parser.add_argument(
+    "--stop_patience",
+    type=int,
+    help="consecutive converged steps before stopping early",
+    default=3,
+)
+parser.add_argument(
+    "--deep_cache_interval",
+    type=int,
+    help="run the full unet every n steps and only its shallow blocks on cached deep features in between, 1 disables",
+    default=1,
+)
+parser.add_argument(
+    "--deep_cache_depth",
+    type=int,
+    help="number of input and output blocks that still run on the cached steps",
+    default=1,
+)
+parser.add_argument(
+    "--tile_size",
+    type=int,
+    help="sample the latent in overlapping windows of this many pixels, for canvases that don't fit at once",
+    default=None,
+)
+parser.add_argument(
+    "--tile_overlap",
+    type=int,
+    help="overlap of the sampling windows in pixels",
+    default=128,
+)
+parser.add_argument(
+    "--tile_batch",
+    type=int,
+    help="number of sampling windows that go through the unet together",
+    default=4,
+)
 opt = parser.parse_args()
 
 config = opt.config_path
@@ -200,45 +301,23 @@ seed_everything(opt.seed)
 # Logging
 logger(vars(opt), log_csv="logs/img2img_logs.csv")
 
-sd = load_model_from_config(f"{ckpt}")
-li, lo = [], []
-for key, value in sd.items():
-    sp = key.split(".")
-    if (sp[0]) == "model":
-        if "input_blocks" in sp:
-            li.append(key)
-        elif "middle_block" in sp:
-            li.append(key)
-        elif "time_embed" in sp:
-            li.append(key)
-        else:
-            lo.append(key)
-for key in li:
-    sd["model1." + key[6:]] = sd.pop(key)
-for key in lo:
-    sd["model2." + key[6:]] = sd.pop(key)
-
 config = OmegaConf.load(f"{config}")
+model, modelCS, modelFS = load_split_models(config, ckpt)
 
 assert os.path.isfile(opt.init_img)
 init_image = load_img(opt.init_img, opt.H, opt.W).to(opt.device)
 
-model = instantiate_from_config(config.modelUNet)
-_, _ = model.load_state_dict(sd, strict=False)
-model.eval()
 model.cdevice = opt.device
 model.unet_bs = opt.unet_bs
 model.turbo = opt.turbo
+model.cache_context_kv = opt.kv_cache
+model.set_token_merge(opt.tome_ratio, opt.tome_max_downsample, opt.tome_ff)
+model.legacy_noise = opt.legacy_noise
 
-modelCS = instantiate_from_config(config.modelCondStage)
-_, _ = modelCS.load_state_dict(sd, strict=False)
-modelCS.eval()
 modelCS.cond_stage_model.device = opt.device
+modelFS.set_tiling(opt.tiled_vae)
+stages = stage_residency(opt.device, modelCS=modelCS, modelFS=modelFS)
 
-modelFS = instantiate_from_config(config.modelFirstStage)
-_, _ = modelFS.load_state_dict(sd, strict=False)
-modelFS.eval()
-del sd
 if opt.device != "cpu" and opt.precision == "autocast":
     model.half()
     modelCS.half()
@@ -259,16 +338,13 @@ else:
         data = batch_size * list(data)
         data = list(chunk(sorted(data), batch_size))
 
-modelFS.to(opt.device)
+stages.acquire("modelFS")
 
 init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
 init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))  # move to latent space
 
-if opt.device != "cpu":
-    mem = torch.cuda.memory_allocated() / 1e6
-    modelFS.to("cpu")
-    while torch.cuda.memory_allocated() / 1e6 >= mem:
-        time.sleep(1)
+stages.prefetch("modelCS")
+stages.release("modelFS")
 
 assert 0.0 <= opt.strength <= 1.0, "can only work with strength in [0.0, 1.0]"
 t_enc = int(opt.strength * opt.ddim_steps)
@@ -290,31 +366,16 @@ with torch.no_grad():
             base_count = len(os.listdir(sample_path))
 
             with precision_scope("cuda"):
-                modelCS.to(opt.device)
+                stages.acquire("modelCS")
                 uc = None
                 if opt.scale != 1.0:
                     uc = modelCS.get_learned_conditioning(batch_size * [""])
                 if isinstance(prompts, tuple):
                     prompts = list(prompts)
 
-                subprompts, weights = split_weighted_subprompts(prompts[0])
-                if len(subprompts) > 1:
-                    c = torch.zeros_like(uc)
-                    totalWeight = sum(weights)
-                    # normalize each "sub prompt" and add it
-                    for i in range(len(subprompts)):
-                        weight = weights[i]
-                        # if not skip_normalize:
-                        weight = weight / totalWeight
-                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                else:
-                    c = modelCS.get_learned_conditioning(prompts)
-
-                if opt.device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelCS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                c = modelCS.get_weighted_conditioning(prompts)
+
+                stages.release("modelCS")
 
                 # encode (scaled latent)
                 z_enc = model.stochastic_encode(
@@ -328,13 +389,24 @@ with torch.no_grad():
                 samples_ddim = model.sample(
                     t_enc,
                     c,
-                    z_enc,
+                    # the sigma-space samplers noise the clean latent themselves
+                    init_latent if opt.sampler.startswith(("dpmpp", "k_")) else z_enc,
+                    seed=opt.seed,
                     unconditional_guidance_scale=opt.scale,
                     unconditional_conditioning=uc,
-                    sampler=opt.sampler
+                    sampler=opt.sampler,
+                    sigma_schedule=opt.sigma_schedule,
+                    guidance=GuidancePolicy(tuple(opt.guidance_interval), opt.uncond_every),
+                    stop_threshold=opt.stop_threshold,
+                    stop_patience=opt.stop_patience,
+                    deep_cache=DeepCache(opt.deep_cache_interval, opt.deep_cache_depth)
+                    if opt.deep_cache_interval > 1 else None,
+                    tile_size=opt.tile_size // 8 if opt.tile_size else None,
+                    tile_overlap=opt.tile_overlap // 8,
+                    tile_batch=opt.tile_batch
                 )
 
-                modelFS.to(opt.device)
+                stages.acquire("modelFS")
                 print("saving images")
                 for i in range(batch_size):
                     x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
@@ -347,11 +419,7 @@ with torch.no_grad():
                     opt.seed += 1
                     base_count += 1
 
-                if opt.device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelFS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelFS")
 
                 del samples_ddim
                 print("memory_final = ", torch.cuda.memory_allocated() / 1e6)
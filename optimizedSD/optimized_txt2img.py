@@ -18,8 +18,14 @@ from torchvision.utils import make_grid
 from tqdm import tqdm, trange
 from transformers import logging
 
+from ldm.modules.attention import chunk_planner
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from deep_cache import DeepCache
+from fast_ckpt import load_split_models
+from guidance import GuidancePolicy
+from inpaint_crop import MaskCrop
+from optimUtils import logger
+from residency import stage_residency
 
 logging.set_verbosity_error()
 
@@ -54,8 +60,17 @@ def load_img(image, h0, w0):
     return 2.0 * image - 1.0
 
 
-def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=None):
+def load_inpaint_mask(mask, batch_size, latent_h, latent_w):
+    """[b, 4, h, w] sampler mask of a pil mask image that is white where the image is regenerated"""
+    mask = mask.convert("L").resize((latent_w, latent_h), resample=Image.LANCZOS)
+    mask = 1.0 - torch.from_numpy(np.array(mask).astype(np.float32) / 255.0)
+    return mask[None, None].repeat(batch_size, 4, 1, 1)
+
+
+def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=None, stages=None):
     tic = time.time()
+    if stages is None:
+        stages = stage_residency(opt.device, modelCS=modelCS, modelFS=modelFS)
     start_code = None
     if opt.fixed_code:
         start_code = torch.randn([opt.num_images, opt.C, opt.height // opt.f, opt.width // opt.f], device=opt.device)
@@ -76,7 +91,8 @@ def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=
     if not opt.from_file and prompt is None:
         prompt = opt.prompt
         assert prompt is not None
-        data = [batch_size * [prompt]]
+        # a list holds one prompt per sample, like the merged jobs of batching.py
+        data = [list(prompt)] if isinstance(prompt, list) else [batch_size * [prompt]]
 
     else:
         print(f"reading prompts from {opt.from_file}")
@@ -90,24 +106,32 @@ def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=
     else:
         precision_scope = nullcontext
 
+    mask, crop = None, None
     if use_init_img:
-        modelFS.to(opt.device)
+        stages.acquire("modelFS")
         init_image = repeat(init_image, "1 ... -> b ...", b=batch_size)
         init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
+        if getattr(opt, "mask", None) is not None:
+            mask = load_inpaint_mask(opt.mask, batch_size, *init_latent.shape[2:]).to(init_latent.device,
+                                                                                      init_latent.dtype)
+            if getattr(opt, "mask_crop", True):
+                # only sample the box around the masked area, the rest of the image is kept as it is
+                crop = MaskCrop(mask, margin=getattr(opt, "mask_crop_margin", 64) // opt.f)
+                init_latent, mask = crop.crop(init_latent), crop.crop(mask)
+        t_enc = int(opt.ddim_steps * opt.img2img_strength)
         z_enc = model.stochastic_encode(
             init_latent,
-            torch.tensor([int(opt.ddim_steps * opt.img2img_strength)] * batch_size, device=opt.device),
+            torch.tensor([t_enc] * batch_size, device=opt.device),
             opt.seed,
             opt.ddim_eta,
             opt.ddim_steps,
         ).to(opt.device)
-        if opt.device != "cpu":
-            mem = torch.cuda.memory_allocated(device=opt.device) / 1e6
-            modelFS.to("cpu")
-            while torch.cuda.memory_allocated(device=opt.device) / 1e6 >= mem:
-                time.sleep(1)
+        stages.prefetch("modelCS")
+        stages.release("modelFS")
 
     seeds = ""
+    opt.run_stats = []
+    deep_cache_interval = getattr(opt, "deep_cache_interval", 1)
     try:
         negative_prompt = opt.negative_prompt
     except:
@@ -123,37 +147,24 @@ def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=
                 else:
                     base_count = 0
                 with precision_scope("cuda"):
-                    modelCS.to(opt.device)
+                    stages.acquire("modelCS")
                     uc = None
                     if opt.scale != 1.0:
-                        uc = modelCS.get_learned_conditioning(batch_size * [negative_prompt])
+                        uc = modelCS.get_learned_conditioning(
+                            negative_prompt if isinstance(negative_prompt, list) else batch_size * [negative_prompt])
                     if isinstance(prompts, tuple):
                         prompts = list(prompts)
 
-                    subprompts, weights = split_weighted_subprompts(prompts[0])
-                    if len(subprompts) > 1:
-                        c = torch.zeros_like(uc)
-                        totalWeight = sum(weights)
-                        # normalize each "sub prompt" and add it
-                        for i in range(len(subprompts)):
-                            weight = weights[i]
-                            # if not skip_normalize:
-                            weight = weight / totalWeight
-                            c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                    else:
-                        c = modelCS.get_learned_conditioning(prompts)
+                    c = modelCS.get_weighted_conditioning(prompts)
 
                     shape = [opt.num_images, opt.C, opt.height // opt.f, opt.width // opt.f]
 
-                    if opt.device != "cpu":
-                        mem = torch.cuda.memory_allocated(device=opt.device) / 1e6
-                        modelCS.to("cpu")
-                        while torch.cuda.memory_allocated(device=opt.device) / 1e6 >= mem:
-                            time.sleep(1)
+                    stages.release("modelCS")
                     samples_ddim = model.sample(
                         x0=(z_enc if opt.sampler == "ddim" else init_latent) if use_init_img else None,
                         batch_size=batch_size,
-                        S=opt.ddim_steps,
+                        # the sigma-space samplers start img2img at the noise level of the strength
+                        S=t_enc if use_init_img and opt.sampler.startswith(("dpmpp", "k_")) else opt.ddim_steps,
                         conditioning=c,
                         seed=opt.seed,
                         shape=shape,
@@ -161,27 +172,37 @@ def get_image(opt, model, modelCS, modelFS, prompt=None, save=True, callback_fn=
                         unconditional_guidance_scale=opt.scale,
                         unconditional_conditioning=uc,
                         eta=opt.ddim_eta,
-                        x_T=start_code,
+                        # ddim blends the kept part of an inpainting mask from x_T
+                        x_T=init_latent if mask is not None and opt.sampler == "ddim" else start_code,
+                        mask=mask,
                         sampler=opt.sampler,
                         speed_mp=speed_mp,
-                        callback_fn=callback_fn
+                        callback_fn=callback_fn,
+                        sigma_schedule=getattr(opt, "sigma_schedule", None),
+                        guidance=GuidancePolicy(tuple(getattr(opt, "guidance_interval", (0., 1.))),
+                                                getattr(opt, "uncond_every", 1)),
+                        stop_threshold=getattr(opt, "stop_threshold", 0.),
+                        stop_patience=getattr(opt, "stop_patience", 3),
+                        deep_cache=DeepCache(deep_cache_interval, getattr(opt, "deep_cache_depth", 1))
+                        if deep_cache_interval > 1 else None,
+                        tile_size=opt.tile_size // opt.f if getattr(opt, "tile_size", None) else None,
+                        tile_overlap=getattr(opt, "tile_overlap", 128) // opt.f,
+                        tile_batch=getattr(opt, "tile_batch", 4),
+                        progress=getattr(opt, "progress", None)
                     )
-                    modelFS.to(opt.device)
+                    opt.run_stats.append(model.last_run_stats)
+                    stages.acquire("modelFS")
 
                     print(samples_ddim.shape)
                     print("saving images")
-                    for i in range(batch_size):
-                        x_samples_ddim = modelFS.decode_first_stage(samples_ddim[i].unsqueeze(0))
-                        x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-                        all_samples.append(x_sample.to("cpu"))
-                        seeds += str(opt.seed) + ","
-                        base_count += 1
-
-                    if opt.device != "cpu":
-                        mem = torch.cuda.memory_allocated(device=opt.device) / 1e6
-                        modelFS.to("cpu")
-                        while torch.cuda.memory_allocated(device=opt.device) / 1e6 >= mem:
-                            time.sleep(1)
+                    x_samples = modelFS.decode_samples(samples_ddim, to_uint8=False)
+                    if crop is not None:
+                        x_samples = crop.paste((init_image + 1.0) / 2.0, x_samples)
+                    all_samples.extend(x_samples.split(1))
+                    seeds += batch_size * (str(opt.seed) + ",")
+                    base_count += batch_size
+
+                    stages.release("modelFS")
                     del samples_ddim
                     print("memory_final = ", torch.cuda.memory_allocated(device=opt.device) / 1e6)
 
@@ -326,6 +347,53 @@ if __name__ == '__main__':
         action="store_true",
         help="Reduces inference time on the expense of 1GB VRAM",
     )
+    parser.add_argument(
+        "--legacy_noise",
+        action="store_true",
+        help="draw the noise from the global torch rng like older versions did, to reproduce their seeds",
+    )
+    parser.add_argument(
+        "--kv_cache",
+        action="store_true",
+        help="project the prompt for the cross-attention once per run instead of at every step",
+    )
+    parser.add_argument(
+        "--tome_ratio",
+        type=float,
+        help="merge this fraction of the tokens before the self-attention of the high resolution transformers "
+             "(token merging, 0 disables)",
+        default=0.,
+    )
+    parser.add_argument(
+        "--tome_max_downsample",
+        type=int,
+        choices=[1, 2, 4, 8],
+        help="merge tokens in the transformers down to this downsampling of the latent",
+        default=1,
+    )
+    parser.add_argument(
+        "--tome_ff",
+        action="store_true",
+        help="also merge the tokens before the feed forward layers",
+    )
+    parser.add_argument(
+        "--tiled_vae",
+        action="store_true",
+        help="encode/decode the image in overlapping tiles, for very large resolutions",
+    )
+    parser.add_argument(
+        "--attn_cpu_budget",
+        type=int,
+        default=None,
+        help="MB of RAM the attention may use when running on the cpu, splits it into chunks above that",
+    )
+    parser.add_argument(
+        "--attn_backend",
+        type=str,
+        help="attention implementation, overrides the config (falls back automatically when unavailable)",
+        choices=["auto", "einsum", "sdpa", "xformers", "naive"],
+        default=None,
+    )
     parser.add_argument(
         "--precision",
         type=str,
@@ -344,9 +412,74 @@ if __name__ == '__main__':
         "--sampler",
         type=str,
         help="sampler",
-        choices=["ddim", "plms"],
+        choices=["ddim", "plms", "dpmpp_2m", "dpmpp_3s", "k_euler", "k_euler_a", "k_heun", "k_dpm_2", "k_dpm_2_a",
+                 "k_lms"],
         default="plms",
     )
+    parser.add_argument(
+        "--sigma_schedule",
+        type=str,
+        help="step schedule of the sigma-space samplers (default: karras for dpmpp, uniform for k_)",
+        choices=["karras", "uniform"],
+        default=None,
+    )
+    parser.add_argument(
+        "--guidance_interval",
+        type=float,
+        nargs=2,
+        help="only guide the steps in this fraction of the sampling, e.g. 0 0.7 drops guidance for the last 30%%",
+        default=[0., 1.],
+    )
+    parser.add_argument(
+        "--uncond_every",
+        type=int,
+        help="evaluate the unconditional branch every k steps and reuse its difference in between",
+        default=1,
+    )
+    parser.add_argument(
+        "--stop_threshold",
+        type=float,
+        help="stop plms/ddim early once the x_0 prediction changes by less than this (relative l2) for "
+             "--stop_patience steps in a row, 0 disables",
+        default=0.,
+    )
+    parser.add_argument(
+        "--stop_patience",
+        type=int,
+        help="consecutive converged steps before stopping early",
+        default=3,
+    )
+    parser.add_argument(
+        "--deep_cache_interval",
+        type=int,
+        help="run the full unet every n steps and only its shallow blocks on cached deep features in between, "
+             "1 disables",
+        default=1,
+    )
+    parser.add_argument(
+        "--deep_cache_depth",
+        type=int,
+        help="number of input and output blocks that still run on the cached steps",
+        default=1,
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        help="sample the latent in overlapping windows of this many pixels, for canvases that don't fit at once",
+        default=None,
+    )
+    parser.add_argument(
+        "--tile_overlap",
+        type=int,
+        help="overlap of the sampling windows in pixels",
+        default=128,
+    )
+    parser.add_argument(
+        "--tile_batch",
+        type=int,
+        help="number of sampling windows that go through the unet together",
+        default=4,
+    )
     opt = parser.parse_args()
     opt.num_images = opt.n_samples
     opt.height = opt.H
@@ -365,42 +498,23 @@ if __name__ == '__main__':
     # Logging
     logger(vars(opt), log_csv="logs/txt2img_logs.csv")
 
-    sd = load_model_from_config(f"{opt.ckpt_path}")
-    li, lo = [], []
-    for key, value in sd.items():
-        sp = key.split(".")
-        if (sp[0]) == "model":
-            if "input_blocks" in sp:
-                li.append(key)
-            elif "middle_block" in sp:
-                li.append(key)
-            elif "time_embed" in sp:
-                li.append(key)
-            else:
-                lo.append(key)
-    for key in li:
-        sd["model1." + key[6:]] = sd.pop(key)
-    for key in lo:
-        sd["model2." + key[6:]] = sd.pop(key)
-
     config = OmegaConf.load(f"{opt.config_path}")
-
-    _model = instantiate_from_config(config.modelUNet)
-    _, _ = _model.load_state_dict(sd, strict=False)
-    _model.eval()
+    if opt.attn_backend is not None:
+        config.modelUNet.params.unetConfigEncode.params.attn_backend = opt.attn_backend
+        config.modelUNet.params.unetConfigDecode.params.attn_backend = opt.attn_backend
+        config.modelFirstStage.params.first_stage_config.params.ddconfig.attn_backend = opt.attn_backend
+    _model, _modelCS, _modelFS = load_split_models(config, opt.ckpt_path)
     _model.unet_bs = opt.unet_bs
     _model.cdevice = opt.device
     _model.turbo = opt.turbo
+    _model.cache_context_kv = opt.kv_cache
+    _model.set_token_merge(opt.tome_ratio, opt.tome_max_downsample, opt.tome_ff)
+    _model.legacy_noise = opt.legacy_noise
 
-    _modelCS = instantiate_from_config(config.modelCondStage)
-    _, _ = _modelCS.load_state_dict(sd, strict=False)
-    _modelCS.eval()
     _modelCS.cond_stage_model.device = opt.device
-
-    _modelFS = instantiate_from_config(config.modelFirstStage)
-    _, _ = _modelFS.load_state_dict(sd, strict=False)
-    _modelFS.eval()
-    del sd
+    _modelFS.set_tiling(opt.tiled_vae)
+    if opt.attn_cpu_budget is not None:
+        chunk_planner.set_budget("cpu", opt.attn_cpu_budget * 1024 ** 2)
 
     if opt.device != "cpu" and opt.precision == "autocast":
         _model.half()
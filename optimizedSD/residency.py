@@ -0,0 +1,141 @@
+"""
+Keeps track of which split stages (UNet / CondStage / FirstStage) live on the gpu.
+
+The scripts used to move a stage back to the cpu and then poll torch.cuda.memory_allocated() once a second
+until the number went down. StageResidency moves stages with a proper synchronization instead, can keep
+released stages on the device while they fit in a memory budget (evicting the least recently used one
+when they don't) and can prefetch the next stage on a side stream while the current one is still busy.
+
+With device == host (cpu runs) nothing is ever copied, only the bookkeeping is done.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+def module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+
+class StageResidency:
+    """
+    budget_mb=None keeps the low-vram behaviour: a stage goes back to the host as soon as it is released.
+    With a budget, released stages stay on the device until the room is needed by another stage.
+    Only the registered stages are accounted for.
+    """
+
+    def __init__(self, device="cuda", host="cpu", budget_mb=None):
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None:
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.host = torch.device(host)
+        self.budget = None if budget_mb is None else int(budget_mb * 1e6)
+        self.stages = {}
+        self.resident = OrderedDict()  # name -> None, least recently used first
+        self.in_use = set()
+        self.pending = {}  # name -> cuda event of a running prefetch
+        self.use_cuda = self.device.type == "cuda" and self.device != self.host
+        self.stream = None
+
+    def register(self, name, module):
+        self.stages[name] = module
+        param = next(module.parameters(), None)
+        if param is not None and param.device == self.device:
+            self.resident[name] = None
+        return module
+
+    def size(self, name):
+        # not cached, the stages may be cast to half after registration
+        return module_bytes(self.stages[name])
+
+    def resident_bytes(self):
+        return sum(self.size(name) for name in self.resident)
+
+    def _make_room(self, name):
+        if self.budget is None:
+            return
+        needed = self.size(name)
+        for other in list(self.resident):
+            if self.resident_bytes() + needed <= self.budget:
+                break
+            if other != name and other not in self.in_use:
+                self.offload(other)
+
+    def _move(self, name, target, non_blocking=False):
+        if self.device != self.host:
+            self.stages[name].to(target, non_blocking=non_blocking)
+
+    def _wait(self, name):
+        event = self.pending.pop(name, None)
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+
+    def acquire(self, name):
+        """Puts the stage on the device and pins it there until release()."""
+        self._wait(name)
+        if name not in self.resident:
+            self._make_room(name)
+            self._move(name, self.device)
+            self.resident[name] = None
+        self.resident.move_to_end(name)
+        self.in_use.add(name)
+        return self.stages[name]
+
+    def release(self, name):
+        self.in_use.discard(name)
+        if self.budget is None:
+            self.offload(name)
+
+    def offload(self, name):
+        self._wait(name)
+        if name not in self.resident:
+            return
+        self._move(name, self.host)
+        if self.use_cuda:
+            # the old device tensors are freed in stream order, make sure the copy is done before the room is reused
+            torch.cuda.synchronize(self.device)
+        del self.resident[name]
+        self.in_use.discard(name)
+
+    def offload_all(self):
+        for name in list(self.resident):
+            self.offload(name)
+
+    def prefetch(self, name):
+        """Starts moving the stage to the device without waiting for it, acquire() waits for the copy."""
+        if name in self.resident:
+            return
+        self._make_room(name)
+        if self.use_cuda:
+            if self.stream is None:
+                self.stream = torch.cuda.Stream(self.device)
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                self._move(name, self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+            self.pending[name] = event
+        else:
+            self._move(name, self.device)
+        self.resident[name] = None
+
+    @contextmanager
+    def use(self, name):
+        module = self.acquire(name)
+        try:
+            yield module
+        finally:
+            self.release(name)
+
+    def stats(self):
+        return dict(resident=list(self.resident), in_use=sorted(self.in_use), resident_mb=self.resident_bytes() / 1e6,
+                    budget_mb=None if self.budget is None else self.budget / 1e6)
+
+
+def stage_residency(device, budget_mb=None, **stages):
+    """StageResidency on `device` with the given stages registered, e.g. stage_residency(device, modelCS=modelCS)."""
+    residency = StageResidency(device, budget_mb=budget_mb)
+    for name, module in stages.items():
+        residency.register(name, module)
+    return residency
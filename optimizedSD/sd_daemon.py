@@ -0,0 +1,390 @@
+"""
+Persistent generation daemon.
+
+Loads the split UNet / CondStage / FirstStage once and keeps them in memory, then serves
+get_image() requests over a unix socket or a localhost tcp port, so a batch of prompt
+invocations only pays the checkpoint loading cost once.
+
+Start the daemon:
+    python optimizedSD/sd_daemon.py serve --port 7861
+Send a job (same arguments as optimized_txt2img.py):
+    python optimizedSD/sd_daemon.py generate --port 7861 --prompt "an apple" --n_samples 2
+
+The wire protocol is one json object per line in each direction.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+from argparse import Namespace
+from random import randint
+
+import numpy as np
+import torch
+from PIL import Image
+from einops import rearrange
+from omegaconf import OmegaConf
+
+from fast_ckpt import load_split_models
+from optimized_txt2img import get_image
+from residency import stage_residency
+
+DEFAULT_PORT = 7861
+
+# defaults mirror the argparse defaults of optimized_txt2img.py
+DEFAULT_JOB = dict(
+    prompt="a painting of a virus monster playing guitar",
+    negative_prompt="",
+    outdir="outputs/txt2img-samples",
+    init_image=None,
+    mask=None,
+    mask_crop=True,
+    mask_crop_margin=64,
+    img2img_strength=0.75,
+    ddim_steps=50,
+    fixed_code=False,
+    ddim_eta=0.0,
+    n_iter=1,
+    H=512,
+    W=512,
+    C=4,
+    f=8,
+    n_samples=1,
+    scale=7.5,
+    from_file=None,
+    seed=None,
+    unet_bs=1,
+    speed_mp=3,
+    turbo=False,
+    format="png",
+    sampler="plms",
+    sigma_schedule=None,
+    guidance_interval=[0., 1.],
+    uncond_every=1,
+    stop_threshold=0.,
+    stop_patience=3,
+    deep_cache_interval=1,
+    deep_cache_depth=1,
+    tile_size=None,
+    tile_overlap=128,
+    tile_batch=4,
+)
+
+
+def load_models(opt):
+    config = OmegaConf.load(f"{opt.config_path}")
+    model, modelCS, modelFS = load_split_models(config, opt.ckpt_path)
+    model.cdevice = opt.device
+    model.cache_context_kv = opt.kv_cache
+    model.set_token_merge(opt.tome_ratio, opt.tome_max_downsample, opt.tome_ff)
+    modelCS.cond_stage_model.device = opt.device
+
+    if opt.device != "cpu" and opt.precision == "autocast":
+        model.half()
+        modelCS.half()
+        modelFS.half()
+    return model, modelCS, modelFS
+
+
+def add_model_args(p):
+    """arguments of the process that loads the models, shared with http_api.py"""
+    p.add_argument("--config_path", type=str, default="optimizedSD/v1-inference.yaml", help="config path")
+    p.add_argument("--ckpt_path", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                   help="checkpoint path")
+    p.add_argument("--device", type=str, default="cuda", help="specify GPU (cuda/cuda:0/cuda:1/...)")
+    p.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast",
+                   help="evaluate at this precision")
+    p.add_argument("--stage_budget", type=float, default=None,
+                   help="MB of vram the text encoder and the autoencoder may keep between jobs "
+                        "(default: move them back to the cpu after every use)")
+    p.add_argument("--kv_cache", action="store_true",
+                   help="project the prompt for the cross-attention once per job instead of at every step")
+    p.add_argument("--tome_ratio", type=float, default=0.,
+                   help="merge this fraction of the tokens before the self-attention of the high resolution "
+                        "transformers (token merging, 0 disables)")
+    p.add_argument("--tome_max_downsample", type=int, choices=[1, 2, 4, 8], default=1,
+                   help="merge tokens in the transformers down to this downsampling of the latent")
+    p.add_argument("--tome_ff", action="store_true", help="also merge the tokens before the feed forward layers")
+
+
+def job_to_opt(job, server_opt):
+    """Builds the `opt` namespace get_image() expects from a client job dict."""
+    unknown = set(job) - set(DEFAULT_JOB) - {"return_bytes"}
+    if unknown:
+        raise ValueError(f"unknown job arguments: {sorted(unknown)}")
+    opt = Namespace(**{**DEFAULT_JOB, **{k: v for k, v in job.items() if k != "return_bytes"}})
+    opt.num_images = opt.n_samples
+    opt.height = opt.H
+    opt.width = opt.W
+    opt.device = server_opt.device
+    opt.precision = server_opt.precision
+    opt.outpath = opt.outdir
+    if opt.seed is None:
+        opt.seed = randint(0, 1000000)
+    if opt.init_image is not None:
+        opt.init_image = Image.open(opt.init_image).convert("RGB")
+    else:
+        del opt.init_image  # get_image() treats a missing init image as txt2img
+    if opt.mask is not None:
+        if not hasattr(opt, "init_image"):
+            raise ValueError("an inpainting mask needs an init image")
+        opt.mask = Image.open(opt.mask)
+    if opt.from_file is None:
+        opt.from_file = False
+    return opt
+
+
+class GenerationService:
+    """Owns the loaded models and runs one job at a time on them."""
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.model, self.modelCS, self.modelFS = load_models(opt)
+        # shared across jobs, so that with a budget the stages can stay on the gpu between them
+        self.stages = stage_residency(opt.device, budget_mb=opt.stage_budget, modelCS=self.modelCS,
+                                      modelFS=self.modelFS)
+        self.lock = threading.Lock()
+        self.jobs_done = 0
+        self.steps_planned = 0
+        self.steps_run = 0
+
+    def run(self, job, progress=None):
+        """progress: called with (step, total steps) at every sampler step, from the thread running the job"""
+        opt = job_to_opt(job, self.opt)
+        opt.progress = progress
+        with self.lock:
+            self.model.unet_bs = opt.unet_bs
+            self.model.turbo = opt.turbo
+            tic = time.time()
+            samples = get_image(opt, self.model, self.modelCS, self.modelFS, save=True, stages=self.stages)
+            self.jobs_done += 1
+            self.steps_planned += sum(stats["steps_planned"] for stats in opt.run_stats)
+            self.steps_run += sum(stats["steps_run"] for stats in opt.run_stats)
+        return self.save_images(job, opt, samples, tic)
+
+    def run_batch(self, jobs, progress=None):
+        """
+        Runs txt2img jobs that batching.batch_key() groups together as one sampler batch, with the prompt, negative
+        prompt, guidance scale and seeds of every job kept per sample. Returns one result per job, as run() would.
+        """
+        opts = [job_to_opt(job, self.opt) for job in jobs]
+        merged = Namespace(**vars(opts[0]))
+        merged.prompt = [opt.prompt for opt in opts for _ in range(opt.n_samples)]
+        merged.negative_prompt = [opt.negative_prompt for opt in opts for _ in range(opt.n_samples)]
+        merged.scale = [opt.scale for opt in opts for _ in range(opt.n_samples)]
+        merged.seed = [opt.seed + i for opt in opts for i in range(opt.n_samples)]
+        merged.num_images = merged.n_samples = len(merged.seed)
+        merged.progress = progress
+        with self.lock:
+            # every job asked for a unet batch size that fits its memory, the batch keeps to the smallest
+            self.model.unet_bs = min(opt.unet_bs for opt in opts)
+            self.model.turbo = merged.turbo
+            tic = time.time()
+            samples = get_image(merged, self.model, self.modelCS, self.modelFS, save=True, stages=self.stages)
+            self.jobs_done += len(jobs)
+            self.steps_planned += sum(stats["steps_planned"] for stats in merged.run_stats)
+            self.steps_run += sum(stats["steps_run"] for stats in merged.run_stats)
+
+        results, offset = [], 0
+        for job, opt in zip(jobs, opts):
+            opt.run_stats = merged.run_stats
+            result = self.save_images(job, opt, samples[offset:offset + opt.n_samples], tic)
+            result["batch"] = dict(jobs=len(jobs), samples=merged.num_images)
+            results.append(result)
+            offset += opt.n_samples
+        return results
+
+    def save_images(self, job, opt, samples, tic):
+        prompt = opt.prompt if not opt.from_file else os.path.basename(opt.from_file)
+        sample_path = os.path.join(opt.outpath, "_".join(re.split(":| ", prompt.replace("/", ""))))[:150]
+        os.makedirs(sample_path, exist_ok=True)
+        base_count = len(os.listdir(sample_path))
+        paths, images, seeds = [], [], []
+        for i, x_sample in enumerate(samples):
+            seed = opt.seed + i % opt.num_images
+            x_sample = 255.0 * rearrange(x_sample[0].cpu().numpy(), "c h w -> h w c")
+            img = Image.fromarray(x_sample.astype(np.uint8))
+            path = os.path.join(sample_path, "seed_" + str(seed) + "_" + f"{base_count:05}.{opt.format}")
+            img.save(path)
+            base_count += 1
+            paths.append(os.path.abspath(path))
+            seeds.append(seed)
+            if job.get("return_bytes"):
+                buf = io.BytesIO()
+                img.save(buf, format="PNG" if opt.format == "png" else "JPEG")
+                images.append(base64.b64encode(buf.getvalue()).decode("ascii"))
+
+        result = dict(ok=True, paths=paths, seeds=seeds, time=time.time() - tic,
+                      steps_run=[stats["steps_run"] for stats in opt.run_stats], run_stats=opt.run_stats)
+        if job.get("return_bytes"):
+            result["images"] = images
+        return result
+
+    def stats(self):
+        return dict(jobs_done=self.jobs_done, steps_planned=self.steps_planned, steps_run=self.steps_run,
+                    cond_cache=self.modelCS.cond_cache.stats())
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get("cmd") == "ping":
+                    response = dict(ok=True, **self.server.service.stats())
+                else:
+                    response = self.server.service.run(request.get("job", {}))
+            except Exception as e:
+                response = dict(ok=False, error=f"{type(e).__name__}: {e}")
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(opt):
+    service = GenerationService(opt)
+    if opt.socket:
+        if os.path.exists(opt.socket):
+            os.remove(opt.socket)
+        server = ThreadingUnixServer(opt.socket, JobHandler)
+        where = opt.socket
+    else:
+        server = ThreadingTCPServer((opt.host, opt.port), JobHandler)
+        where = f"{opt.host}:{opt.port}"
+    server.service = service
+    print(f"daemon listening on {where}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if opt.socket and os.path.exists(opt.socket):
+            os.remove(opt.socket)
+
+
+def connect(opt):
+    if opt.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(opt.socket)
+    else:
+        sock = socket.create_connection((opt.host, opt.port))
+    return sock
+
+
+def request(opt, payload):
+    with connect(opt) as sock:
+        sock.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def generate(opt):
+    job = {k: getattr(opt, k) for k in DEFAULT_JOB if getattr(opt, k, None) is not None}
+    for key in ("init_image", "mask"):
+        if job.get(key) is not None:
+            job[key] = os.path.abspath(job[key])
+    if job.get("from_file") is not None:
+        job["from_file"] = os.path.abspath(job["from_file"])
+    job["outdir"] = os.path.abspath(job["outdir"])
+    job["return_bytes"] = opt.save_to is not None
+    response = request(opt, dict(job=job))
+    if not response["ok"]:
+        print("generation failed:", response["error"])
+        sys.exit(1)
+    if opt.save_to is not None:
+        os.makedirs(opt.save_to, exist_ok=True)
+        for path, data in zip(response["paths"], response["images"]):
+            with open(os.path.join(opt.save_to, os.path.basename(path)), "wb") as f:
+                f.write(base64.b64decode(data))
+    for path in response["paths"]:
+        print(path)
+    print(f"done in {response['time']:.2f} seconds, sampling steps run: {response['steps_run']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="persistent SD generation daemon and its client")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_connection_args(p):
+        p.add_argument("--host", type=str, default="127.0.0.1", help="tcp host to bind/connect")
+        p.add_argument("--port", type=int, default=DEFAULT_PORT, help="tcp port to bind/connect")
+        p.add_argument("--socket", type=str, default=None, help="unix socket path, overrides host/port")
+
+    p_serve = sub.add_parser("serve", help="load the models and serve jobs")
+    add_connection_args(p_serve)
+    add_model_args(p_serve)
+
+    p_gen = sub.add_parser("generate", help="send a job to a running daemon")
+    add_connection_args(p_gen)
+    p_gen.add_argument("--prompt", type=str, default=DEFAULT_JOB["prompt"], help="the prompt to render")
+    p_gen.add_argument("--negative_prompt", type=str, default="", help="the negative prompt")
+    p_gen.add_argument("--outdir", type=str, default=DEFAULT_JOB["outdir"], help="dir to write results to")
+    p_gen.add_argument("--init_img", dest="init_image", type=str, default=None, help="path to an input image")
+    p_gen.add_argument("--mask", type=str, default=None,
+                       help="inpainting mask for the input image, white where the image is regenerated")
+    p_gen.add_argument("--strength", dest="img2img_strength", type=float, default=0.75,
+                       help="strength for noising/unnoising the input image")
+    p_gen.add_argument("--ddim_steps", type=int, default=50, help="number of ddim sampling steps")
+    p_gen.add_argument("--fixed_code", action="store_true", help="uses the same starting code across samples")
+    p_gen.add_argument("--ddim_eta", type=float, default=0.0, help="ddim eta")
+    p_gen.add_argument("--n_iter", type=int, default=1, help="sample this often")
+    p_gen.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    p_gen.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    p_gen.add_argument("--n_samples", type=int, default=1, help="batch size")
+    p_gen.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    p_gen.add_argument("--from-file", type=str, default=None, help="if specified, load prompts from this file")
+    p_gen.add_argument("--seed", type=int, default=None, help="the seed (for reproducible sampling)")
+    p_gen.add_argument("--unet_bs", type=int, default=1, help="U-Net batch size")
+    p_gen.add_argument("--speed_mp", type=int, default=3, help="More vram, more image res")
+    p_gen.add_argument("--turbo", action="store_true", help="Reduces inference time on the expense of 1GB VRAM")
+    p_gen.add_argument("--format", type=str, choices=["jpg", "png"], default="png", help="output image format")
+    p_gen.add_argument("--sampler", type=str, default="plms", help="sampler")
+    p_gen.add_argument("--sigma_schedule", type=str, choices=["karras", "uniform"], default=None,
+                       help="step schedule of the sigma-space samplers (default: karras for dpmpp, uniform for k_)")
+    p_gen.add_argument("--guidance_interval", type=float, nargs=2, default=[0., 1.],
+                       help="only guide the steps in this fraction of the sampling")
+    p_gen.add_argument("--uncond_every", type=int, default=1,
+                       help="evaluate the unconditional branch every k steps and reuse its difference in between")
+    p_gen.add_argument("--stop_threshold", type=float, default=0.,
+                       help="stop plms/ddim early once the x_0 prediction changes by less than this (relative l2)")
+    p_gen.add_argument("--stop_patience", type=int, default=3,
+                       help="consecutive converged steps before stopping early")
+    p_gen.add_argument("--deep_cache_interval", type=int, default=1,
+                       help="run the full unet every n steps and only its shallow blocks in between, 1 disables")
+    p_gen.add_argument("--deep_cache_depth", type=int, default=1,
+                       help="number of input and output blocks that still run on the cached steps")
+    p_gen.add_argument("--tile_size", type=int, default=None,
+                       help="sample the latent in overlapping windows of this many pixels")
+    p_gen.add_argument("--tile_overlap", type=int, default=128, help="overlap of the sampling windows in pixels")
+    p_gen.add_argument("--tile_batch", type=int, default=4,
+                       help="number of sampling windows that go through the unet together")
+    p_gen.add_argument("--save_to", type=str, default=None,
+                       help="also receive the images as bytes and write them to this local dir")
+
+    p_ping = sub.add_parser("ping", help="check that a daemon is up")
+    add_connection_args(p_ping)
+
+    opt = parser.parse_args()
+    if opt.command == "serve":
+        serve(opt)
+    elif opt.command == "generate":
+        generate(opt)
+    else:
+        print(request(opt, dict(cmd="ping")))
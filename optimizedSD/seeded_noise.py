@@ -0,0 +1,128 @@
+"""
+Seeded gaussian noise that doesn't touch the global rng.
+
+Every sample of a batch has its own seed and draws from a Philox4x32-10 counter-based generator keyed by that seed,
+so a sample gets exactly the same noise whether it runs alone or next to other samples, and a whole
+[B, C, H, W] batch is produced in one vectorized call instead of a manual_seed() + randn() loop per sample.
+
+The counter of a draw is (element block, draw number, stream), the draw number goes up by one with every call,
+e.g. for the per-step noise of ancestral samplers. Everything is computed on the cpu with integer arithmetic and
+float64 +, *, / and sqrt only (log, sin and cos are evaluated as series), all of which are exactly rounded,
+so the result is bitwise identical no matter how the work is split into vectors or threads.
+"""
+import math
+
+import torch
+
+PHILOX_M0 = 0xD2511F53
+PHILOX_M1 = 0xCD9E8D57
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+MASK32 = 0xFFFFFFFF
+
+LN2 = math.log(2.0)
+SQRT_HALF = math.sqrt(0.5)
+HALF_PI = math.pi / 2
+
+
+def _mulhilo(a, m):
+    # 32 x 32 -> 64 bit product in int64 tensors without overflowing: split the constant into 16 bit halves
+    t = a * (m & 0xFFFF)
+    u = a * (m >> 16) + (t >> 16)
+    lo = ((u & 0xFFFF) << 16) | (t & 0xFFFF)
+    return u >> 16, lo
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1, rounds=10):
+    """Philox4x32 on broadcastable int64 tensors holding uint32 values, returns the 4 output words."""
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo(c0, PHILOX_M0)
+        hi1, lo1 = _mulhilo(c2, PHILOX_M1)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0 = (k0 + PHILOX_W0) & MASK32
+        k1 = (k1 + PHILOX_W1) & MASK32
+    return c0, c1, c2, c3
+
+
+def _uniform(x):
+    # uint32 -> (0, 1), exact in float64
+    return (x.double() + 0.5) / 2 ** 32
+
+
+def _log(x):
+    m, e = torch.frexp(x)  # x = m * 2 ** e, m in [0.5, 1)
+    small = m < SQRT_HALF
+    m = torch.where(small, m * 2, m)
+    e = e - small.to(e.dtype)
+    s = (m - 1) / (m + 1)  # |s| < 0.172
+    s2 = s * s
+    acc = torch.full_like(s, 1 / 25)
+    for k in range(11, -1, -1):
+        acc = acc * s2 + 1 / (2 * k + 1)
+    return 2 * s * acc + e.double() * LN2
+
+
+def _sin_cos_quarter(a):
+    # taylor series on [0, pi / 2)
+    a2 = a * a
+    sin, cos = torch.full_like(a, 1.0), torch.full_like(a, 1.0)
+    for k in range(12, 0, -1):
+        sin = 1 - sin * a2 / ((2 * k) * (2 * k + 1))
+        cos = 1 - cos * a2 / ((2 * k - 1) * (2 * k))
+    return sin * a, cos
+
+
+def _sin_cos_turns(u):
+    """sin and cos of 2 pi u for u in (0, 1)"""
+    q = torch.floor(u * 4)
+    sin, cos = _sin_cos_quarter((u * 4 - q) * HALF_PI)
+    q = q.long()
+    sin_out = torch.where(q == 0, sin, torch.where(q == 1, cos, torch.where(q == 2, -sin, -cos)))
+    cos_out = torch.where(q == 0, cos, torch.where(q == 1, -sin, torch.where(q == 2, -cos, sin)))
+    return sin_out, cos_out
+
+
+def philox_randn(seeds, numel, draw=0, stream=0):
+    """[len(seeds), numel] float32 standard normal samples, row i only depends on (seeds[i], draw, stream)."""
+    seeds = torch.as_tensor(seeds, dtype=torch.int64).reshape(-1, 1)
+    k0, k1 = seeds & MASK32, (seeds >> 32) & MASK32
+    blocks = torch.arange((numel + 3) // 4, dtype=torch.int64).reshape(1, -1)
+    c0, c1 = blocks & MASK32, blocks >> 32
+    c2 = torch.full_like(blocks, draw & MASK32)
+    c3 = torch.full_like(blocks, stream & MASK32)
+    x0, x1, x2, x3 = philox4x32(c0, c1, c2, c3, k0, k1)
+
+    # box-muller, every block of 4 words gives 4 normals
+    normals = []
+    for a, b in ((x0, x1), (x2, x3)):
+        r = torch.sqrt(-2 * _log(_uniform(a)))
+        sin, cos = _sin_cos_turns(_uniform(b))
+        normals += [r * cos, r * sin]
+    # interleave so that element 4 * i + j comes from block i
+    out = torch.stack([normals[0], normals[1], normals[2], normals[3]], dim=-1).reshape(seeds.shape[0], -1)
+    return out[:, :numel].float()
+
+
+class SeededNoise:
+    """
+    Noise source of one run: sample i of every batch drawn from it uses seeds[i].
+    `stream` separates independent uses of the same seeds (initial noise, img2img encoding, ...).
+    """
+
+    def __init__(self, seeds, device="cpu", stream=0):
+        self.seeds = [int(s) for s in seeds]
+        self.device = device
+        self.stream = stream
+        self.draws = 0
+
+    def randn(self, shape, dtype=torch.float32, device=None):
+        """[len(seeds), *shape] noise, every call gives new values"""
+        numel = math.prod(shape)
+        noise = philox_randn(self.seeds, numel, draw=self.draws, stream=self.stream)
+        self.draws += 1
+        return noise.reshape(len(self.seeds), *shape).to(device or self.device, dtype)
+
+    def randn_like(self, x):
+        if x.shape[0] != len(self.seeds):
+            raise ValueError(f"noise for a batch of {x.shape[0]} requested from a source of {len(self.seeds)} seeds")
+        return self.randn(tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
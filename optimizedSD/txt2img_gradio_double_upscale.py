@@ -19,7 +19,9 @@ from tqdm import tqdm, trange
 from transformers import logging
 import mimetypes
 from ldm.util import instantiate_from_config
-from optimUtils import split_weighted_subprompts, logger
+from fast_ckpt import load_split_models
+from optimUtils import logger
+from residency import stage_residency
 
 logging.set_verbosity_error()
 
@@ -82,6 +84,7 @@ def generate(
     model.turbo = turbo
     model.cdevice = device
     modelCS.cond_stage_model.device = device
+    stages = stage_residency(device, modelCS=modelCS, modelFS=modelFS)
 
     if seed == "":
         seed = randint(0, 1000000)
@@ -117,33 +120,18 @@ def generate(
         all_samples = list()
         for prompts in tqdm(data, desc="data"):
             with precision_scope("cuda"):
-                modelCS.to(device)
+                stages.acquire("modelCS")
                 uc = None
                 if scale != 1.0:
                     uc = modelCS.get_learned_conditioning(1 * [""])
                 if isinstance(prompts, tuple):
                     prompts = list(prompts)
 
-                subprompts, weights = split_weighted_subprompts(prompts[0])
-                if len(subprompts) > 1:
-                    c = torch.zeros_like(uc)
-                    totalWeight = sum(weights)
-                    # normalize each "sub prompt" and add it
-                    for i in range(len(subprompts)):
-                        weight = weights[i]
-                        # if not skip_normalize:
-                        weight = weight / totalWeight
-                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
-                else:
-                    c = modelCS.get_learned_conditioning(prompts)
+                c = modelCS.get_weighted_conditioning(prompts)
 
                 shape = [1, C, Height // f, Width // f]
 
-                if device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelCS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelCS")
 
                 samples_ddim = model.sample(
                     S=ddim_steps,
@@ -158,7 +146,7 @@ def generate(
                     sampler=sampler,
                 )
 
-                modelFS.to(device)
+                stages.acquire("modelFS")
 
                 x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
                 x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -173,7 +161,7 @@ def generate(
                                     "1 ... -> b ...", b=1)
                 init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
 
-                modelFS.cpu()
+                stages.release("modelFS")
                 model.to(device)
 
                 z_enc = model.stochastic_encode(
@@ -190,9 +178,9 @@ def generate(
                     sampler="ddim"
                 )
 
-                modelFS.to(device)
+                stages.acquire("modelFS")
                 model.cpu()
-                modelCS.to("cpu")
+                stages.release("modelCS")
                 torch.cuda.empty_cache()
 
                 x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
@@ -209,7 +197,7 @@ def generate(
                     "1 ... -> b ...", b=1)
                 init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
 
-                modelFS.cpu()
+                stages.release("modelFS")
                 model.to(device)
 
                 z_enc = model.stochastic_encode(
@@ -228,7 +216,7 @@ def generate(
 
                 print("saving images")
                 model.cpu()
-                modelFS.to(device)
+                stages.acquire("modelFS")
 
                 x_samples_ddim = modelFS.decode_first_stage(samples_ddim[0].unsqueeze(0))
                 x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -238,11 +226,7 @@ def generate(
                     os.path.join(sample_path, "seed_" + str(seed) + "_step3_" + f"{base_count:05}.{img_format}")
                 )
 
-                if device != "cpu":
-                    mem = torch.cuda.memory_allocated() / 1e6
-                    modelFS.to("cpu")
-                    while torch.cuda.memory_allocated() / 1e6 >= mem:
-                        time.sleep(1)
+                stages.release("modelFS")
 
                 del samples_ddim
                 del x_sample
@@ -275,38 +259,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     config = args.config_path
     ckpt = args.ckpt_path
-    sd = load_model_from_config(f"{ckpt}")
-    li, lo = [], []
-    for key, v_ in sd.items():
-        sp = key.split(".")
-        if (sp[0]) == "model":
-            if "input_blocks" in sp:
-                li.append(key)
-            elif "middle_block" in sp:
-                li.append(key)
-            elif "time_embed" in sp:
-                li.append(key)
-            else:
-                lo.append(key)
-    for key in li:
-        sd["model1." + key[6:]] = sd.pop(key)
-    for key in lo:
-        sd["model2." + key[6:]] = sd.pop(key)
-
     config = OmegaConf.load(f"{config}")
-
-    model = instantiate_from_config(config.modelUNet)
-    _, _ = model.load_state_dict(sd, strict=False)
-    model.eval()
-
-    modelCS = instantiate_from_config(config.modelCondStage)
-    _, _ = modelCS.load_state_dict(sd, strict=False)
-    modelCS.eval()
-
-    modelFS = instantiate_from_config(config.modelFirstStage)
-    _, _ = modelFS.load_state_dict(sd, strict=False)
-    modelFS.eval()
-    del sd
+    model, modelCS, modelFS = load_split_models(config, ckpt)
 
     demo = gr.Interface(
         fn=generate,
@@ -0,0 +1,67 @@
+"""
+Speed and quality of DeepCache on a tiny random-weight unet, against the same run without it.
+
+    python tests/bench_deep_cache.py --steps 30 --model_channels 64 --size 32
+
+Prints one row per (interval, depth): the median sampling time, the speedup, the share of unet evaluations that ran
+on cached features and the relative rms error of the final latent.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch  # noqa: E402
+
+from optimizedSD.deep_cache import DeepCache  # noqa: E402
+from tiny_models import conditioning, tiny_unet  # noqa: E402
+
+
+def run(model, opt, deep_cache=None):
+    return model.sample(S=opt.steps, conditioning=conditioning(opt.batch), seed=0, sampler=opt.sampler,
+                        shape=[opt.batch, 4, opt.size, opt.size], batch_size=opt.batch, verbose=False,
+                        unconditional_guidance_scale=7.5, unconditional_conditioning=conditioning(opt.batch, seed=1),
+                        deep_cache=deep_cache)
+
+
+def timed(model, opt, make_cache):
+    times, out, cache = [], None, None
+    for _ in range(opt.repeats):
+        cache = make_cache()
+        tic = time.perf_counter()
+        out = run(model, opt, cache)
+        times.append(time.perf_counter() - tic)
+    return sorted(times)[len(times) // 2], out, cache
+
+
+def main(opt):
+    torch.set_num_threads(opt.threads)
+    model = tiny_unet(model_channels=opt.model_channels)
+    with torch.no_grad():
+        run(model, opt)  # warm up
+        base_time, base, _ = timed(model, opt, lambda: None)
+        print(f"{'interval':>8} {'depth':>5} {'time s':>8} {'speedup':>8} {'cached':>7} {'rel err':>8}")
+        print(f"{1:>8} {'-':>5} {base_time:>8.3f} {1:>8.2f} {0:>6.0%} {0:>8.4f}")
+        for interval in opt.intervals:
+            for depth in opt.depths:
+                t, out, cache = timed(model, opt, lambda: DeepCache(interval, depth))
+                stats = model.last_run_stats["deep_cache"]
+                cached = stats["cheap_evals"] / max(1, stats["cheap_evals"] + stats["full_evals"])
+                error = ((out - base).pow(2).mean().sqrt() / base.pow(2).mean().sqrt()).item()
+                print(f"{interval:>8} {depth:>5} {t:>8.3f} {base_time / t:>8.2f} {cached:>6.0%} {error:>8.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DeepCache speed/quality table on a tiny unet")
+    parser.add_argument("--steps", type=int, default=30, help="sampling steps")
+    parser.add_argument("--sampler", type=str, default="ddim", help="sampler")
+    parser.add_argument("--size", type=int, default=32, help="latent size")
+    parser.add_argument("--batch", type=int, default=1, help="batch size")
+    parser.add_argument("--model_channels", type=int, default=64, help="width of the tiny unet")
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 5], help="deep cache intervals")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2], help="deep cache depths")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per setting, the median is reported")
+    parser.add_argument("--threads", type=int, default=4, help="cpu threads")
+    main(parser.parse_args())
@@ -0,0 +1,90 @@
+"""
+Time spent in the SpatialTransformers of the Encode (model1) and Decode (model2) halves at several token merge
+ratios, on a random-weight unet.
+
+    python tests/bench_token_merge.py --size 64 --model_channels 64 --ratios 0 0.25 0.5 0.75
+
+Prints one row per ratio: the median time of the transformers of each half per forward pass, the speedup against
+ratio 0 and the relative rms difference of the unet output.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch  # noqa: E402
+
+from ldm.modules.attention import SpatialTransformer  # noqa: E402
+from tiny_models import conditioning, tiny_unet  # noqa: E402
+
+
+def time_transformers(model, totals):
+    """adds the wall time of every SpatialTransformer forward to totals["model1"] / totals["model2"]"""
+    handles = []
+    for half in ("model1", "model2"):
+        for module in getattr(model, half).modules():
+            if isinstance(module, SpatialTransformer):
+                def start(module, inputs):
+                    module.bench_tic = time.perf_counter()
+
+                def stop(module, inputs, output, half=half):
+                    totals[half] += time.perf_counter() - module.bench_tic
+
+                handles += [module.register_forward_pre_hook(start), module.register_forward_hook(stop)]
+    return handles
+
+
+def forward(model, x, t, cond):
+    # the unet halves the way apply_model() calls them, speed_mp=None as in a default sampling run
+    h, emb, hs = model.model1(x, t, cond, None)
+    return model.model2(h, emb, x.dtype, hs, cond, None)
+
+
+def main(opt):
+    torch.set_num_threads(opt.threads)
+    model = tiny_unet(image_size=opt.size, model_channels=opt.model_channels)
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(opt.batch, 4, opt.size, opt.size, generator=generator)
+    t = torch.full((opt.batch,), 500, dtype=torch.long)
+    cond = conditioning(opt.batch)
+    totals = defaultdict(float)
+    handles = time_transformers(model, totals)
+    rows, base = [], None
+    with torch.no_grad():
+        for ratio in opt.ratios:
+            model.set_token_merge(ratio, opt.max_downsample)
+            forward(model, x, t, cond)  # warm up
+            runs = defaultdict(list)
+            for _ in range(opt.repeats):
+                totals.clear()
+                out = forward(model, x, t, cond)
+                for half in ("model1", "model2"):
+                    runs[half].append(totals[half])
+            times = {half: sorted(v)[len(v) // 2] for half, v in runs.items()}
+            if base is None:
+                base = times, out
+            error = ((out - base[1]).pow(2).mean().sqrt() / base[1].pow(2).mean().sqrt()).item()
+            rows.append((ratio, times, error))
+    for handle in handles:
+        handle.remove()
+    model.set_token_merge(0)
+
+    print(f"{'ratio':>6} {'encode ms':>10} {'speedup':>8} {'decode ms':>10} {'speedup':>8} {'rel err':>8}")
+    for ratio, times, error in rows:
+        print(f"{ratio:>6.2f} {times['model1'] * 1e3:>10.2f} {base[0]['model1'] / times['model1']:>8.2f} "
+              f"{times['model2'] * 1e3:>10.2f} {base[0]['model2'] / times['model2']:>8.2f} {error:>8.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SpatialTransformer time at several token merge ratios")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0., 0.25, 0.5, 0.75], help="token merge ratios")
+    parser.add_argument("--max_downsample", type=int, default=1, help="largest downsampling factor that merges")
+    parser.add_argument("--size", type=int, default=64, help="latent size")
+    parser.add_argument("--batch", type=int, default=2, help="batch size")
+    parser.add_argument("--model_channels", type=int, default=64, help="width of the unet")
+    parser.add_argument("--repeats", type=int, default=5, help="timed forward passes, the median is reported")
+    parser.add_argument("--threads", type=int, default=4, help="cpu threads")
+    main(parser.parse_args())
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts in optimizedSD import each other flatly, ddpm.py imports them as optimizedSD.*
+for path in (ROOT, os.path.join(ROOT, "optimizedSD")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
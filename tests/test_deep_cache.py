@@ -0,0 +1,46 @@
+"""DeepCache runs part of the steps on kept features and stays close to the uncached run, on a tiny unet."""
+import pytest
+import torch
+
+from optimizedSD.deep_cache import DeepCache
+from tiny_models import conditioning, tiny_unet
+
+SHAPE = [1, 4, 16, 16]
+STEPS = 20
+
+
+def sample(model, deep_cache=None):
+    return model.sample(S=STEPS, conditioning=conditioning(1), shape=SHAPE, seed=0, sampler="ddim",
+                        unconditional_guidance_scale=7.5, unconditional_conditioning=conditioning(1, seed=1),
+                        batch_size=1, verbose=False, deep_cache=deep_cache)
+
+
+def relative_error(a, b):
+    return ((a - b).pow(2).mean().sqrt() / b.pow(2).mean().sqrt()).item()
+
+
+@pytest.fixture(scope="module")
+def reference():
+    model = tiny_unet()
+    with torch.no_grad():
+        return model, sample(model)
+
+
+@pytest.mark.parametrize("interval,depth", [(2, 1), (3, 1), (3, 2)])
+def test_deep_cache_skips_evaluations(reference, interval, depth):
+    model, plain = reference
+    with torch.no_grad():
+        cached = sample(model, DeepCache(interval, depth))
+    stats = model.last_run_stats["deep_cache"]
+    evals = stats["full_evals"] + stats["cheap_evals"]
+    assert evals >= STEPS
+    assert stats["cheap_evals"] >= evals - (evals + interval - 1) // interval
+    assert 0 < relative_error(cached, plain) < 0.2
+
+
+def test_deep_cache_interval_one_is_exact(reference):
+    model, plain = reference
+    with torch.no_grad():
+        cached = sample(model, DeepCache(1, 1))
+    assert model.last_run_stats["deep_cache"]["cheap_evals"] == 0
+    assert torch.allclose(cached, plain)
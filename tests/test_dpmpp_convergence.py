@@ -0,0 +1,38 @@
+"""DPM-Solver++ with 15-20 model evaluations lands close to a 50 step DDIM run of the same ODE, on a tiny unet."""
+import pytest
+import torch
+
+from tiny_models import conditioning, tiny_unet
+
+SHAPE = [1, 4, 16, 16]
+
+
+def sample(model, steps, sampler):
+    return model.sample(S=steps, conditioning=conditioning(1), shape=SHAPE, seed=0, sampler=sampler,
+                        unconditional_guidance_scale=3.0, unconditional_conditioning=conditioning(1, seed=1),
+                        batch_size=1, verbose=False)
+
+
+def relative_error(a, b):
+    return ((a - b).pow(2).mean().sqrt() / b.pow(2).mean().sqrt()).item()
+
+
+@pytest.fixture(scope="module")
+def reference():
+    model = tiny_unet()
+    return model, sample(model, 50, "ddim")
+
+
+@pytest.mark.parametrize("solver", ["dpmpp_2m", "dpmpp_3s"])
+def test_dpmpp_converges_to_ddim(reference, solver, monkeypatch):
+    model, ddim = reference
+    # ddim starts at the first timestep of its schedule, not at the last one of the model, start there as well
+    t_max = int(model.ddim_timesteps[-1])
+    schedule = model.sigma_schedule
+    monkeypatch.setattr(model, "sigma_schedule",
+                        lambda n, kind="karras", t_start=None: schedule(n, kind, t_max if t_start is None else t_start))
+
+    errors = {steps: relative_error(sample(model, steps, solver), ddim) for steps in (5, 15, 20)}
+    assert errors[20] < errors[5]
+    assert errors[15] < errors[5]
+    assert errors[15] < 0.05 and errors[20] < 0.05, errors
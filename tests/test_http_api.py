@@ -0,0 +1,60 @@
+"""Validation of the job fields and failure isolation of the http api worker."""
+import asyncio
+import json
+
+import pytest
+
+from batching import BatchScheduler
+from http_api import ApiServer, HttpError, Job, parse_job
+
+
+@pytest.mark.parametrize("params", [
+    {"n_samples": "2"}, {"n_samples": 2.5}, {"n_samples": True}, {"scale": "7.5"}, {"turbo": 1},
+    {"prompt": ["an apple"]}, {"seed": "42"}, {"guidance_interval": [0, "1"]}, {"guidance_interval": [0.]},
+    {"tile_size": 64.}, {"sigma_schedule": 1},
+])
+def test_parse_job_rejects_wrong_types(params):
+    with pytest.raises(HttpError) as error:
+        parse_job("txt2img", json.dumps(params).encode())
+    assert error.value.status == 400
+    assert repr(next(iter(params))) in str(error.value)
+
+
+def test_parse_job_accepts_defaults_and_ints_for_floats():
+    params = dict(prompt="an apple", n_samples=2, scale=7, ddim_eta=0, seed=None, tile_size=64, turbo=True,
+                  guidance_interval=[0, 0.8], sigma_schedule="karras")
+    assert parse_job("txt2img", json.dumps(params).encode()) == {**params, "return_bytes": True}
+
+
+class FakeService:
+    """stands in for GenerationService, fails the jobs whose prompt is "fail" or whose fields it can't use"""
+
+    def run(self, job, progress=None):
+        if job["prompt"] == "fail" or job.get("stop_threshold", 0.) > 0:
+            raise RuntimeError("sampling failed")
+        return dict(images=[""] * job.get("n_samples", 1))
+
+    def run_batch(self, jobs, progress=None):
+        return [self.run(job, progress) for job in jobs]
+
+
+def test_worker_fails_only_the_affected_jobs():
+    async def scenario():
+        server = ApiServer(FakeService(), scheduler=BatchScheduler(max_batch=4, max_wait=0.01))
+        jobs = [Job("txt2img", params) for params in (
+            {"prompt": "an apple"}, {"prompt": "a pear", "n_samples": "2"}, {"prompt": "fail"},
+            {"prompt": "a plum", "stop_threshold": "high"}, {"prompt": "a fig"})]
+        for job in jobs:
+            server.jobs[job.id] = job
+            server.queue.put_nowait(job)
+        worker = asyncio.ensure_future(server.worker())
+        try:
+            for _ in range(200):
+                if all(job.status in ("done", "failed") for job in jobs):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            worker.cancel()
+        return [job.status for job in jobs]
+
+    assert asyncio.run(scenario()) == ["done", "failed", "failed", "failed", "done"]
@@ -0,0 +1,30 @@
+"""img2img at strength 0 runs no steps and keeps the image as it is in the sigma-space samplers."""
+import pytest
+import torch
+
+from tiny_models import conditioning, tiny_unet
+
+SHAPE = [1, 4, 16, 16]
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_unet()
+
+
+@pytest.mark.parametrize("sampler", ["dpmpp_2m", "dpmpp_3s", "k_euler", "k_heun", "k_lms"])
+def test_zero_steps_keep_the_image(model, sampler):
+    x0 = torch.randn(SHAPE, generator=torch.Generator().manual_seed(3))
+    model.make_schedule(ddim_num_steps=10, ddim_eta=0., verbose=False)
+    out = model.sample(S=0, conditioning=conditioning(1), x0=x0, seed=0, sampler=sampler,
+                       unconditional_guidance_scale=7.5, unconditional_conditioning=conditioning(1, seed=1),
+                       batch_size=1, verbose=False)
+    assert torch.equal(out, x0)
+
+
+def test_img2img_start_is_clamped(model):
+    x0 = torch.zeros(SHAPE)
+    model.make_schedule(ddim_num_steps=10, ddim_eta=0., verbose=False)
+    assert model.img2img_t_start(x0, 0) == model.ddim_timesteps[0]
+    assert model.img2img_t_start(x0, 3) == model.ddim_timesteps[2]
+    assert model.img2img_t_start(x0, 50) == model.ddim_timesteps[-1]
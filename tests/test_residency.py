@@ -0,0 +1,115 @@
+"""StageResidency on the cpu, as both the device and the host tier."""
+import pytest
+import torch
+
+from residency import StageResidency, module_bytes, stage_residency
+
+
+def linear(n):
+    # n * n weights + n biases in float32
+    return torch.nn.Linear(n, n)
+
+
+def mb(*modules):
+    return sum(module_bytes(m) for m in modules) / 1e6
+
+
+@pytest.fixture
+def no_moves(monkeypatch):
+    """records every Module.to() call"""
+    calls = []
+    original = torch.nn.Module.to
+
+    def to(self, *args, **kwargs):
+        calls.append(args)
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(torch.nn.Module, "to", to)
+    return calls
+
+
+def test_cpu_registration_is_resident():
+    a, b = linear(4), linear(8)
+    residency = stage_residency("cpu", modelCS=a, modelFS=b)
+    assert list(residency.resident) == ["modelCS", "modelFS"]
+    assert not residency.use_cuda
+    assert residency.resident_bytes() == module_bytes(a) + module_bytes(b)
+
+
+def test_acquire_release_offload_prefetch(no_moves):
+    a, b = linear(4), linear(8)
+    residency = stage_residency("cpu", modelCS=a, modelFS=b)
+    residency.offload_all()
+    assert list(residency.resident) == []
+
+    assert residency.acquire("modelCS") is a
+    assert residency.stats()["in_use"] == ["modelCS"]
+    assert list(residency.resident) == ["modelCS"]
+    # without a budget a released stage goes back to the host at once
+    residency.release("modelCS")
+    assert list(residency.resident) == [] and residency.stats()["in_use"] == []
+
+    residency.prefetch("modelFS")
+    assert list(residency.resident) == ["modelFS"] and residency.pending == {}
+    assert residency.acquire("modelFS") is b
+    residency.offload("modelFS")
+    assert list(residency.resident) == [] and residency.stats()["in_use"] == []
+
+    with residency.use("modelCS") as module:
+        assert module is a and residency.stats()["in_use"] == ["modelCS"]
+    assert residency.stats()["in_use"] == []
+    # device == host: all of the above is bookkeeping only
+    assert no_moves == []
+    assert residency.stream is None
+
+
+def test_budget_keeps_released_stages_and_evicts_lru():
+    a, b, c = linear(16), linear(16), linear(16)
+    residency = StageResidency("cpu", budget_mb=mb(a, b))
+    for name, module in (("a", a), ("b", b), ("c", c)):
+        residency.register(name, module)
+    residency.offload_all()
+
+    residency.acquire("a")
+    residency.release("a")
+    residency.acquire("b")
+    residency.release("b")
+    # both fit, released stages stay resident
+    assert list(residency.resident) == ["a", "b"]
+
+    residency.acquire("a")
+    residency.release("a")
+    # c needs room, b is now the least recently used one
+    residency.acquire("c")
+    assert list(residency.resident) == ["a", "c"]
+    assert residency.resident_bytes() <= residency.budget
+
+
+def test_budget_never_evicts_stages_in_use():
+    a, b, c = linear(16), linear(16), linear(16)
+    residency = StageResidency("cpu", budget_mb=mb(a, b))
+    for name, module in (("a", a), ("b", b), ("c", c)):
+        residency.register(name, module)
+    residency.offload_all()
+
+    residency.acquire("a")
+    residency.acquire("b")
+    residency.release("b")
+    residency.acquire("c")
+    assert "a" in residency.resident and "b" not in residency.resident
+    assert residency.stats()["in_use"] == ["a", "c"]
+
+
+def test_prefetch_makes_room():
+    a, b = linear(16), linear(16)
+    residency = StageResidency("cpu", budget_mb=mb(a))
+    residency.register("a", a)
+    residency.register("b", b)
+    residency.offload_all()
+    residency.acquire("a")
+    residency.release("a")
+    residency.prefetch("b")
+    assert list(residency.resident) == ["b"]
+    # a second prefetch of a resident stage does nothing
+    residency.prefetch("b")
+    assert list(residency.resident) == ["b"]
@@ -0,0 +1,41 @@
+"""A sample() call that fails half way leaves no per-run state behind for the next one."""
+import pytest
+import torch
+
+from ldm.modules.attention import CrossAttention
+from optimizedSD.deep_cache import DeepCache
+from tiny_models import conditioning, tiny_unet
+
+SHAPE = [1, 4, 16, 16]
+
+
+def sample(model, **kwargs):
+    return model.sample(S=6, conditioning=conditioning(1), shape=SHAPE, seed=0, sampler="ddim",
+                        unconditional_guidance_scale=7.5, unconditional_conditioning=conditioning(1, seed=1),
+                        batch_size=1, verbose=False, **kwargs)
+
+
+def test_failed_run_resets_state():
+    model = tiny_unet()
+    model.cache_context_kv = True
+    with torch.no_grad():
+        expected = sample(model)
+
+        def progress(step, total_steps):
+            if step == 2:
+                raise RuntimeError("cancelled")
+
+        with pytest.raises(RuntimeError, match="cancelled"):
+            sample(model, deep_cache=DeepCache(2, 1), tile_size=8, tile_overlap=4, progress=progress)
+
+        assert model.noise is None
+        assert model.guidance is None
+        assert model.deep_cache is None
+        assert model.progress is None
+        assert model.tiling is None
+        assert model.tile_conds == {}
+        assert model.tile_weight_cache is None
+        assert all(module.kv_cache is None for module in list(model.model1.modules()) + list(model.model2.modules())
+                   if isinstance(module, CrossAttention))
+
+        assert torch.equal(sample(model), expected)
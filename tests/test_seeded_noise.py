@@ -0,0 +1,55 @@
+"""The seeded noise of a sample only depends on its seed and draw, never on the batch it is drawn in."""
+import pytest
+import torch
+
+from optimizedSD.ddpm import sample_seeds
+from optimizedSD.seeded_noise import SeededNoise, philox_randn
+
+SHAPE = (4, 9, 7)  # 252 elements, the last philox block is cut
+
+
+def draws(seeds, n=3):
+    noise = SeededNoise(seeds)
+    return [noise.randn(SHAPE) for _ in range(n)]
+
+
+@pytest.mark.parametrize("batch", [[11, 42, 7], [5, 6, 42, 1234567890123, 0]])
+def test_noise_does_not_depend_on_the_batch(batch):
+    k = batch.index(42)
+    for alone, together in zip(draws([42]), draws(batch)):
+        assert torch.equal(alone[0], together[k])
+
+
+def test_draws_and_streams_differ():
+    first, second = draws([42], n=2)
+    other_stream = SeededNoise([42], stream=1).randn(SHAPE)
+    assert not torch.equal(first, second)
+    assert not torch.equal(first, other_stream)
+    assert torch.equal(first, draws([42], n=1)[0])
+
+
+def test_noise_does_not_depend_on_the_length():
+    seeds = [3, 4]
+    assert torch.equal(philox_randn(seeds, 10)[:, :6], philox_randn(seeds, 6))
+
+
+def test_noise_is_standard_normal():
+    x = philox_randn([0, 1, 2, 3], 50000).double()
+    assert abs(x.mean().item()) < 0.01
+    assert abs(x.std().item() - 1) < 0.01
+
+
+def test_randn_like_checks_the_batch():
+    with pytest.raises(ValueError):
+        SeededNoise([1, 2]).randn_like(torch.zeros(3, 4))
+
+
+def test_per_sample_seeds():
+    assert sample_seeds(40, 3) == [40, 41, 42]
+    assert sample_seeds([99, 41, 7], 3) == [99, 41, 7]
+    with pytest.raises(ValueError):
+        sample_seeds([1, 2], 3)
+    # a job batched with others gets the rows of its own consecutive seeds
+    alone = SeededNoise(sample_seeds(41, 1)).randn(SHAPE)
+    batched = SeededNoise(sample_seeds([99, 41, 7], 3)).randn(SHAPE)
+    assert torch.equal(alone[0], batched[1])
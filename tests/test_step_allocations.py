@@ -0,0 +1,68 @@
+"""
+The sampler step loop reuses its buffers. The unet is replaced by a stand-in that returns the same preallocated
+tensor every time, so every allocation the cpu memory profiler sees (ops whose own cpu memory usage is positive)
+is made by the sampler itself.
+"""
+import pytest
+import torch
+
+from tiny_models import conditioning, tiny_unet
+
+SHAPE = [1, 4, 16, 16]
+# what a step still allocates: pred_x0 and x_prev of ddim_update(), plms adds the 8 temporaries of its 4th order
+# combination of the old eps. The per-step torch.cat of x, t and the conditioning or a noise draw at eta 0 all
+# push a sampler over its budget.
+ALLOCATIONS_PER_STEP = dict(ddim=2, plms=10)
+
+
+class FixedOutput:
+    """stands in for UNet.apply_model, returns zeros and records the buffers of every guided call"""
+
+    def __init__(self):
+        self.out = torch.zeros([2] + SHAPE[1:])
+        self.guided_calls = []
+
+    def __call__(self, x, t, c, **kwargs):
+        if x.shape[0] == 2:
+            # t is a row of the plan's timestep table, its base address is that of the table
+            self.guided_calls.append((x.data_ptr(), c.data_ptr(), t.data_ptr() - t.storage_offset() * t.element_size()))
+        return self.out.zero_()[:x.shape[0]]
+
+
+def count_allocations(fn):
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    return sum(1 for event in prof.function_events if event.self_cpu_memory_usage > 0)
+
+
+def sample(model, steps, sampler):
+    return model.sample(S=steps, conditioning=conditioning(1), shape=SHAPE, seed=0, sampler=sampler,
+                        unconditional_guidance_scale=7.5, unconditional_conditioning=conditioning(1, seed=1),
+                        batch_size=1, verbose=False)
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_unet()
+
+
+@pytest.mark.parametrize("sampler", ["plms", "ddim"])
+def test_step_allocations_are_bounded(model, sampler, monkeypatch):
+    monkeypatch.setattr(model, "apply_model", FixedOutput())
+    steps = 5
+    counts = {}
+    for n in (steps, 2 * steps):
+        sample(model, n, sampler)  # builds the schedule and the sampling plan
+        counts[n] = count_allocations(lambda: sample(model, n, sampler))
+    # the first steps (plms warm-up) are in both runs, the difference is `steps` steady steps
+    assert (counts[2 * steps] - counts[steps]) / steps <= ALLOCATIONS_PER_STEP[sampler]
+
+
+@pytest.mark.parametrize("sampler", ["plms", "ddim", "dpmpp_2m"])
+def test_cfg_buffers_are_reused(model, sampler, monkeypatch):
+    fixed = FixedOutput()
+    monkeypatch.setattr(model, "apply_model", fixed)
+    sample(model, 6, sampler)
+    # the doubled input, the [uncond, cond] conditioning and the timestep table are the same at every step
+    assert len(fixed.guided_calls) >= 6
+    assert len(set(fixed.guided_calls)) == 1
@@ -0,0 +1,81 @@
+"""Tiled first stage encode/decode against the plain one, on a tiny autoencoder with random weights."""
+import pytest
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+from optimizedSD.ddpm import FirstStage
+
+
+def tiny_first_stage():
+    torch.manual_seed(0)
+    config = OmegaConf.create(dict(
+        target="ldm.models.autoencoder.AutoencoderKL",
+        params=dict(
+            embed_dim=4,
+            ddconfig=dict(double_z=True, z_channels=4, resolution=64, in_channels=3, out_ch=3, ch=32, ch_mult=[1, 2],
+                          num_res_blocks=1, attn_resolutions=[], dropout=0.0, attn_type="none"),
+            lossconfig=dict(target="torch.nn.Identity"),
+        ),
+    ))
+    return FirstStage(config, timesteps=1000, scale_factor=0.18215).eval()
+
+
+def relative_error(a, b):
+    return ((a - b).pow(2).mean().sqrt() / b.std()).item()
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_first_stage()
+
+
+def test_tiled_apply_blends_exactly():
+    model = tiny_first_stage()
+    x = torch.randn(2, 4, 40, 56)
+    # a pointwise function and an upsampling one give the same result tiled, only the blending is tested
+    out = model.tiled_apply(lambda t: 2 * t + 1, x, 16, 6, 1)
+    torch.testing.assert_close(out, 2 * x + 1)
+    up = lambda t: F.interpolate(t, scale_factor=2, mode="nearest")
+    out = model.tiled_apply(up, x, 16, 6, 2)
+    torch.testing.assert_close(out, up(x))
+
+
+def test_tiling_off_below_tile_size(model):
+    z = torch.randn(1, 4, 16, 16)
+    plain = model.decode_first_stage(z)
+    model.set_tiling(True, tile_size=16, overlap=8)
+    try:
+        torch.testing.assert_close(model.decode_first_stage(z), plain)
+    finally:
+        model.set_tiling(False)
+
+
+def test_tiled_decode_close_to_plain(model):
+    torch.manual_seed(1)
+    z = torch.randn(1, 4, 48, 40)
+    plain = model.decode_first_stage(z)
+    model.set_tiling(True, tile_size=24, overlap=12)
+    try:
+        tiled = model.decode_first_stage(z)
+    finally:
+        model.set_tiling(False)
+    assert tiled.shape == plain.shape == (1, 3, 96, 80)
+    # group norm statistics and zero padding are per tile, so close but not exact
+    assert relative_error(tiled, plain) < 0.15
+    # far closer than the decode of another latent
+    assert relative_error(model.decode_first_stage(torch.randn_like(z)), plain) > 0.5
+
+
+def test_tiled_encode_close_to_plain(model):
+    torch.manual_seed(2)
+    x = torch.rand(1, 3, 96, 80) * 2 - 1
+    plain = model.encode_first_stage(x)
+    model.set_tiling(True, tile_size=24, overlap=12)
+    try:
+        tiled = model.encode_first_stage(x)
+    finally:
+        model.set_tiling(False)
+    assert tiled.mean.shape == plain.mean.shape == (1, 4, 48, 40)
+    assert relative_error(tiled.mean, plain.mean) < 0.15
+    assert relative_error(tiled.logvar, plain.logvar) < 0.15
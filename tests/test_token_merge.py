@@ -0,0 +1,29 @@
+"""Token merging averages every destination token with the source tokens merged into it."""
+import torch
+
+from ldm.modules.token_merge import bipartite_soft_matching
+
+
+def test_merge_averages_sources_into_destinations():
+    torch.manual_seed(0)
+    h = w = 4
+    x = torch.randn(2, h * w, 8)
+    merge, unmerge = bipartite_soft_matching(x, h, w, ratio=0.5)
+    merged = merge(x)
+    assert merged.shape == (2, h * w // 2, 8)
+
+    # each token of the output of unmerge() is the merged token it went into
+    out = unmerge(merged)
+    for b in range(2):
+        for token in merged[b]:
+            members = [i for i in range(h * w) if torch.equal(out[b, i], token)]
+            assert members
+            assert torch.allclose(token, x[b, members].mean(dim=0), atol=1e-6)
+
+
+def test_merge_keeps_constant_tokens():
+    x = torch.ones(1, 64, 4)
+    x[..., 0] = torch.linspace(1, 2, 64)
+    merge, unmerge = bipartite_soft_matching(x, 8, 8, ratio=0.5)
+    assert torch.allclose(merge(x)[..., 1:], torch.ones(1, 32, 3))
+    assert unmerge(merge(x)).shape == x.shape
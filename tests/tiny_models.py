@@ -0,0 +1,40 @@
+"""Tiny random-weight versions of the split models, small enough for cpu tests and benchmarks."""
+import torch
+from omegaconf import OmegaConf
+
+from optimizedSD.ddpm import UNet
+
+CONTEXT_DIM = 32
+CONTEXT_LEN = 8
+
+
+def unet_config(**overrides):
+    params = dict(image_size=16, in_channels=4, out_channels=4, model_channels=32, attention_resolutions=[1, 2],
+                  num_res_blocks=1, channel_mult=[1, 2], num_heads=2, use_spatial_transformer=True,
+                  transformer_depth=1, context_dim=CONTEXT_DIM, use_checkpoint=False, legacy=False)
+    params.update(overrides)
+    return params
+
+
+def tiny_unet(seed=0, **overrides):
+    """UNet on the cpu with random weights. The zero-initialized output layers get small random weights too,
+    otherwise the model predicts exactly 0 and every sampler agrees trivially."""
+    torch.manual_seed(seed)
+    params = unet_config(**overrides)
+    model = UNet(
+        OmegaConf.create(dict(target="optimizedSD.openaimodelSplit.UNetModelEncode", params=params)),
+        OmegaConf.create(dict(target="optimizedSD.openaimodelSplit.UNetModelDecode", params=params)),
+        linear_start=0.00085, linear_end=0.0120, num_timesteps_cond=1, timesteps=1000, image_size=16, channels=4,
+        conditioning_key="crossattn", scale_factor=0.18215, use_ema=False, monitor=None,
+    )
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.dim() > 1 and not param.any():
+                param.normal_(std=0.02)
+    model.cdevice = "cpu"
+    return model.eval()
+
+
+def conditioning(batch_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, CONTEXT_LEN, CONTEXT_DIM, generator=generator)